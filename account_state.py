@@ -0,0 +1,130 @@
+"""Durable per-account stage progress backed by an append-only JSONL journal."""
+import json
+import logging
+import threading
+import time
+from config import STATE_FILE
+
+# Stages of process_account, in the order they complete
+STAGES = [
+    'profile_created',
+    'browser_opened',
+    'login_submitted',
+    'code_received',
+    'verified',
+]
+
+
+class AccountState:
+    """Replayed state of one account."""
+
+    def __init__(self, email):
+        self.email = email
+        self.stages = {}  # stage -> timestamp it completed
+        self.failed_stage = None
+        self.last_error = None
+        self.updated_at = None
+
+    @property
+    def verified(self):
+        return 'verified' in self.stages
+
+    @property
+    def failed(self):
+        return self.failed_stage is not None
+
+    def apply(self, record):
+        """Apply one journal record."""
+        self.updated_at = record['ts']
+        if record['status'] == 'ok':
+            self.stages[record['stage']] = record['ts']
+            if record['stage'] == self.failed_stage or record['stage'] == 'verified':
+                self.failed_stage = None
+        elif record['status'] == 'failed':
+            self.failed_stage = record['stage']
+            self.last_error = record.get('error')
+        elif record['status'] == 'started':
+            # A new attempt supersedes the progress of the previous one
+            self.stages = {}
+            self.failed_stage = None
+
+
+class AccountStateStore:
+    """Thread-safe journal of stage transitions, replayed into AccountState on load."""
+
+    def __init__(self, filename=STATE_FILE):
+        self.filename = filename
+        self.accounts = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Replay the journal; a torn trailing line from a crash is ignored."""
+        count = 0
+        try:
+            with open(self.filename, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        logging.warning(f"Skipping unreadable state record: {line.strip()}")
+                        continue
+                    self._apply(record)
+                    count += 1
+        except FileNotFoundError:
+            logging.info(f"No state journal found at {self.filename}, starting fresh")
+        except Exception as e:
+            logging.error(f"Error reading state journal: {str(e)}")
+        logging.info(f"Replayed {count} state records for {len(self.accounts)} accounts")
+        return self
+
+    def get(self, email):
+        """Return the AccountState for email, or None if it was never seen."""
+        return self.accounts.get(email)
+
+    def _apply(self, record):
+        state = self.accounts.get(record['email'])
+        if state is None:
+            state = self.accounts[record['email']] = AccountState(record['email'])
+        state.apply(record)
+
+    def _append(self, email, stage, status, error=None):
+        record = {'ts': time.time(), 'email': email, 'stage': stage, 'status': status}
+        if error:
+            record['error'] = error
+        with self._lock:
+            self._apply(record)
+            try:
+                with open(self.filename, 'a') as f:
+                    f.write(json.dumps(record) + "\n")
+            except Exception as e:
+                logging.error(f"Error writing state journal: {str(e)}")
+
+    def start(self, email):
+        """Record the start of a new attempt for an account."""
+        self._append(email, None, 'started')
+
+    def complete(self, email, stage):
+        """Record that a stage completed."""
+        self._append(email, stage, 'ok')
+
+    def fail(self, email, stage, error):
+        """Record that a stage failed, with the error message."""
+        self._append(email, stage, 'failed', error)
+
+    def select(self, accounts, resume=False, only_failed=False, retry_stage=None):
+        """Lazily filter accounts according to the --resume/--only-failed/--retry-stage options."""
+        selected = total = 0
+        for account in accounts:
+            total += 1
+            state = self.accounts.get(account['email'])
+            if retry_stage:
+                if state is None or state.failed_stage != retry_stage:
+                    continue
+            elif only_failed:
+                if state is None or not state.failed:
+                    continue
+            elif resume and state is not None and state.verified:
+                continue
+            selected += 1
+            yield account
+        logging.info(f"Selected {selected}/{total} accounts from state journal")
@@ -0,0 +1,117 @@
+"""Streaming account loader for text, CSV and JSONL account lists."""
+import csv
+import hashlib
+import json
+import logging
+import os
+
+ACCOUNT_FIELDS = ('email', 'email_password', 'tiktok_password')
+FORMATS = ('text', 'csv', 'jsonl')
+_EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+
+def parse_shard(value):
+    """Parse an --shard value "i/n" (1 <= i <= n) into a zero-based (index, count)."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except (AttributeError, ValueError):
+        raise ValueError(f"Invalid shard {value!r}, expected i/n such as 1/4")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Invalid shard {value!r}, i must be between 1 and n")
+    return index - 1, count
+
+
+def shard_of(email, count):
+    """Stable shard number of an email; the same on every host and run."""
+    digest = hashlib.sha1(email.strip().lower().encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def detect_format(filename):
+    """Guess the account list format from the file extension."""
+    return _EXTENSIONS.get(os.path.splitext(filename)[1].lower(), 'text')
+
+
+def _text_rows(f):
+    for line in f:
+        if not line.strip():  # Skip empty lines
+            continue
+        parts = line.split()
+        if len(parts) != len(ACCOUNT_FIELDS):
+            logging.error(f"Invalid line format in accounts file: {line.strip()}")
+            logging.error(f"Expected format: email email_password tiktok_password")
+            continue
+        yield dict(zip(ACCOUNT_FIELDS, parts))
+
+
+def _csv_rows(f):
+    reader = csv.reader(f)
+    columns = ACCOUNT_FIELDS
+    for row in reader:
+        if not row or not any(cell.strip() for cell in row):
+            continue
+        cells = [cell.strip() for cell in row]
+        if reader.line_num == 1 and cells[0].lower() == 'email':
+            columns = tuple(cell.lower() for cell in cells)
+            continue
+        account = dict(zip(columns, cells))
+        if not all(account.get(field) for field in ACCOUNT_FIELDS):
+            logging.error(f"Invalid row {reader.line_num} in accounts file: missing fields")
+            continue
+        yield {field: account[field] for field in ACCOUNT_FIELDS}
+
+
+def _jsonl_rows(f):
+    for line_number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            account = json.loads(line)
+        except ValueError as e:
+            logging.error(f"Invalid JSON on line {line_number} of accounts file: {str(e)}")
+            continue
+        if not isinstance(account, dict) or not all(account.get(field) for field in ACCOUNT_FIELDS):
+            logging.error(f"Invalid account on line {line_number} of accounts file: missing fields")
+            continue
+        yield {field: str(account[field]) for field in ACCOUNT_FIELDS}
+
+
+_READERS = {'text': _text_rows, 'csv': _csv_rows, 'jsonl': _jsonl_rows}
+
+
+def iter_accounts(filename, fmt=None, shard=None):
+    """Yield account dicts from filename one at a time.
+
+    fmt is 'text' (email email_password tiktok_password per line), 'csv' or
+    'jsonl', detected from the extension when None. Repeated emails are
+    skipped after their first occurrence. shard is a zero-based
+    (index, count) pair from parse_shard(); only accounts whose email hashes
+    to that shard are yielded, so hosts can split one list without
+    coordinating.
+    """
+    fmt = fmt or detect_format(filename)
+    seen = set()
+    loaded = duplicates = other_shards = 0
+    try:
+        with open(filename, 'r', newline='' if fmt == 'csv' else None) as f:
+            for account in _READERS[fmt](f):
+                key = account['email'].strip().lower()
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                if shard is not None and shard_of(key, shard[1]) != shard[0]:
+                    other_shards += 1
+                    continue
+                loaded += 1
+                yield account
+    except FileNotFoundError:
+        logging.error(f"Accounts file not found: {filename}")
+        return
+    except Exception as e:
+        logging.error(f"Error reading accounts file: {str(e)}")
+        return
+    logging.info(
+        f"Read {loaded} accounts from {filename} "
+        f"({duplicates} duplicates, {other_shards} in other shards skipped)"
+    )
@@ -1,28 +1,65 @@
 """AdsPower API integration for browser profile management."""
 import requests
 import logging
-import time
 import socket
 import json
-from urllib.parse import urljoin
+import threading
+from urllib.parse import urljoin, urlsplit
 from config import (
     ADSPOWER_API_URL, ADSPOWER_LOCAL_URL, ADSPOWER_CREATE_PROFILE,
-    ADSPOWER_OPEN_URL, ADSPOWER_CLOSE_URL,
-    ADSPOWER_TIMEOUT, MAX_RETRIES, RETRY_DELAY, CLI_CREDENTIAL
+    ADSPOWER_OPEN_URL, ADSPOWER_CLOSE_URL, ADSPOWER_LIST_PROFILES, ADSPOWER_ACTIVE_URL,
+    ADSPOWER_LIST_PAGE_SIZE, ADSPOWER_TIMEOUT, ADSPOWER_RATE_LIMITS, CLI_CREDENTIAL,
+    BROWSER_LAUNCH_OPTIONS, LEAN_BROWSER_OPTIONS, HEADLESS_BROWSER_OPTIONS, SHUTDOWN_DEADLINE
 )
+from retry_policy import RetryableError, FatalError, adspower_error, account_deadline
+from utils import retry_operation
+from log_context import payload_logging_enabled
+from metrics import run_metrics
+from rate_limit import RateLimiter
+import cassette
+
+def launch_params(profile_id, launch_options=None):
+    """Query parameters for ADSPOWER_OPEN_URL; launch_args is sent as a JSON array."""
+    params = {"user_id": profile_id}
+    for key, value in (launch_options or {}).items():
+        params[key] = json.dumps(value) if isinstance(value, (list, tuple)) else value
+    return params
+
+def browser_launch_options(lean=False, headless=False):
+    """Combine the configured launch option sets for a run."""
+    options = dict(BROWSER_LAUNCH_OPTIONS)
+    if lean:
+        options.update(LEAN_BROWSER_OPTIONS)
+    if headless:
+        options.update(HEADLESS_BROWSER_OPTIONS)
+    return options
+
+def port_open(port, host='127.0.0.1', timeout=1):
+    """True if something accepts TCP connections on host:port."""
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
 
 class AdsPowerAPI:
-    def __init__(self):
-        self.base_url = ADSPOWER_API_URL
+    def __init__(self, base_url=ADSPOWER_API_URL, launch_options=None, rate_limits=ADSPOWER_RATE_LIMITS):
+        self.base_url = base_url
+        # Shared by every worker thread using this instance
+        self.rate_limiter = RateLimiter(rate_limits or {})
+        self.launch_options = launch_options if launch_options is not None else dict(BROWSER_LAUNCH_OPTIONS)
+        self._adopted = {}  # profile_id -> browser_info of browsers left open by a previous run
+        self._adopted_lock = threading.Lock()
         self.local_url = ADSPOWER_LOCAL_URL
         self.session = requests.Session()
 
-    def _check_port_status(self, host='local.adspower.net', port=50325):
+    def _check_port_status(self):
         """Check if AdsPower port is open and accessible."""
+        parts = urlsplit(self.base_url)
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             sock.settimeout(2)
-            result = sock.connect_ex((host, port))
+            result = sock.connect_ex((parts.hostname, parts.port or 80))
             sock.close()
             return result == 0
         except Exception as e:
@@ -30,29 +67,31 @@ class AdsPowerAPI:
             return False
 
     def _log_request_details(self, method, url, **kwargs):
-        """Log detailed request information."""
-        logging.debug(f"Request Details:")
-        logging.debug(f"Method: {method}")
-        logging.debug(f"URL: {url}")
-        if 'params' in kwargs:
-            logging.debug(f"Query Params: {kwargs['params']}")
-        if 'json' in kwargs:
-            logging.debug(f"Request Body: {json.dumps(kwargs['json'], indent=2)}")
-        if 'headers' in kwargs:
-            logging.debug(f"Headers: {kwargs['headers']}")
-
-    def _log_response_details(self, response):
-        """Log detailed response information."""
-        try:
-            logging.debug(f"Response Details:")
-            logging.debug(f"Status Code: {response.status_code}")
-            logging.debug(f"Response Headers: {dict(response.headers)}")
-            logging.debug(f"Response Body: {json.dumps(response.json(), indent=2)}")
-        except Exception as e:
-            logging.error(f"Failed to log response details: {str(e)}")
+        """Log the request and, when payload logging is on, its body."""
+        logging.debug(f"AdsPower request: {method.upper()} {url} params={kwargs.get('params')}")
+        if 'json' in kwargs and payload_logging_enabled():
+            logging.debug("AdsPower request body", extra={'payload': kwargs['json']})
+
+    def _log_response_details(self, response, data=None):
+        """Log the response and, when payload logging is on, its headers and body."""
+        logging.debug(
+            f"AdsPower response: {response.status_code} in {response.elapsed.total_seconds():.3f}s"
+        )
+        if payload_logging_enabled():
+            logging.debug(
+                "AdsPower response body",
+                extra={'payload': {
+                    'headers': dict(response.headers),
+                    'body': data if data is not None else response.text,
+                }}
+            )
 
     def _make_request(self, method, endpoint, **kwargs):
-        """Make HTTP request to AdsPower API with retries and enhanced error handling."""
+        """Make one HTTP request to AdsPower and classify failures.
+        
+        Retrying is left to the caller's retry policy: transport errors, 5xx
+        and 429 responses raise RetryableError, other HTTP errors FatalError.
+        """
         kwargs.setdefault('timeout', ADSPOWER_TIMEOUT)
         
         # Add CLI credential to headers
@@ -61,43 +100,43 @@ class AdsPowerAPI:
         kwargs['headers'] = headers
 
         url = urljoin(self.base_url, endpoint)
+        waited = self.rate_limiter.acquire(endpoint)
+        if waited:
+            # Only actual waits: a record per call would swamp the metrics windows
+            run_metrics.record(f"adspower_wait_{endpoint.rstrip('/').rsplit('/', 1)[-1]}", waited)
+            logging.debug(f"Waited {waited:.2f}s for the AdsPower rate limit on {endpoint}")
         self._log_request_details(method, url, **kwargs)
+        # Recorded with --record; answered from the cassette when replaying
+        return cassette.exchange(
+            'adspower', f"{method.upper()} {endpoint}",
+            lambda: self._send(method, url, **kwargs),
+            request={key: kwargs[key] for key in ('params', 'json') if key in kwargs}
+        )
+
+    def _send(self, method, url, **kwargs):
+        """One HTTP round trip: classify the failure or return the parsed body."""
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.Timeout as e:
+            raise RetryableError(f"AdsPower request timed out: {str(e)}") from e
+        except requests.exceptions.ConnectionError as e:
+            raise RetryableError(f"AdsPower connection error: {str(e)}") from e
         
-        for attempt in range(MAX_RETRIES):
-            try:
-                # Check port status before making request
-                if not self._check_port_status():
-                    logging.error(f"AdsPower port is not accessible (attempt {attempt + 1}/{MAX_RETRIES})")
-                    if attempt < MAX_RETRIES - 1:
-                        time.sleep(RETRY_DELAY * (attempt + 1))
-                        continue
-                    break
+        if response.status_code != 200:
+            self._log_response_details(response)
+            logging.error(f"Request failed with status code {response.status_code}")
+            logging.error(f"Response content: {response.text}")
+            error = RetryableError if response.status_code >= 500 or response.status_code == 429 else FatalError
+            raise error(f"AdsPower returned status code {response.status_code}")
 
-                # Make the request
-                response = self.session.request(method, url, **kwargs)
-                
-                # Log response details
-                self._log_response_details(response)
-
-                if response.status_code == 200:
-                    return response.json()
-                else:
-                    logging.error(f"Request failed with status code {response.status_code}")
-                    logging.error(f"Response content: {response.text}")
-                    
-            except requests.exceptions.Timeout:
-                logging.error(f"Request timed out (attempt {attempt + 1}/{MAX_RETRIES})")
-            except requests.exceptions.ConnectionError as e:
-                logging.error(f"Connection error (attempt {attempt + 1}/{MAX_RETRIES}): {str(e)}")
-            except json.JSONDecodeError as e:
-                logging.error(f"Invalid JSON response (attempt {attempt + 1}/{MAX_RETRIES}): {str(e)}")
-            except Exception as e:
-                logging.error(f"Unexpected error (attempt {attempt + 1}/{MAX_RETRIES}): {str(e)}")
-            
-            if attempt < MAX_RETRIES - 1:
-                time.sleep(RETRY_DELAY * (attempt + 1))
-    
-        raise Exception("Failed to connect to AdsPower API after multiple retries")
+        # Parse once; the parsed body is what gets logged
+        try:
+            data = response.json()
+        except ValueError as e:
+            self._log_response_details(response)
+            raise RetryableError(f"Invalid JSON response from AdsPower: {str(e)}") from e
+        self._log_response_details(response, data)
+        return data
 
     def check_connection(self):
         """Check if AdsPower is running and accessible with detailed diagnostics."""
@@ -122,68 +161,147 @@ class AdsPowerAPI:
             return False
 
     def create_profile(self, name):
-        """Create a new browser profile in AdsPower."""
+        """Create a new browser profile in AdsPower; raises a classified error on failure."""
         logging.info(f"Creating new AdsPower profile: {name}")
+        data = self._make_request(
+            'post',
+            ADSPOWER_CREATE_PROFILE,
+            json={"name": name, "group_id": "0"}
+        )
+        
+        if data["code"] != 0:
+            logging.error(f"Failed to create profile: {data.get('msg', 'Unknown error')}")
+            raise adspower_error(data)
+        
+        profile_id = data["data"]["id"]
+        logging.info(f"Successfully created profile with ID: {profile_id}")
+        return profile_id
+
+    def list_profiles(self):
+        """Return all AdsPower profiles as a list of dicts, or None on failure."""
+        logging.info("Listing AdsPower profiles")
+        profiles = []
+        page = 1
         try:
-            data = self._make_request(
-                'post',
-                ADSPOWER_CREATE_PROFILE,
-                json={"name": name, "group_id": "0"}
-            )
-            
-            if data["code"] == 0:
-                profile_id = data["data"]["id"]
-                logging.info(f"Successfully created profile with ID: {profile_id}")
-                return profile_id
-            else:
-                logging.error(f"Failed to create profile: {data.get('msg', 'Unknown error')}")
-                return None
-                
+            while True:
+                data = self._make_request(
+                    'get',
+                    ADSPOWER_LIST_PROFILES,
+                    params={"page": page, "page_size": ADSPOWER_LIST_PAGE_SIZE}
+                )
+                if data["code"] != 0:
+                    logging.error(f"Failed to list profiles: {data.get('msg', 'Unknown error')}")
+                    return None
+
+                batch = data["data"]["list"]
+                profiles.extend(batch)
+                if len(batch) < ADSPOWER_LIST_PAGE_SIZE:
+                    break
+                page += 1
+
+            logging.info(f"Found {len(profiles)} AdsPower profiles")
+            return profiles
+
         except Exception as e:
-            logging.error(f"Error creating AdsPower profile: {str(e)}")
+            logging.error(f"Error listing AdsPower profiles: {str(e)}")
             return None
 
-    def open_browser(self, profile_id):
-        """Start browser with specified profile."""
+    def open_browser(self, profile_id, launch_options=None):
+        """Start browser with specified profile; raises a classified error on failure.
+        
+        launch_options (default: the instance's) are passed to the start API,
+        e.g. headless, launch_args and open_tabs.
+        """
+        with self._adopted_lock:
+            adopted = self._adopted.pop(profile_id, None)
+        if adopted:
+            logging.info(f"Reusing browser left open for profile {profile_id}: {adopted}")
+            return adopted
         logging.info(f"Opening browser for profile: {profile_id}")
-        try:
-            data = self._make_request(
-                'get',
-                ADSPOWER_OPEN_URL,
-                params={"user_id": profile_id}
+        data = self._make_request(
+            'get',
+            ADSPOWER_OPEN_URL,
+            params=launch_params(
+                profile_id,
+                self.launch_options if launch_options is None else launch_options
             )
-            
-            if data["code"] == 0:
-                browser_info = {
-                    "selenium_port": data["data"]["selenium_port"],
-                    "debug_port": data["data"]["debug_port"]
-                }
-                logging.info(f"Successfully opened browser: {browser_info}")
-                return browser_info
-            else:
-                logging.error(f"Failed to open browser: {data.get('msg', 'Unknown error')}")
+        )
+        
+        if data["code"] != 0:
+            logging.error(f"Failed to open browser: {data.get('msg', 'Unknown error')}")
+            raise adspower_error(data)
+        
+        browser_info = {
+            "selenium_port": data["data"]["selenium_port"],
+            "debug_port": data["data"]["debug_port"]
+        }
+        logging.info(f"Successfully opened browser: {browser_info}")
+        return browser_info
+
+    def list_active_browsers(self):
+        """Return the browsers open on this AdsPower host, or None on failure.
+        
+        Each item is a dict with user_id, selenium_port and debug_port.
+        """
+        try:
+            data = self._make_request('get', ADSPOWER_ACTIVE_URL)
+            if data["code"] != 0:
+                logging.error(f"Failed to list active browsers: {data.get('msg', 'Unknown error')}")
                 return None
-                
+            browsers = []
+            for item in data["data"].get("list", []):
+                selenium = (item.get("ws") or {}).get("selenium", "")
+                port = item.get("selenium_port") or selenium.rpartition(':')[2] or item.get("debug_port")
+                browsers.append({
+                    "user_id": item["user_id"],
+                    "selenium_port": int(port),
+                    "debug_port": int(item.get("debug_port") or port),
+                })
+            return browsers
         except Exception as e:
-            logging.error(f"Error opening browser: {str(e)}")
+            logging.error(f"Error listing active browsers: {str(e)}")
             return None
 
+    def adopt_browser(self, profile_id, browser_info):
+        """Have the next open_browser(profile_id) reuse an already open browser."""
+        with self._adopted_lock:
+            self._adopted[profile_id] = {
+                "selenium_port": browser_info["selenium_port"],
+                "debug_port": browser_info["debug_port"],
+            }
+
+    def drop_adopted(self):
+        """Forget adopted browsers that were never reused and return their profile IDs."""
+        with self._adopted_lock:
+            profile_ids = list(self._adopted)
+            self._adopted.clear()
+        return profile_ids
+
     def close_browser(self, profile_id):
-        """Close browser for specified profile."""
+        """Close browser for specified profile; returns True once AdsPower confirms.
+        
+        Throttling, 5xx and timeouts are retried under the shared policy, all
+        within SHUTDOWN_DEADLINE, since a browser left open keeps its slot.
+        """
         logging.info(f"Closing browser for profile: {profile_id}")
         try:
-            data = self._make_request(
-                'get',
-                ADSPOWER_CLOSE_URL,
-                params={"user_id": profile_id}
-            )
-            success = data["code"] == 0
-            if success:
+            with account_deadline(SHUTDOWN_DEADLINE):
+                closed = retry_operation(self._stop_browser, profile_id)
+            if closed:
                 logging.info(f"Successfully closed browser for profile: {profile_id}")
-            else:
-                logging.error(f"Failed to close browser: {data.get('msg', 'Unknown error')}")
-            return success
-            
+            return bool(closed)
         except Exception as e:
             logging.error(f"Error closing browser: {str(e)}")
             return False
+
+    def _stop_browser(self, profile_id):
+        """One stop call; raises a classified error on failure."""
+        data = self._make_request(
+            'get',
+            ADSPOWER_CLOSE_URL,
+            params={"user_id": profile_id}
+        )
+        if data["code"] != 0:
+            logging.error(f"Failed to close browser: {data.get('msg', 'Unknown error')}")
+            raise adspower_error(data)
+        return True
@@ -0,0 +1,326 @@
+"""Asyncio client for the AdsPower local API with a keep-alive connection pool."""
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import urlencode, urlsplit
+from config import (
+    ADSPOWER_API_URL, ADSPOWER_CREATE_PROFILE, ADSPOWER_OPEN_URL,
+    ADSPOWER_CLOSE_URL, ADSPOWER_TIMEOUT, MAX_RETRIES,
+    CLI_CREDENTIAL, ADSPOWER_POOL_SIZE, ADSPOWER_HEALTH_TTL,
+    ADSPOWER_BREAKER_THRESHOLD, ADSPOWER_BREAKER_COOLDOWN, BROWSER_LAUNCH_OPTIONS,
+    ADSPOWER_RATE_LIMITS
+)
+from retry_policy import RetryableError, FatalError, adspower_error, backoff_delay, is_retryable
+from ads_power import launch_params
+from metrics import run_metrics
+from rate_limit import RateLimiter
+
+
+class CircuitOpenError(FatalError):
+    """Raised when calls are refused because AdsPower is considered down."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker.
+
+    Once the cooldown has passed, a single trial call is let through
+    (half-open); its success closes the circuit, its failure re-opens it.
+    """
+
+    def __init__(self, threshold=ADSPOWER_BREAKER_THRESHOLD, cooldown=ADSPOWER_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False  # the half-open trial call is in flight
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """Return True if a call may go through; while half-open only the first caller may."""
+        state = self.state
+        if state == 'half-open':
+            if self.probing:
+                return False
+            self.probing = True
+        return state != 'open'
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logging.info("AdsPower circuit closed")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == 'half-open' or self.failures >= self.threshold:
+            if self.state != 'open':
+                logging.error(f"AdsPower circuit opened after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+
+
+class _ConnectionPool:
+    """Pool of keep-alive HTTP/1.1 connections to a single host."""
+
+    def __init__(self, host, port, size):
+        self.host = host
+        self.port = port
+        self._idle = []
+        self._slots = asyncio.Semaphore(size)
+
+    async def acquire(self):
+        await self._slots.acquire()
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        except BaseException:
+            self._slots.release()
+            raise
+        return reader, writer, False
+
+    def release(self, conn, reusable):
+        reader, writer = conn
+        if reusable and not writer.is_closing():
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        self._slots.release()
+
+    async def close(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+
+async def _read_response(reader):
+    """Read one HTTP/1.1 response; return (status, headers, body)."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("Connection closed by AdsPower")
+    status = int(status_line.split()[1])
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                await reader.readline()
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+        body = b''.join(chunks)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        headers['connection'] = 'close'
+    return status, headers, body
+
+
+class AsyncAdsPowerAPI:
+    """Async counterpart of AdsPowerAPI sharing one connection pool per instance."""
+
+    def __init__(self, base_url=ADSPOWER_API_URL, pool_size=ADSPOWER_POOL_SIZE, launch_options=None,
+                 rate_limits=ADSPOWER_RATE_LIMITS):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self._pool = _ConnectionPool(self.host, self.port, pool_size)
+        self.launch_options = launch_options if launch_options is not None else dict(BROWSER_LAUNCH_OPTIONS)
+        self.breaker = CircuitBreaker()
+        self.rate_limiter = RateLimiter(rate_limits)
+        self._health = None
+        self._health_checked_at = 0.0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        """Close all pooled connections."""
+        await self._pool.close()
+
+    async def _send(self, method, path, params=None, json_body=None):
+        """Send one request over a pooled connection and return the decoded JSON."""
+        if params:
+            path = f"{path}?{urlencode(params)}"
+        body = json.dumps(json_body).encode() if json_body is not None else b''
+        head = (
+            f"{method.upper()} {path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"Serial-Number: {CLI_CREDENTIAL}\r\n"
+            "Connection: keep-alive\r\n"
+            f"Content-Length: {len(body)}\r\n"
+        )
+        if json_body is not None:
+            head += "Content-Type: application/json\r\n"
+        payload = (head + "\r\n").encode() + body
+
+        # A pooled connection may have been dropped by the server while idle;
+        # in that case retry once on a fresh connection.
+        for _ in range(2):
+            reader, writer, reused = await self._pool.acquire()
+            reusable = False
+            try:
+                writer.write(payload)
+                await writer.drain()
+                status, headers, raw = await _read_response(reader)
+                reusable = headers.get('connection', '').lower() != 'close'
+            except (ConnectionError, asyncio.IncompleteReadError):
+                if reused:
+                    continue
+                raise
+            finally:
+                self._pool.release((reader, writer), reusable)
+
+            if status != 200:
+                error = RetryableError if status >= 500 or status == 429 else FatalError
+                raise error(f"AdsPower returned status code {status}")
+            try:
+                return json.loads(raw)
+            except ValueError as e:
+                raise RetryableError(f"Invalid JSON response from AdsPower: {str(e)}") from e
+        raise ConnectionError("AdsPower closed the connection")
+
+    async def _make_request(self, method, endpoint, **kwargs):
+        """Make one request through the rate limiter and circuit breaker, like AdsPowerAPI's.
+        
+        Transport errors, timeouts, 5xx and 429 raise RetryableError and
+        count against the breaker; other HTTP errors raise FatalError.
+        """
+        waited = self.rate_limiter.reserve(endpoint)
+        if waited:
+            run_metrics.record(f"adspower_wait_{endpoint.rstrip('/').rsplit('/', 1)[-1]}", waited)
+            await asyncio.sleep(waited)
+        if not self.breaker.allow():
+            raise CircuitOpenError("AdsPower circuit is open, refusing request")
+        try:
+            data = await asyncio.wait_for(self._send(method, endpoint, **kwargs), ADSPOWER_TIMEOUT)
+        except FatalError:
+            # AdsPower answered, so it is up
+            self.breaker.record_success()
+            raise
+        except RetryableError:
+            self.breaker.record_failure()
+            raise
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            self.breaker.record_failure()
+            raise RetryableError(f"AdsPower request failed: {str(e)}") from e
+        except asyncio.CancelledError:
+            # Neither outcome; let the next caller probe instead
+            self.breaker.probing = False
+            raise
+        self.breaker.record_success()
+        return data
+
+    async def _call(self, method, endpoint, **kwargs):
+        """_make_request retried under the shared policy; a non-zero code raises adspower_error()."""
+        for attempt in range(MAX_RETRIES):
+            try:
+                data = await self._make_request(method, endpoint, **kwargs)
+                if data["code"] != 0:
+                    raise adspower_error(data)
+                return data
+            except Exception as e:
+                if not is_retryable(e) or attempt == MAX_RETRIES - 1:
+                    raise
+                logging.error(f"AdsPower request failed (attempt {attempt + 1}/{MAX_RETRIES}): {str(e)}")
+            await asyncio.sleep(backoff_delay(attempt))
+
+    async def check_connection(self):
+        """Check AdsPower health, caching the result for ADSPOWER_HEALTH_TTL seconds."""
+        if self._health is not None and time.monotonic() - self._health_checked_at < ADSPOWER_HEALTH_TTL:
+            return self._health
+
+        try:
+            response = await self._make_request('get', '/status')
+            healthy = response.get("code") == 0
+            if not healthy:
+                logging.error(f"AdsPower service check failed: {response.get('msg', 'Unknown error')}")
+        except Exception as e:
+            logging.error(f"AdsPower connection check failed: {str(e)}")
+            healthy = False
+
+        self._health = healthy
+        self._health_checked_at = time.monotonic()
+        return healthy
+
+    async def create_profile(self, name):
+        """Create a new browser profile in AdsPower."""
+        logging.info(f"Creating new AdsPower profile: {name}")
+        try:
+            data = await self._call(
+                'post',
+                ADSPOWER_CREATE_PROFILE,
+                json_body={"name": name, "group_id": "0"}
+            )
+            profile_id = data["data"]["id"]
+            logging.info(f"Successfully created profile with ID: {profile_id}")
+            return profile_id
+        except Exception as e:
+            logging.error(f"Error creating AdsPower profile: {str(e)}")
+            return None
+
+    async def open_browser(self, profile_id, launch_options=None):
+        """Start browser with specified profile and launch options."""
+        logging.info(f"Opening browser for profile: {profile_id}")
+        try:
+            data = await self._call(
+                'get',
+                ADSPOWER_OPEN_URL,
+                params=launch_params(
+                    profile_id,
+                    self.launch_options if launch_options is None else launch_options
+                )
+            )
+            browser_info = {
+                "selenium_port": data["data"]["selenium_port"],
+                "debug_port": data["data"]["debug_port"]
+            }
+            logging.info(f"Successfully opened browser: {browser_info}")
+            return browser_info
+        except Exception as e:
+            logging.error(f"Error opening browser: {str(e)}")
+            return None
+
+    async def close_browser(self, profile_id):
+        """Close browser for specified profile."""
+        logging.info(f"Closing browser for profile: {profile_id}")
+        try:
+            await self._call(
+                'get',
+                ADSPOWER_CLOSE_URL,
+                params={"user_id": profile_id}
+            )
+            logging.info(f"Successfully closed browser for profile: {profile_id}")
+            return True
+        except Exception as e:
+            logging.error(f"Error closing browser: {str(e)}")
+            return False
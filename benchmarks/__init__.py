@@ -0,0 +1 @@
+"""Offline benchmark harness with local AdsPower, IMAP and WebDriver fakes."""
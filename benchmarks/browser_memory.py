@@ -0,0 +1,136 @@
+"""Memory per browser for the default and lean launch options, against a real AdsPower.
+
+Usage (from the repository root, on the AdsPower host, Linux only):
+
+    python -m benchmarks.browser_memory --browsers 4
+    python -m benchmarks.browser_memory --browsers 4 --lean-browser --headless
+
+Opens up to N registered profiles with the chosen launch options, loads the
+TikTok Ads login page in each, and reports the proportional set size (PSS)
+of every browser's process tree. The local fakes used by run_benchmark have
+no real browser, so this is the number to compare when sizing --workers.
+"""
+import argparse
+import json
+import os
+import time
+
+from ads_power import AdsPowerAPI, browser_launch_options
+from profile_registry import ProfileRegistry
+from tiktok_login import TikTokLogin
+from config import ADSPOWER_API_URL
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Browser memory benchmark")
+    parser.add_argument('--browsers', type=int, default=4, help="Browsers to open at once")
+    parser.add_argument('--adspower-url', default=ADSPOWER_API_URL, help="AdsPower local API URL")
+    parser.add_argument('--lean-browser', action='store_true', help="Use the lean launch options")
+    parser.add_argument('--headless', action='store_true', help="Start browsers headless")
+    parser.add_argument('--settle', type=float, default=10.0, help="Seconds to wait after the page loads")
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    return parser.parse_args(argv)
+
+
+def _children():
+    """Map of pid -> child pids from /proc."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces, ppid follows its closing parenthesis
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    return children
+
+
+def _browser_pid(debug_port):
+    """Pid of the browser process listening on debug_port, or None."""
+    flag = f'--remote-debugging-port={debug_port}'.encode()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/cmdline', 'rb') as f:
+                arguments = f.read().split(b'\0')
+        except OSError:
+            continue
+        if flag in arguments and not any(arg.startswith(b'--type=') for arg in arguments):
+            return int(entry)
+    return None
+
+
+def _pss_kib(pid):
+    """PSS of one process in KiB (falls back to RSS on older kernels)."""
+    for path, field in ((f'/proc/{pid}/smaps_rollup', 'Pss:'), (f'/proc/{pid}/status', 'VmRSS:')):
+        try:
+            with open(path) as f:
+                for line in f:
+                    if line.startswith(field):
+                        return int(line.split()[1])
+        except OSError:
+            continue
+    return 0
+
+
+def tree_memory_mib(pid, children):
+    """Total PSS of pid and its descendants in MiB, with the process count."""
+    total, count, stack = 0, 0, [pid]
+    while stack:
+        current = stack.pop()
+        total += _pss_kib(current)
+        count += 1
+        stack.extend(children.get(current, []))
+    return total / 1024, count
+
+
+def main_benchmark(argv=None):
+    args = parse_args(argv)
+    options = browser_launch_options(args.lean_browser, args.headless)
+    api = AdsPowerAPI(base_url=args.adspower_url, launch_options=options)
+    profiles = ProfileRegistry().load().items()[:args.browsers]
+    if not profiles:
+        print("No registered profiles; run main.py once to create some")
+        return []
+
+    opened, sessions, results = [], [], []
+    try:
+        for email, profile_id in profiles:
+            browser_info = api.open_browser(profile_id)
+            opened.append((profile_id, browser_info))
+            tiktok = TikTokLogin(browser_info['selenium_port'])
+            sessions.append(tiktok)
+            tiktok.check_session()
+        time.sleep(args.settle)
+
+        children = _children()
+        for profile_id, browser_info in opened:
+            pid = _browser_pid(browser_info['debug_port'])
+            if pid is None:
+                print(f"{profile_id}: browser process not found")
+                continue
+            memory, processes = tree_memory_mib(pid, children)
+            results.append({'profile_id': profile_id, 'pss_mib': memory, 'processes': processes})
+            print(f"{profile_id}: {memory:8.1f} MiB in {processes} processes")
+    finally:
+        for tiktok in sessions:
+            tiktok.cleanup()
+        for profile_id, _ in opened:
+            api.close_browser(profile_id)
+
+    if results:
+        average = sum(result['pss_mib'] for result in results) / len(results)
+        print(f"options: {json.dumps(options)}")
+        print(f"average: {average:.1f} MiB per browser over {len(results)} browsers")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'options': options, 'browsers': results}, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,174 @@
+"""Local HTTP stand-in for the AdsPower local API."""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from config import (
+    ADSPOWER_CREATE_PROFILE, ADSPOWER_OPEN_URL, ADSPOWER_CLOSE_URL,
+    ADSPOWER_LIST_PROFILES, ADSPOWER_ACTIVE_URL
+)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+
+        with server.lock:
+            server.requests[parts.path] = server.requests.get(parts.path, 0) + 1
+
+        if parts.path != '/status' and server.throttled():
+            self._reply({"code": -1, "msg": "Too many request per second, please check"})
+            return
+
+        latency = server.latency.get(parts.path, server.default_latency)
+        if latency:
+            time.sleep(random.uniform(0.5 * latency, 1.5 * latency))
+
+        if parts.path != '/status' and random.random() < server.error_rate:
+            with server.lock:
+                server.errors += 1
+            if random.random() < 0.5:
+                self._reply({"code": -1, "msg": "Too many request per second, please check"})
+            else:
+                self._reply({"code": -1, "msg": "internal error"}, status=500)
+            return
+
+        handler = server.routes.get(parts.path)
+        if handler is None:
+            self._reply({"code": -1, "msg": "not found"}, status=404)
+            return
+        self._reply(handler(params, body))
+
+    do_GET = _handle
+    do_POST = _handle
+
+
+class FakeAdsPowerServer(ThreadingHTTPServer):
+    """Serves /status and the profile/browser endpoints used by ads_power.py.
+
+    latency may be a number (seconds, applied to every endpoint) or a dict of
+    path -> seconds; error_rate is the fraction of calls that fail.
+    throttle, if set, is the calls per second above which requests are
+    rejected with AdsPower's "Too many request per second" error.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, selenium_port, latency=0.0, error_rate=0.0, throttle=0.0):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.selenium_port = selenium_port
+        self.default_latency = latency if not isinstance(latency, dict) else 0.0
+        self.latency = latency if isinstance(latency, dict) else {}
+        self.error_rate = error_rate
+        self.throttle = throttle
+        self.throttled_calls = 0
+        self._recent = []  # arrival times within the last second
+        self.lock = threading.Lock()
+        self.profiles = {}  # user_id -> name
+        self.open_browsers = {}  # user_id -> launch params
+        self.launches = []  # launch params of every start call
+        self.peak_open = 0
+        self.requests = {}
+        self.errors = 0
+        self.routes = {
+            '/status': self._status,
+            ADSPOWER_CREATE_PROFILE: self._create_profile,
+            ADSPOWER_LIST_PROFILES: self._list_profiles,
+            ADSPOWER_OPEN_URL: self._open_browser,
+            ADSPOWER_CLOSE_URL: self._close_browser,
+            ADSPOWER_ACTIVE_URL: self._active_browsers,
+        }
+
+    def throttled(self):
+        """Count this call against the throttle; True if it must be rejected."""
+        if not self.throttle:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self._recent = [at for at in self._recent if now - at < 1.0]
+            if len(self._recent) >= self.throttle:
+                self.throttled_calls += 1
+                return True
+            self._recent.append(now)
+            return False
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-adspower", daemon=True).start()
+        return self
+
+    def _status(self, params, body):
+        return {"code": 0, "msg": "success"}
+
+    def _create_profile(self, params, body):
+        with self.lock:
+            user_id = f"j{len(self.profiles) + 1:06d}"
+            self.profiles[user_id] = body.get("name", "")
+        return {"code": 0, "msg": "Success", "data": {"id": user_id}}
+
+    def _list_profiles(self, params, body):
+        page = int(params.get("page", 1))
+        size = int(params.get("page_size", 100))
+        with self.lock:
+            items = [{"user_id": uid, "name": name} for uid, name in self.profiles.items()]
+        chunk = items[(page - 1) * size:page * size]
+        return {"code": 0, "msg": "Success", "data": {"list": chunk, "page": page, "page_size": size}}
+
+    def _open_browser(self, params, body):
+        user_id = params.get("user_id")
+        with self.lock:
+            if user_id not in self.profiles:
+                return {"code": -1, "msg": "Profile does not exist"}
+            self.open_browsers[user_id] = params
+            self.launches.append(params)
+            self.peak_open = max(self.peak_open, len(self.open_browsers))
+        return {
+            "code": 0,
+            "msg": "success",
+            "data": {
+                "ws": {"selenium": f"127.0.0.1:{self.selenium_port}"},
+                "selenium_port": self.selenium_port,
+                "debug_port": self.selenium_port,
+            }
+        }
+
+    def _active_browsers(self, params, body):
+        with self.lock:
+            user_ids = list(self.open_browsers)
+        items = [
+            {
+                "user_id": user_id,
+                "ws": {"selenium": f"127.0.0.1:{self.selenium_port}"},
+                "debug_port": str(self.selenium_port),
+            }
+            for user_id in user_ids
+        ]
+        return {"code": 0, "msg": "success", "data": {"list": items}}
+
+    def _close_browser(self, params, body):
+        with self.lock:
+            self.open_browsers.pop(params.get("user_id"), None)
+        return {"code": 0, "msg": "success"}
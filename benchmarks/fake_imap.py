@@ -0,0 +1,193 @@
+"""Local IMAP server that delivers TikTok verification emails after a delay."""
+import re
+import select
+import socketserver
+import threading
+import time
+from config import VERIFICATION_SENDER
+
+_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+UIDVALIDITY = 1
+
+
+def _message(uid, code):
+    """Build a multipart/alternative verification email; returns (plain, html)."""
+    plain = f"Your TikTok Ads verification code is {code}.\r\n".encode()
+    html = (
+        f"<html><head><style>.c{{color:#000000}}</style></head>"
+        f"<body><p>Your verification code is <b class=\"c\">{code}</b></p></body></html>\r\n"
+    ).encode()
+    return plain, html
+
+
+class Mailbox:
+    """Messages for one user, with a condition variable for IDLE waiters."""
+
+    def __init__(self):
+        self.messages = []  # (uid, sender, plain, html)
+        self.next_uid = 1
+        self.changed = threading.Condition()
+
+    def add(self, sender, code):
+        with self.changed:
+            plain, html = _message(self.next_uid, code)
+            self.messages.append((self.next_uid, sender, plain, html))
+            self.next_uid += 1
+            self.changed.notify_all()
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line if isinstance(line, bytes) else line.encode())
+        self.wfile.flush()
+
+    def handle(self):
+        self.mailbox = None
+        self.known = 0  # message count this session has been told about
+        self.send("* OK [CAPABILITY IMAP4rev1 IDLE UIDPLUS] Fake IMAP ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tokens = [match.group(1) if match.group(1) is not None else match.group(2)
+                      for match in _TOKEN.finditer(line.decode(errors='replace'))]
+            if len(tokens) < 2:
+                continue
+            tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+            self.server.commands += 1
+            if self.server.latency:
+                time.sleep(self.server.latency)
+
+            handler = getattr(self, f"do_{command}", None)
+            if handler is None:
+                self.send(f"{tag} BAD unknown command\r\n")
+            elif handler(tag, args) is False:
+                return
+
+    def do_CAPABILITY(self, tag, args):
+        self.send("* CAPABILITY IMAP4rev1 IDLE UIDPLUS\r\n")
+        self.send(f"{tag} OK CAPABILITY completed\r\n")
+
+    def do_LOGIN(self, tag, args):
+        user, password = args[0], args[1]
+        if password in self.server.rejected_passwords:
+            self.send(f"{tag} NO [AUTHENTICATIONFAILED] Invalid credentials\r\n")
+            return
+        self.mailbox = self.server.mailbox(user)
+        self.send(f"{tag} OK LOGIN completed\r\n")
+
+    def do_NOOP(self, tag, args):
+        self.send(f"{tag} OK NOOP completed\r\n")
+
+    def do_LOGOUT(self, tag, args):
+        self.send("* BYE logging out\r\n")
+        self.send(f"{tag} OK LOGOUT completed\r\n")
+        return False
+
+    def do_SELECT(self, tag, args):
+        with self.mailbox.changed:
+            exists, uidnext = len(self.mailbox.messages), self.mailbox.next_uid
+        self.known = exists
+        self.send(f"* {exists} EXISTS\r\n")
+        self.send(f"* OK [UIDVALIDITY {UIDVALIDITY}] UIDs valid\r\n")
+        self.send(f"* OK [UIDNEXT {uidnext}] Predicted next UID\r\n")
+        self.send(f"{tag} OK [READ-ONLY] SELECT completed\r\n")
+
+    do_EXAMINE = do_SELECT
+
+    def do_UID(self, tag, args):
+        sub = args[0].upper()
+        with self.mailbox.changed:
+            messages = list(self.mailbox.messages)
+
+        if sub == 'SEARCH':
+            criteria = " ".join(args[1:])
+            matches = messages
+            uid_range = re.search(r'UID (\d+):\*', criteria)
+            if uid_range:
+                low = int(uid_range.group(1))
+                # Like real servers, "n:*" always includes the last message
+                matches = [m for m in matches if m[0] >= low] or messages[-1:]
+            sender = re.search(r'FROM (\S+)', criteria)
+            if sender:
+                matches = [m for m in matches if m[1] == sender.group(1).strip('"()')]
+            uids = " ".join(str(m[0]) for m in matches)
+            self.send(f"* SEARCH {uids}\r\n" if uids else "* SEARCH\r\n")
+            self.send(f"{tag} OK SEARCH completed\r\n")
+            return
+
+        if sub == 'FETCH':
+            uid = int(args[1])
+            items = " ".join(args[2:]).upper()
+            message = next((m for m in messages if m[0] == uid), None)
+            if message is not None:
+                _, _, plain, html = message
+                if 'BODYSTRUCTURE' in items:
+                    self.send(
+                        f'* {uid} FETCH (UID {uid} BODYSTRUCTURE ('
+                        f'("text" "plain" ("charset" "utf-8") NIL NIL "7bit" {len(plain)} 1 NIL NIL NIL)'
+                        f'("text" "html" ("charset" "utf-8") NIL NIL "7bit" {len(html)} 1 NIL NIL NIL)'
+                        f' "alternative" ("boundary" "b1") NIL NIL))\r\n'
+                    )
+                else:
+                    section = re.search(r'BODY(?:\.PEEK)?\[(\d+)\]', items)
+                    body = html if section and section.group(1) == '2' else plain
+                    self.server.bytes_sent += len(body)
+                    self.send(f"* {uid} FETCH (UID {uid} BODY[{section.group(1) if section else 1}] {{{len(body)}}}\r\n")
+                    self.send(body + b")\r\n")
+            self.send(f"{tag} OK FETCH completed\r\n")
+            return
+
+        self.send(f"{tag} BAD unsupported UID command\r\n")
+
+    def do_IDLE(self, tag, args):
+        self.send("+ idling\r\n")
+        # Like real servers, mail that arrived since the session last heard
+        # of the mailbox size is reported at once, not only mail during IDLE
+        while True:
+            with self.mailbox.changed:
+                count = len(self.mailbox.messages)
+            if count > self.known:
+                self.known = count
+                self.send(f"* {count} EXISTS\r\n")
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if readable:
+                self.rfile.readline()  # DONE
+                break
+            with self.mailbox.changed:
+                self.mailbox.changed.wait(0.05)
+        self.send(f"{tag} OK IDLE terminated\r\n")
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """Plain-text IMAP server on loopback with one mailbox per login."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, rejected_passwords=()):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.latency = latency
+        self.rejected_passwords = set(rejected_passwords)
+        self.mailboxes = {}
+        self.commands = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def mailbox(self, user):
+        with self._lock:
+            return self.mailboxes.setdefault(user, Mailbox())
+
+    def deliver(self, user, code, delay=0.0, sender=VERIFICATION_SENDER):
+        """Deliver a code email to user's mailbox after delay seconds."""
+        timer = threading.Timer(delay, self.mailbox(user).add, args=(sender, code))
+        timer.daemon = True
+        timer.start()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-imap", daemon=True).start()
+        return self
@@ -0,0 +1,220 @@
+"""Local W3C WebDriver endpoint that simulates the TikTok Ads login page."""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import SELECTORS
+
+ELEMENT_KEY = 'element-6066-11e4-a52e-4f735466cecf'
+
+# Elements present on the simulated page in each state, by SELECTORS name
+PAGE_ELEMENTS = {
+    'blank': set(),
+    'login_form': {'email_input', 'password_input', 'login_button'},
+    'captcha': {'captcha_iframe', 'captcha_verify_button', 'email_input', 'password_input', 'login_button'},
+    'code_entry': {'verification_code_input'},
+    'dashboard': {'dashboard'},
+    'error': {'login_error', 'email_input', 'password_input', 'login_button'},
+}
+XPATH_NAMES = {
+    xpath: name
+    for name, selector in SELECTORS.items()
+    for xpath in ([selector] if isinstance(selector, str) else selector)
+}
+
+
+class FakePage:
+    """State machine for one browser session."""
+
+    def __init__(self, server):
+        self.server = server
+        self.state = 'blank'
+        self.pending = []  # (at, state) transitions scheduled by the simulation
+        self.typed = {}
+        self.code = None
+        self.inspected = False  # the page's window flag set by the inspect script
+
+    def current(self):
+        now = time.monotonic()
+        while self.pending and self.pending[0][0] <= now:
+            self.state = self.pending.pop(0)[1]
+        return self.state
+
+    def has(self, name):
+        return name in PAGE_ELEMENTS[self.current()]
+
+    def navigate(self):
+        time.sleep(self.server.page_load)
+        session_rate = self.server.session_rate
+        self.state = 'dashboard' if session_rate and random.random() < session_rate else 'login_form'
+        self.pending = []
+        self.typed = {}
+        self.inspected = False
+
+    def type(self, name, text):
+        self.typed[name] = self.typed.get(name, '') + text
+        if name == 'verification_code_input' and self.typed[name] == self.code:
+            self.state = 'dashboard'
+
+    def click(self, name):
+        if name != 'login_button' or self.current() != 'login_form':
+            return
+        server = self.server
+        email = self.typed.get('email_input', '')
+        if server.reject_rate and random.random() < server.reject_rate:
+            self.state = 'error'
+            return
+
+        now = time.monotonic()
+        self.code = f"{random.randint(0, 999999):06d}"
+        if server.captcha_rate and random.random() < server.captcha_rate:
+            self.state = 'captcha'
+            self.pending = [(now + server.captcha_time, 'code_entry')]
+        else:
+            self.state = 'code_entry'
+        if server.imap_server is not None:
+            server.imap_server.deliver(email, self.code, server.email_delay)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, value, status=200):
+        body = json.dumps({"value": value}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, error, message, status=404):
+        self._reply({"error": error, "message": message, "stacktrace": ""}, status)
+
+    def _handle(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        with server.lock:
+            server.commands += 1
+        if server.command_latency:
+            time.sleep(server.command_latency)
+
+        if self.path == '/session' and self.command == 'POST':
+            session_id = uuid.uuid4().hex
+            with server.lock:
+                server.sessions[session_id] = FakePage(server)
+            self._reply({"sessionId": session_id, "capabilities": {"browserName": "chrome"}})
+            return
+
+        match = re.match(r'^/session/([^/]+)(/.*)?$', self.path)
+        page = server.sessions.get(match.group(1)) if match else None
+        if page is None:
+            self._error('invalid session id', 'Unknown session')
+            return
+        session_id, route = match.group(1), match.group(2) or ''
+
+        if self.command == 'DELETE' and route == '':
+            with server.lock:
+                server.sessions.pop(session_id, None)
+            self._reply(None)
+        elif route == '/timeouts':
+            self._reply(None)
+        elif route == '/url' and self.command == 'POST':
+            page.navigate()
+            self._reply(None)
+        elif route == '/execute/sync':
+            self._reply(self._execute(page, body.get('args', [])))
+        elif route == '/element':
+            name = XPATH_NAMES.get(body.get('value'))
+            if name is None or not page.has(name):
+                self._error('no such element', f"Unable to locate {body.get('value')}")
+                return
+            self._reply({ELEMENT_KEY: name})
+        elif route.startswith('/element/'):
+            _, _, name, action = route.split('/', 3)
+            if not page.has(name):
+                self._error('stale element reference', f"{name} is no longer attached")
+            elif action == 'value':
+                page.type(name, body.get('text', ''))
+                self._reply(None)
+            elif action == 'click':
+                page.click(name)
+                self._reply(None)
+            elif action == 'clear':
+                page.typed.pop(name, None)
+                self._reply(None)
+            else:
+                self._reply(None)
+        elif route == '/frame':
+            self._reply(None)
+        else:
+            self._error('unknown command', f"{self.command} {route}", status=404)
+
+    def _execute(self, page, args):
+        """Support the inspect script: (checks, lookups) -> [state, elements, fresh]."""
+        if len(args) != 2:
+            return None
+        checks, lookups = args
+
+        def find(xpaths):
+            for xpath in xpaths:
+                name = XPATH_NAMES.get(xpath)
+                if name is not None and page.has(name):
+                    return name
+            return None
+
+        state = next((state for state, xpaths in checks if find(xpaths)), None)
+        elements = {}
+        for name, xpaths in lookups:
+            found = find(xpaths)
+            elements[name] = {ELEMENT_KEY: found} if found else None
+        fresh = not page.inspected
+        page.inspected = True
+        return [state, elements, fresh]
+
+    do_GET = _handle
+    do_POST = _handle
+    do_DELETE = _handle
+
+
+class FakeWebDriverServer(ThreadingHTTPServer):
+    """Remote WebDriver endpoint serving a static login page built from SELECTORS.
+
+    Submitting the form schedules a verification email on imap_server, an
+    optional captcha phase, and moves to the code entry page. session_rate
+    is the fraction of page loads that find a still-valid session and land
+    on the dashboard.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, imap_server=None, page_load=0.0, command_latency=0.0,
+                 email_delay=0.0, captcha_rate=0.0, captcha_time=0.0, reject_rate=0.0,
+                 session_rate=0.0):
+        super().__init__(('127.0.0.1', 0), _Handler)
+        self.imap_server = imap_server
+        self.page_load = page_load
+        self.command_latency = command_latency
+        self.email_delay = email_delay
+        self.captcha_rate = captcha_rate
+        self.captcha_time = captcha_time
+        self.reject_rate = reject_rate
+        self.session_rate = session_rate
+        self.sessions = {}
+        self.commands = 0
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="fake-webdriver", daemon=True).start()
+        return self
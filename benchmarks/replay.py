@@ -0,0 +1,158 @@
+"""Replay recorded cassettes through process_account with no network.
+
+Usage (from the repository root):
+
+    python main.py --record cassettes/                 # against the live services
+    python -m benchmarks.replay cassettes/             # offline, delays removed
+    python -m benchmarks.replay cassettes/ --realtime  # offline, at the recorded speed
+
+Every AdsPower request, WebDriver command and IMAP line is answered from the
+account's cassette, in order; a run that asks for anything else fails that
+account with a ReplayMismatch. Without --realtime the recorded service time
+and the pacing, typing and polling delays are all removed, so the elapsed
+time is the orchestration's own overhead.
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+import cassette
+import email_handler
+import main
+import retry_policy
+import tiktok_login
+from account_state import AccountStateStore
+from ads_power import AdsPowerAPI
+from email_handler import IMAPConnectionManager
+from metrics import run_metrics
+from profile_registry import ProfileRegistry
+from config import ADSPOWER_CREATE_PROFILE, ADSPOWER_RATE_LIMITS
+
+# Never contacted: every request is answered from the cassettes
+REPLAY_URL = "http://adspower.replay.invalid"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay recorded AdsPower, WebDriver and IMAP cassettes")
+    parser.add_argument('directory', help="Directory written by main.py --record")
+    parser.add_argument('--workers', type=int, default=1, help="Accounts replayed at once")
+    parser.add_argument('--realtime', action='store_true',
+                        help="Take as long as the recording for every exchange and keep the configured delays")
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    parser.add_argument('--verbose', action='store_true', help="Show pipeline logging")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return args
+
+
+def remove_delays():
+    """Zero the pacing, typing, retry and polling delays so only orchestration time is left."""
+    main.ACCOUNT_DELAY = 0
+    tiktok_login.TYPING_DELAY_MIN = 0
+    tiktok_login.TYPING_DELAY_MAX = 0
+    tiktok_login.PAGE_STATE_POLL_INTERVAL = 0.001
+    email_handler.EMAIL_CHECK_INTERVAL = 0
+    retry_policy.RETRY_DELAY = 0
+
+
+def recorded_profile(player, account):
+    """Profile the account used when recorded, unless the recording created it."""
+    profile_id = None
+    for event in player.events(account, 'adspower'):
+        if event['op'].endswith(ADSPOWER_CREATE_PROFILE):
+            return None
+        params = event.get('request', {}).get('params') or {}
+        if profile_id is None and 'user_id' in params:
+            profile_id = params['user_id']
+    return profile_id
+
+
+def replay_accounts(player):
+    """Account dicts for the recorded accounts, with stand-in passwords of the recorded length."""
+    return [
+        {
+            'email': account,
+            'email_password': '',
+            'tiktok_password': 'x' * player.meta(account).get('tiktok_password_length', 0),
+        }
+        for account in player.accounts()
+    ]
+
+
+def replay(args):
+    player = cassette.start_replay(args.directory, realtime=args.realtime)
+    accounts = replay_accounts(player)
+    previous_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory(prefix="tiktok-replay-") as workdir:
+            os.chdir(workdir)
+            registry = ProfileRegistry()
+            for account in accounts:
+                profile_id = recorded_profile(player, account['email'])
+                if profile_id:
+                    registry.register(account['email'], profile_id)
+            state = AccountStateStore().load()
+            adspower_api = AdsPowerAPI(
+                base_url=REPLAY_URL, rate_limits=ADSPOWER_RATE_LIMITS if args.realtime else {}
+            )
+            imap_manager = IMAPConnectionManager(max_connections=max(args.workers * 2, 2))
+            start_time = time.perf_counter()
+            try:
+                results = main.run_pool(
+                    args.workers, accounts, main.run_account, adspower_api, registry, state, imap_manager
+                )
+            finally:
+                imap_manager.close_all()
+            elapsed = time.perf_counter() - start_time
+    finally:
+        os.chdir(previous_cwd)
+        cassette.stop()
+
+    summary = run_metrics.summary()
+    return {
+        'accounts': len(results),
+        'succeeded': sum(1 for ok in results.values() if ok),
+        'elapsed': elapsed,
+        'realtime': args.realtime,
+        'mismatches': player.mismatches,
+        'not_replayed': player.remaining(),
+        'stages': {
+            stage: {'p50': data['p50'], 'p95': data['p95'], 'count': data['count']}
+            for stage, data in summary['stages'].items()
+        },
+    }
+
+
+def main_replay(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.CRITICAL,
+        format='%(asctime)s - %(levelname)s - [%(threadName)s] - %(message)s'
+    )
+    if not args.realtime:
+        remove_delays()
+
+    result = replay(args)
+    print(
+        f"Replayed {result['succeeded']}/{result['accounts']} accounts OK in {result['elapsed']:.2f}s "
+        f"({'realtime' if args.realtime else 'delays removed'})"
+    )
+    for stage, data in sorted(result['stages'].items()):
+        print(f"  {stage:<24} p50 {data['p50']:>8.3f}s  p95 {data['p95']:>8.3f}s  n={data['count']}")
+    for mismatch in result['mismatches']:
+        print(f"  mismatch: {mismatch}")
+    for account, count in sorted(result['not_replayed'].items()):
+        print(f"  {account}: {count} recorded exchanges not replayed")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'arguments': vars(args), 'result': result}, f, indent=2)
+    return result
+
+
+if __name__ == "__main__":
+    main_replay()
@@ -0,0 +1,183 @@
+"""End-to-end throughput benchmark against local AdsPower, IMAP and WebDriver fakes.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run_benchmark --accounts 20 --workers 1,2,4,8
+
+Each concurrency level runs main.run() for N accounts in a fresh temporary
+directory and reports accounts/minute, so changes to the orchestration in
+main.py can be checked for regressions without network access. Memory per
+browser needs real browsers; see benchmarks/browser_memory.py.
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+
+import cassette
+import main
+import retry_policy
+import tiktok_login
+from ads_power import AdsPowerAPI, browser_launch_options
+from email_handler import IMAPConnectionManager
+from metrics import run_metrics
+from config import ADSPOWER_RATE_LIMITS
+from benchmarks.fake_adspower import FakeAdsPowerServer
+from benchmarks.fake_imap import FakeIMAPServer
+from benchmarks.fake_webdriver import FakeWebDriverServer
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark")
+    parser.add_argument('--accounts', type=int, default=20, help="Accounts per run")
+    parser.add_argument('--workers', default="1,2,4,8", help="Comma-separated concurrency levels")
+    parser.add_argument('--adspower-latency', type=float, default=0.05, help="Mean AdsPower API latency (s)")
+    parser.add_argument('--adspower-error-rate', type=float, default=0.0, help="Fraction of failing AdsPower calls")
+    parser.add_argument('--adspower-throttle', type=float, default=0.0,
+                        help="Calls per second above which the fake AdsPower rejects requests (0: off)")
+    parser.add_argument('--no-rate-limit', action='store_true', help="Disable the client-side AdsPower rate limiter")
+    parser.add_argument('--page-load', type=float, default=0.3, help="Simulated page load time (s)")
+    parser.add_argument('--command-latency', type=float, default=0.002, help="Per WebDriver command latency (s)")
+    parser.add_argument('--email-delay', type=float, default=1.0, help="Delay before the code email arrives (s)")
+    parser.add_argument('--captcha-rate', type=float, default=0.0, help="Fraction of logins that show a captcha")
+    parser.add_argument('--captcha-time', type=float, default=2.0, help="Time until a captcha clears (s)")
+    parser.add_argument('--pipeline', action='store_true', help="Use the staged pipeline (main.py --pipeline)")
+    parser.add_argument('--prewarm', type=int, default=2, help="Browsers prewarmed ahead of login with --pipeline")
+    parser.add_argument('--captcha-queue', action='store_true', help="Park captchas instead of waiting inline")
+    parser.add_argument('--session-rate', type=float, default=0.0, help="Fraction of profiles with a valid saved session")
+    parser.add_argument('--imap-latency', type=float, default=0.0, help="Per IMAP command latency (s)")
+    parser.add_argument('--retry-delay', type=float, default=0.1, help="RETRY_DELAY used during the benchmark (s)")
+    parser.add_argument('--lean-browser', action='store_true', help="Send the lean launch options to AdsPower")
+    parser.add_argument('--profile', metavar='DIR', help="Profile accounts into DIR/<workers>/ (see main.py --profile)")
+    parser.add_argument('--profile-stages', action='store_true', help="With --profile, one .pstats file per stage")
+    parser.add_argument('--record', metavar='DIR',
+                        help="Record cassettes into DIR/<workers>/ for benchmarks/replay.py")
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    parser.add_argument('--verbose', action='store_true', help="Show pipeline logging")
+    return parser.parse_args(argv)
+
+
+def apply_benchmark_timings(args):
+    """Remove human-pacing delays so the run measures orchestration, not sleeps."""
+    main.ACCOUNT_DELAY = 0
+    tiktok_login.TYPING_DELAY_MIN = 0
+    tiktok_login.TYPING_DELAY_MAX = 0
+    retry_policy.RETRY_DELAY = args.retry_delay
+
+
+def run_level(args, workers):
+    """Run one concurrency level against fresh fakes and return its results."""
+    imap_server = FakeIMAPServer(latency=args.imap_latency).start()
+    webdriver_server = FakeWebDriverServer(
+        imap_server=imap_server,
+        page_load=args.page_load,
+        command_latency=args.command_latency,
+        email_delay=args.email_delay,
+        captcha_rate=args.captcha_rate,
+        captcha_time=args.captcha_time,
+        session_rate=args.session_rate,
+    ).start()
+    adspower_server = FakeAdsPowerServer(
+        webdriver_server.port,
+        latency=args.adspower_latency,
+        error_rate=args.adspower_error_rate,
+        throttle=args.adspower_throttle,
+    ).start()
+
+    previous_cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory(prefix="tiktok-bench-") as workdir:
+            os.chdir(workdir)
+            with open("accounts.txt", "w") as f:
+                for index in range(args.accounts):
+                    f.write(f"bench{index}@example.com mailpass{index} tiktokpass{index}\n")
+
+            run_args = main.parse_args(
+                ["--accounts", "accounts.txt", "--workers", str(workers)]
+                + (["--captcha-queue"] if args.captcha_queue else [])
+                + (["--pipeline", "--prewarm", str(args.prewarm)] if args.pipeline else [])
+                + (["--profile", os.path.join(os.path.abspath(args.profile), str(workers))] if args.profile else [])
+                + (["--profile-stages"] if args.profile_stages else [])
+            )
+            if args.record:
+                cassette.start_recording(os.path.join(os.path.abspath(args.record), str(workers)))
+            adspower_api = AdsPowerAPI(
+                base_url=adspower_server.url,
+                launch_options=browser_launch_options(lean=args.lean_browser),
+                rate_limits={} if args.no_rate_limit else ADSPOWER_RATE_LIMITS
+            )
+            imap_manager = IMAPConnectionManager(
+                '127.0.0.1', imap_server.port, max_connections=max(workers * 2 + (args.prewarm if args.pipeline else 0), 2), use_ssl=False
+            )
+            start_time = time.perf_counter()
+            try:
+                with main.pipeline_profiler(run_args):
+                    results = main.run(run_args, adspower_api, imap_manager)
+            finally:
+                imap_manager.close_all()
+                cassette.stop()
+            elapsed = time.perf_counter() - start_time
+    finally:
+        os.chdir(previous_cwd)
+        for server in (adspower_server, webdriver_server, imap_server):
+            server.shutdown()
+            server.server_close()
+
+    succeeded = sum(1 for ok in results.values() if ok)
+    summary = run_metrics.summary()
+    return {
+        'workers': workers,
+        'accounts': len(results),
+        'succeeded': succeeded,
+        'elapsed': elapsed,
+        'accounts_per_minute': len(results) / elapsed * 60 if elapsed > 0 else 0.0,
+        'adspower_requests': dict(adspower_server.requests),
+        'adspower_errors': adspower_server.errors,
+        'adspower_throttled': adspower_server.throttled_calls,
+        'peak_open_browsers': adspower_server.peak_open,
+        'browsers_left_open': len(adspower_server.open_browsers),
+        'webdriver_commands': webdriver_server.commands,
+        'imap_commands': imap_server.commands,
+        'imap_body_bytes': imap_server.bytes_sent,
+        'stages': {
+            stage: {'p50': data['p50'], 'p95': data['p95'], 'count': data['count']}
+            for stage, data in summary['stages'].items()
+        },
+    }
+
+
+def main_benchmark(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.CRITICAL,
+        format='%(asctime)s - %(levelname)s - [%(threadName)s] - %(message)s'
+    )
+    apply_benchmark_timings(args)
+
+    levels = [int(level) for level in args.workers.split(',') if level.strip()]
+    results = []
+    print(
+        f"{'workers':>7} {'ok':>9} {'elapsed':>9} {'acc/min':>9} {'wd cmds':>8} {'imap cmds':>9} "
+        f"{'p50 account':>12} {'throttled':>9} {'left open':>9}"
+    )
+    for workers in levels:
+        result = run_level(args, workers)
+        results.append(result)
+        account_p50 = result['stages'].get('account', {}).get('p50', 0.0)
+        print(
+            f"{workers:>7} {result['succeeded']:>4}/{result['accounts']:<4} {result['elapsed']:>8.1f}s "
+            f"{result['accounts_per_minute']:>9.1f} {result['webdriver_commands']:>8} "
+            f"{result['imap_commands']:>9} {account_p50:>11.2f}s {result['adspower_throttled']:>9} "
+            f"{result['browsers_left_open']:>9}"
+        )
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'arguments': vars(args), 'results': results}, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main_benchmark()
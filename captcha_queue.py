@@ -0,0 +1,164 @@
+"""Operator queue for accounts parked on a manual captcha, with a local listing page."""
+import html
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tiktok_login import CAPTCHA
+from metrics import run_metrics
+from teardown import shutdown_requested
+from config import MANUAL_CAPTCHA_TIMEOUT, CAPTCHA_MAX_PARKED, CAPTCHA_POLL_INTERVAL
+
+
+class ParkedAccount:
+    """An account whose browser is left open on a captcha for an operator."""
+
+    def __init__(self, email, profile_id, tiktok, resume, on_timeout):
+        self.email = email
+        self.profile_id = profile_id
+        self.tiktok = tiktok
+        self.resume = resume
+        self.on_timeout = on_timeout
+        self.parked_at = time.time()
+        self.future = Future()
+
+    @property
+    def waiting(self):
+        return time.time() - self.parked_at
+
+
+class CaptchaQueue:
+    """Parks captcha-blocked accounts so workers can move on.
+
+    A watcher thread checks each parked browser's page state; once the
+    captcha is gone the account's resume callable is submitted to the worker
+    pool, and after `timeout` the account is given up with on_timeout().
+    park() returns a Future for the account's final result.
+    """
+
+    def __init__(self, max_parked=CAPTCHA_MAX_PARKED, timeout=MANUAL_CAPTCHA_TIMEOUT,
+                 poll_interval=CAPTCHA_POLL_INTERVAL, listing_port=None):
+        self.max_parked = max_parked
+        self.listing_port = listing_port
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._parked = []
+        self._lock = threading.Lock()
+        self._submit = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def start(self, submit):
+        """Start watching; resumed accounts are run with submit(callable)."""
+        self._submit = submit
+        self._thread = threading.Thread(target=self._watch, name="captcha-watch", daemon=True)
+        self._thread.start()
+        if self.listing_port is not None:
+            self._serve(self.listing_port)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def park(self, email, profile_id, tiktok, resume, on_timeout):
+        """Park an account; returns its result Future, or None if the queue is full."""
+        with self._lock:
+            if len(self._parked) >= self.max_parked:
+                return None
+            entry = ParkedAccount(email, profile_id, tiktok, resume, on_timeout)
+            self._parked.append(entry)
+            waiting = len(self._parked)
+        logging.warning(
+            f"CAPTCHA waiting for an operator: {email} (profile {profile_id}); "
+            f"{waiting} account(s) parked"
+        )
+        return entry.future
+
+    def waiting(self):
+        """Snapshot of the parked accounts, oldest first."""
+        with self._lock:
+            return list(self._parked)
+
+    def _remove(self, entry):
+        with self._lock:
+            self._parked.remove(entry)
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            for entry in self.waiting():
+                if shutdown_requested():
+                    self._remove(entry)
+                    entry.future.set_result(False)
+                elif entry.tiktok.detect_state() != CAPTCHA:
+                    self._remove(entry)
+                    run_metrics.record('captcha_wait', entry.waiting, 'ok', account=entry.email)
+                    logging.info(f"CAPTCHA cleared for {entry.email} after {entry.waiting:.0f}s, resuming")
+                    self._resume(entry)
+                elif entry.waiting > self.timeout:
+                    self._remove(entry)
+                    logging.error(f"CAPTCHA for {entry.email} not solved within {self.timeout}s")
+                    run_metrics.record('captcha_wait', entry.waiting, 'failed', account=entry.email)
+                    self._give_up(entry)
+
+    def _resume(self, entry):
+        def relay(future):
+            if future.exception() is not None:
+                entry.future.set_exception(future.exception())
+            else:
+                entry.future.set_result(future.result())
+        try:
+            self._submit(entry.resume).add_done_callback(relay)
+        except RuntimeError as e:
+            # The pool is shutting down
+            logging.error(f"Cannot resume {entry.email}: {str(e)}")
+            self._give_up(entry)
+
+    def _give_up(self, entry):
+        try:
+            entry.on_timeout()
+        except Exception as e:
+            logging.error(f"Error giving up parked account {entry.email}: {str(e)}")
+        entry.future.set_result(False)
+
+    def render(self):
+        """Plain-text listing of the parked accounts."""
+        entries = self.waiting()
+        lines = [f"{len(entries)} account(s) waiting for a captcha to be solved"]
+        for entry in entries:
+            remaining = max(0, self.timeout - entry.waiting)
+            lines.append(
+                f"{entry.email}\tprofile {entry.profile_id}\t"
+                f"waiting {entry.waiting:.0f}s\tgives up in {remaining:.0f}s"
+            )
+        return "\n".join(lines) + "\n"
+
+    def _serve(self, port):
+        queue = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                body = (
+                    "<html><head><meta http-equiv='refresh' content='5'></head><body><pre>"
+                    + html.escape(queue.render())
+                    + "</pre></body></html>"
+                ).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="captcha-listing", daemon=True).start()
+        logging.info(f"Parked captchas listed at http://127.0.0.1:{self._server.server_address[1]}/")
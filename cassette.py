@@ -0,0 +1,238 @@
+"""Record AdsPower, WebDriver and IMAP traffic into per-account cassettes, and replay it offline.
+
+Besides the three services, a clock channel holds the outcome of every
+timeout check made through expired(), so waits end where they did.
+"""
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from log_context import current_log_context
+from retry_policy import FatalError, RetryableError, WEBDRIVER_FATAL_ERRORS
+
+# Cassette of the exchanges made outside any account (status check, reconcile, ...)
+RUN_CASSETTE = '_run'
+
+
+class ReplayMismatch(FatalError):
+    """The replayed run asked for an exchange the recording does not have next."""
+
+
+def current_account():
+    """Account whose cassette the current thread records into or replays from."""
+    return current_log_context().get('account') or RUN_CASSETTE
+
+
+def cassette_path(directory, account):
+    return os.path.join(directory, re.sub(r'[^\w@.-]', '_', account) + '.json.gz')
+
+
+class CassetteRecorder:
+    """Collects exchanges per account and channel; save() writes one gzipped JSON file per account.
+
+    Every event carries its op name, its duration and its offset t from the
+    start of the recording, both in seconds.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.started = time.monotonic()
+        self._cassettes = {}  # account -> {'meta': {...}, 'channels': {channel: [events]}}
+        self._lock = threading.Lock()
+
+    def _cassette(self, account):
+        return self._cassettes.setdefault(account, {'meta': {}, 'channels': {}})
+
+    def record(self, channel, event, account=None, started=None):
+        """Append event to the account's channel; started is its time.monotonic() start."""
+        started = time.monotonic() if started is None else started
+        event['t'] = round(started - self.started, 4)
+        with self._lock:
+            self._cassette(account or current_account())['channels'].setdefault(channel, []).append(event)
+
+    def describe(self, account, **fields):
+        """Attach metadata (e.g. what replay needs to drive the same calls) to an account's cassette."""
+        with self._lock:
+            self._cassette(account)['meta'].update(fields)
+
+    def save(self):
+        """Write the cassettes; returns the paths written."""
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            cassettes = dict(self._cassettes)
+        paths = []
+        for account, cassette in cassettes.items():
+            path = cassette_path(self.directory, account)
+            try:
+                data = json.dumps({'account': account, **cassette}, separators=(',', ':'))
+                with gzip.open(path, 'wt', encoding='utf-8') as f:
+                    f.write(data)
+                paths.append(path)
+            except (OSError, TypeError, ValueError) as e:
+                logging.error(f"Failed to write cassette {path}: {str(e)}")
+        logging.info(f"Recorded {len(paths)} cassettes into {self.directory}")
+        return paths
+
+
+class CassettePlayer:
+    """Hands out recorded exchanges in order, per account and channel.
+
+    With realtime, each exchange takes as long as it did when recorded;
+    otherwise it returns at once.
+    """
+
+    def __init__(self, directory, realtime=False):
+        self.directory = directory
+        self.realtime = realtime
+        self.mismatches = []
+        self._cassettes = {}  # account -> {'meta': {...}, 'channels': {channel: deque of events}}
+        self._lock = threading.Lock()
+        for path in sorted(glob.glob(os.path.join(directory, '*.json.gz'))):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+            self._cassettes[data['account']] = {
+                'meta': data.get('meta', {}),
+                'channels': {channel: deque(events) for channel, events in data['channels'].items()},
+            }
+        logging.info(f"Loaded {len(self._cassettes)} cassettes from {directory}")
+
+    def accounts(self):
+        """Recorded accounts, without the run-level cassette."""
+        return sorted(account for account in self._cassettes if account != RUN_CASSETTE)
+
+    def meta(self, account):
+        return dict(self._cassettes.get(account, {}).get('meta', {}))
+
+    def events(self, account, channel):
+        """Snapshot of the exchanges not yet replayed."""
+        with self._lock:
+            return list(self._cassettes.get(account, {}).get('channels', {}).get(channel, ()))
+
+    def remaining(self):
+        """{account: exchanges not replayed} for accounts that stopped short of their recording."""
+        with self._lock:
+            counts = {
+                account: sum(len(events) for events in cassette['channels'].values())
+                for account, cassette in self._cassettes.items() if account != RUN_CASSETTE
+            }
+        return {account: count for account, count in counts.items() if count}
+
+    def next(self, channel, op, account=None):
+        """Pop the account's next exchange on channel, which must be op; raises ReplayMismatch."""
+        account = account or current_account()
+        with self._lock:
+            events = self._cassettes.get(account, {}).get('channels', {}).get(channel)
+            event = events[0] if events else None
+            if event is None:
+                message = f"{account}: no recorded {channel} exchange left for {op}"
+            elif event['op'] != op:
+                # Left in place, so what follows is still reported against the recording
+                message = f"{account}: recorded {channel} {event['op']}, replay asked for {op}"
+            else:
+                message = None
+                events.popleft()
+            if message:
+                self.mismatches.append(message)
+        if message:
+            raise ReplayMismatch(message)
+        if self.realtime and event.get('duration'):
+            time.sleep(event['duration'])
+        return event
+
+
+_active = None
+
+
+def start_recording(directory):
+    global _active
+    _active = CassetteRecorder(directory)
+    logging.info(f"Recording AdsPower, WebDriver and IMAP traffic into {directory}")
+    return _active
+
+
+def start_replay(directory, realtime=False):
+    global _active
+    _active = CassettePlayer(directory, realtime)
+    return _active
+
+
+def stop():
+    """Stop recording or replaying; a recording is saved."""
+    global _active
+    active, _active = _active, None
+    if isinstance(active, CassetteRecorder):
+        active.save()
+
+
+def active():
+    return _active is not None
+
+
+def recorder():
+    return _active if isinstance(_active, CassetteRecorder) else None
+
+
+def player():
+    return _active if isinstance(_active, CassettePlayer) else None
+
+
+def describe(account, **fields):
+    """Attach metadata to an account's cassette while recording; no-op otherwise."""
+    active = recorder()
+    if active is not None:
+        active.describe(account, **fields)
+
+
+def expired(wait, check):
+    """Whether the wait named wait has run out: check() when live, the recorded answer on replay.
+
+    Waits measure wall-clock time, which a replay without delays runs
+    through far faster; recording each give-up check makes the replay stop
+    polling on the same round as the recorded run.
+    """
+    return exchange('clock', wait, check)
+
+
+def replayed_error(error):
+    """Rebuild a recorded exception with the same retry classification."""
+    if error['type'] in ('FatalError', 'ReplayMismatch') or error['type'] in WEBDRIVER_FATAL_ERRORS:
+        return FatalError(error['message'])
+    return RetryableError(error['message'])
+
+
+def exchange(channel, op, call, request=None, account=None):
+    """Return call(), recording it under op, or the recorded result when replaying.
+
+    The result must be JSON-serializable. A recorded exception is raised
+    again on replay as a RetryableError or FatalError, as classified when it
+    was recorded. request is stored alongside for reference only.
+    """
+    active = _active
+    if active is None:
+        return call()
+    if isinstance(active, CassettePlayer):
+        event = active.next(channel, op, account)
+        if 'error' in event:
+            raise replayed_error(event['error'])
+        return event['result']
+
+    event = {'op': op}
+    if request is not None:
+        event['request'] = request
+    started = time.monotonic()
+    try:
+        result = call()
+        # Snapshot now: callers may modify the result (WebDriver unwraps elements in place)
+        event['result'] = json.loads(json.dumps(result))
+        return result
+    except Exception as e:
+        event['error'] = {'type': type(e).__name__, 'message': str(e)}
+        raise
+    finally:
+        event['duration'] = round(time.monotonic() - started, 4)
+        active.record(channel, event, account, started)
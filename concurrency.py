@@ -0,0 +1,145 @@
+"""AIMD concurrency limit driven by host headroom, AdsPower errors and stage latency."""
+import logging
+import math
+import os
+import threading
+import time
+from metrics import run_metrics
+from config import (
+    CONCURRENCY_MIN, CONCURRENCY_MAX, CONCURRENCY_INTERVAL, CONCURRENCY_LOAD_MAX,
+    CONCURRENCY_MEM_MIN, CONCURRENCY_ERROR_MAX, CONCURRENCY_LATENCY_FACTOR,
+    CONCURRENCY_DECREASE
+)
+
+# Stages whose failures and retries count as AdsPower errors
+ADSPOWER_STAGES = ('open_browser', 'create_profile')
+# Stage whose latency shows AdsPower/host saturation
+LATENCY_STAGE = 'open_browser'
+
+
+def load_per_cpu():
+    """1-minute load average divided by the CPU count, or None if unavailable."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+
+def available_memory_fraction():
+    """MemAvailable / MemTotal from /proc/meminfo, or None if unavailable."""
+    try:
+        values = {}
+        with open('/proc/meminfo') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                values[name] = int(value.split()[0])
+        return values['MemAvailable'] / values['MemTotal']
+    except (OSError, KeyError, ValueError, ZeroDivisionError):
+        return None
+
+
+class AdaptiveLimiter:
+    """Limit on in-flight accounts, adjusted by additive increase/multiplicative decrease.
+
+    Every interval the limit is halved (down to floor) if the host is short
+    of CPU or memory, AdsPower calls fail or get retried too often, or
+    open_browser slows down. Otherwise, if the limit was actually reached
+    during the interval, it is raised by one (up to ceiling).
+    """
+
+    def __init__(self, initial, floor=CONCURRENCY_MIN, ceiling=CONCURRENCY_MAX,
+                 interval=CONCURRENCY_INTERVAL, metrics=run_metrics):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.limit = min(self.ceiling, max(self.floor, initial))
+        self.interval = interval
+        self.metrics = metrics
+        self.in_flight = 0
+        self._saturated = False  # limit reached since the last adjustment
+        self._best_latency = None
+        self._window_start = time.time()
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="concurrency", daemon=True)
+
+    def start(self):
+        logging.info(f"Adaptive concurrency: limit {self.limit} (floor {self.floor}, ceiling {self.ceiling})")
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def acquire(self):
+        """Block until an account may start."""
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._saturated = True
+                self._condition.wait()
+            self.in_flight += 1
+            if self.in_flight >= self.limit:
+                self._saturated = True
+
+    def release(self, *_):
+        """Mark an account finished; usable as a Future done-callback."""
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.adjust()
+            except Exception as e:
+                logging.error(f"Concurrency adjustment failed: {str(e)}")
+
+    def pressure(self, records):
+        """Return the reasons to back off given the records of the last window."""
+        reasons = []
+        load = load_per_cpu()
+        if load is not None and load > CONCURRENCY_LOAD_MAX:
+            reasons.append(f"load {load:.2f}/cpu")
+        memory = available_memory_fraction()
+        if memory is not None and memory < CONCURRENCY_MEM_MIN:
+            reasons.append(f"memory {memory:.0%} available")
+
+        calls = [record for record in records if record['stage'] in ADSPOWER_STAGES]
+        if calls:
+            errors = sum(1 for record in calls if record['outcome'] != 'ok' or record['retries'])
+            if errors / len(calls) > CONCURRENCY_ERROR_MAX:
+                reasons.append(f"AdsPower errors {errors}/{len(calls)}")
+
+        durations = sorted(record['duration'] for record in records if record['stage'] == LATENCY_STAGE)
+        if len(durations) >= 2:
+            median = durations[len(durations) // 2]
+            if self._best_latency is None or median < self._best_latency:
+                self._best_latency = median
+            elif median > self._best_latency * CONCURRENCY_LATENCY_FACTOR:
+                reasons.append(f"{LATENCY_STAGE} p50 {median:.1f}s vs best {self._best_latency:.1f}s")
+        return reasons
+
+    def adjust(self):
+        """Apply one AIMD step from the records of the last interval."""
+        now = time.time()
+        records = self.metrics.since(self._window_start)
+        self._window_start = now
+        reasons = self.pressure(records)
+
+        with self._condition:
+            previous = self.limit
+            if reasons:
+                self.limit = max(self.floor, math.floor(self.limit * CONCURRENCY_DECREASE))
+                decision = f"{'decrease' if self.limit < previous else 'hold at floor'} ({'; '.join(reasons)})"
+            elif self._saturated and self.limit < self.ceiling:
+                self.limit += 1
+                decision = "increase (limit reached, no pressure)"
+            else:
+                decision = "hold"
+            self._saturated = self.in_flight >= self.limit
+            self._condition.notify_all()
+        logging.info(
+            f"Concurrency {decision}: {previous} -> {self.limit} "
+            f"(in flight {self.in_flight}, {len(records)} stage records)"
+        )
+        return self.limit
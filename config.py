@@ -9,41 +9,122 @@ CLI_CREDENTIAL = "f96e3db4f589b15d0b7f37ed4a884aec"
 ADSPOWER_CREATE_PROFILE = "/api/v1/profile/create"
 ADSPOWER_OPEN_URL = "/api/v1/browser/start"
 ADSPOWER_CLOSE_URL = "/api/v1/browser/stop"
+ADSPOWER_ACTIVE_URL = "/api/v1/browser/local-active"  # Browsers currently open on this host
+ADSPOWER_LIST_PROFILES = "/api/v1/user/list"
+ADSPOWER_LIST_PAGE_SIZE = 100  # Maximum page size accepted by the list endpoint
 ADSPOWER_TIMEOUT = 10  # Timeout for AdsPower API requests
+# Calls per second and burst size; '*' limits all calls together. AdsPower
+# throttles at 2 req/s for small accounts (5-10 req/s with more profiles)
+ADSPOWER_RATE_LIMITS = {
+    '*': (2.0, 2),
+    ADSPOWER_CREATE_PROFILE: (1.0, 1),
+    ADSPOWER_OPEN_URL: (1.0, 2),
+}
+ADSPOWER_POOL_SIZE = 10  # Keep-alive connections held by the async client
+ADSPOWER_HEALTH_TTL = 15  # Seconds a successful/failed health check is cached
+ADSPOWER_BREAKER_THRESHOLD = 5  # Consecutive failures before the circuit opens
+ADSPOWER_BREAKER_COOLDOWN = 30  # Seconds the circuit stays open before a trial call
+
+# Browser launch options sent with ADSPOWER_OPEN_URL (see AdsPowerAPI.open_browser)
+BROWSER_LAUNCH_OPTIONS = {}  # Default: the profile's own settings, full UI
+LEAN_BROWSER_OPTIONS = {
+    'open_tabs': 1,  # Don't restore the platform and previously opened tabs
+    'ip_tab': 0,  # Skip the IP check tab
+    'launch_args': [
+        '--blink-settings=imagesEnabled=false',
+        '--disk-cache-size=33554432',  # 32 MB
+        '--media-cache-size=8388608',  # 8 MB
+        '--disable-extensions',
+        '--disable-background-networking',
+        '--renderer-process-limit=2',
+    ],
+}
+# Headless cannot show a captcha for manual solving, so it is a separate option
+HEADLESS_BROWSER_OPTIONS = {'headless': 1}
 
 # TikTok URLs
 TIKTOK_ADS_URL = "https://ads.tiktok.com/i18n/login"
 
 # Timeouts and delays (in seconds)
 PAGE_LOAD_TIMEOUT = 30
-IMPLICIT_WAIT = 10
+PAGE_STATE_TIMEOUT = 20  # Max wait for the page to reach an expected state
+PAGE_STATE_POLL_INTERVAL = 0.5  # Seconds between page state checks
+SESSION_CHECK_TIMEOUT = 8  # Max wait for a saved session to show the dashboard
 TYPING_DELAY_MIN = 0.1
 TYPING_DELAY_MAX = 0.3
-ACTION_DELAY = 2
-RETRY_DELAY = 5
-MAX_RETRIES = 3
+RETRY_DELAY = 5  # Base delay of the jittered exponential backoff
+RETRY_MAX_DELAY = 30  # Cap on a single backoff delay
+MAX_RETRIES = 3  # Attempts per operation, shared by every layer
+ACCOUNT_DEADLINE = 900  # Seconds an account may spend before retries stop
 MANUAL_CAPTCHA_TIMEOUT = 300  # 5 minutes timeout for manual CAPTCHA resolution
+CAPTCHA_MAX_PARKED = 5  # Browsers kept open on a captcha with --captcha-queue, beyond --workers
+CAPTCHA_POLL_INTERVAL = 2  # Seconds between checks of the parked browsers
+CAPTCHA_LIST_PORT = None  # e.g. 8765 to list parked captchas in a local web page
+ACCOUNT_DELAY = 5  # Delay between accounts handled by the same worker
+
+# Concurrency
+MAX_WORKERS = 1  # Keep at or below the number of browsers AdsPower can hold open
+SHUTDOWN_DEADLINE = 20  # Seconds allowed to close in-flight sessions on SIGINT/SIGTERM
+TEARDOWN_WORKERS = 8  # Leaked browsers closed at once during startup reclamation
+
+# Staged pipeline (--pipeline)
+PIPELINE_PREWARM = 2  # Browsers opened and attached ahead of the login workers
+
+# Adaptive concurrency (--adaptive): AIMD between the floor and ceiling
+CONCURRENCY_MIN = 1  # Floor of in-flight accounts
+CONCURRENCY_MAX = 8  # Ceiling of in-flight accounts (and threads started)
+CONCURRENCY_INTERVAL = 30  # Seconds between adjustments
+CONCURRENCY_LOAD_MAX = 0.85  # 1-minute load average per CPU above which to back off
+CONCURRENCY_MEM_MIN = 0.15  # Fraction of RAM that must stay available
+CONCURRENCY_ERROR_MAX = 0.2  # Share of AdsPower calls failing or retried before backing off
+CONCURRENCY_LATENCY_FACTOR = 2.0  # Back off when open_browser p50 exceeds the best seen by this factor
+CONCURRENCY_DECREASE = 0.5  # Multiplier applied to the limit on back-off
+
+# Multi-host work queue (--queue)
+QUEUE_LEASE_SECONDS = 180  # A lease not renewed for this long is handed to another worker
+QUEUE_HEARTBEAT_INTERVAL = 30  # Seconds between lease renewals
+QUEUE_POLL_INTERVAL = 5  # Wait before asking again while other workers hold the last leases
+QUEUE_MAX_ATTEMPTS = 3  # Leases per account before it is left failed
 
-# Selectors for TikTok Ads page
+# Selectors for TikTok Ads page; an entry may list fallback XPaths, tried in order
 SELECTORS = {
-    'email_input': '//input[@name="email"]',
-    'password_input': '//input[@name="password"]',
-    'login_button': '//button[@type="submit"]',
+    'email_input': ['//input[@name="email"]', '//input[@type="email"]'],
+    'password_input': ['//input[@name="password"]', '//input[@type="password"]'],
+    'login_button': ['//button[@type="submit"]', '//button[contains(@class, "login")]'],
     'captcha_iframe': '//iframe[contains(@src, "captcha")]',
-    'verification_code_input': '//input[@placeholder="Enter 6-digit code"]',
-    'captcha_verify_button': '//button[contains(@class, "verify")]'
+    'verification_code_input': [
+        '//input[@placeholder="Enter 6-digit code"]',
+        '//input[@autocomplete="one-time-code"]'
+    ],
+    'captcha_verify_button': '//button[contains(@class, "verify")]',
+    # Only with text: empty alert live regions sit on pages without any error
+    'login_error': '//*[(@role="alert" or contains(@class, "error-message")) and normalize-space()]',
+    'dashboard': '//*[contains(@class, "account-info") or contains(@class, "dashboard")]'
 }
 
 # Email (IMAP) settings
 IMAP_SERVER = "outlook.office365.com"
 IMAP_PORT = 993
+IMAP_TIMEOUT = 30  # Socket timeout for IMAP connections and commands
 EMAIL_SEARCH_TIMEOUT = 60
-EMAIL_CHECK_INTERVAL = 5
+VERIFICATION_SENDER = "noreply@ads.tiktok.com"
+EMAIL_CHECK_INTERVAL = 5  # Polling interval when the server has no IDLE support
+EMAIL_USE_IDLE = True  # Wait for new mail with IMAP IDLE instead of polling
+IMAP_MAX_CONNECTIONS = 10  # Concurrent sessions held open per IMAP server
 
 # Logging configuration
-LOG_FORMAT = '%(asctime)s - %(levelname)s - [%(filename)s:%(lineno)d] - %(message)s'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - [%(threadName)s] [%(account)s] [%(filename)s:%(lineno)d] - %(message)s'
 LOG_FILE = 'tiktok_login.log'
 LOG_LEVEL = 'DEBUG'  # Changed to DEBUG for more detailed logging
+LOG_STRUCTURED = False  # Write JSONL records to LOG_JSON_FILE instead of text
+LOG_JSON_FILE = 'tiktok_login.jsonl'
+LOG_PAYLOADS = False  # Dump AdsPower request/response bodies at DEBUG level
 
 # Output files
+METRICS_JSON_FILE = None  # e.g. 'metrics.json'; per-stage timings written at the end of a run
+METRICS_PROM_FILE = None  # e.g. a node_exporter textfile collector path ending in .prom
+PROFILE_SAMPLE_INTERVAL = 0.01  # Seconds between stack samples with --profile
 PROFILE_IDS_FILE = 'profile_ids.txt'
+PROFILE_NAME_PREFIX = 'TikTok_'
+STATE_FILE = 'account_state.jsonl'  # Append-only journal of per-account stage progress
+PROFILE_CREATE_WORKERS = 4  # Concurrent create_profile calls during the bulk pre-pass
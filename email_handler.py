@@ -1,68 +1,569 @@
 """Email verification handler using IMAP for Outlook."""
+import base64
+import html
 import imaplib
-import email
+import io
+import quopri
+import re
+import socket
+import threading
 import time
 import logging
+from collections import OrderedDict, deque
+from itertools import takewhile
+from metrics import run_metrics
+from log_context import log_context, current_log_context
+from retry_policy import FatalError
+import cassette
 from config import (
     IMAP_SERVER, IMAP_PORT, EMAIL_SEARCH_TIMEOUT,
-    EMAIL_CHECK_INTERVAL
+    EMAIL_CHECK_INTERVAL, EMAIL_USE_IDLE, IMAP_MAX_CONNECTIONS,
+    IMAP_TIMEOUT, VERIFICATION_SENDER
 )
 
+CODE_PATTERN = re.compile(r'\b\d{6}\b')
+_SEXP_TOKEN = re.compile(rb'\(|\)|"((?:[^"\\]|\\.)*)"|([^\s()"]+)')
+_HTML_HIDDEN = re.compile(r'<(style|script)\b.*?</\1\s*>', re.S | re.I)
+_HTML_TAG = re.compile(r'<[^>]+>')
+# Stands in for the tag prefix of recorded lines, which is random per connection
+_TAG_PLACEHOLDER = b'{tag}'
+
+
+def _flatten_fetch(data):
+    """Join an imaplib FETCH response, inlining literals as quoted strings."""
+    chunks = []
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            prefix = re.sub(rb'\{\d+\}$', b'', prefix)
+            escaped = literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+            chunks.append(prefix + b'"' + escaped + b'"')
+        elif item:
+            chunks.append(item)
+    return b''.join(chunks)
+
+
+def _parse_sexp(data):
+    """Parse an IMAP parenthesized list into nested Python lists; NIL becomes None."""
+    stack = [[]]
+    for match in _SEXP_TOKEN.finditer(data):
+        token = match.group(0)
+        if token == b'(':
+            stack.append([])
+        elif token == b')':
+            if len(stack) > 1:
+                inner = stack.pop()
+                stack[-1].append(inner)
+        elif match.group(1) is not None:
+            stack[-1].append(re.sub(rb'\\(.)', rb'\1', match.group(1)).decode(errors='replace'))
+        else:
+            atom = match.group(2).decode(errors='replace')
+            stack[-1].append(None if atom.upper() == 'NIL' else atom)
+    return stack[0]
+
+
+def _find_item(node, name):
+    """Return the value following a FETCH item name anywhere in a parsed response."""
+    for index, value in enumerate(node):
+        if isinstance(value, str) and value.upper() == name and index + 1 < len(node):
+            return node[index + 1]
+        if isinstance(value, list):
+            found = _find_item(value, name)
+            if found is not None:
+                return found
+    return None
+
+
+def _text_parts(node, section=''):
+    """Yield (section, subtype, encoding, charset) for text/plain and text/html parts."""
+    if not isinstance(node, list) or not node:
+        return
+    if isinstance(node[0], list):
+        children = takewhile(lambda child: isinstance(child, list), node)
+        for index, child in enumerate(children, 1):
+            yield from _text_parts(child, f"{section}.{index}" if section else str(index))
+        return
+    if len(node) < 6 or (node[0] or '').lower() != 'text':
+        return
+    subtype = (node[1] or '').lower()
+    if subtype not in ('plain', 'html'):
+        return
+    params = node[2] if isinstance(node[2], list) else []
+    charset = dict(zip((key.lower() for key in params[::2]), params[1::2])).get('charset')
+    yield section or '1', subtype, (node[5] or '7bit').lower(), charset
+
+
+def _decode_part(raw, encoding, charset):
+    """Undo the transfer encoding of a body part and decode it to text."""
+    if encoding == 'base64':
+        raw = base64.b64decode(raw)
+    elif encoding == 'quoted-printable':
+        raw = quopri.decodestring(raw)
+    try:
+        return raw.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+
+def _html_to_text(content):
+    """Reduce an HTML body to its visible text."""
+    return html.unescape(_HTML_TAG.sub(' ', _HTML_HIDDEN.sub(' ', content)))
+
+
+class MailboxScanner:
+    """Incremental UID scanner that finds verification codes without marking mail seen.
+
+    snapshot() records the highest UID present before the login is submitted;
+    scan() then only looks at newer UIDs from the sender and fetches just the
+    text part it needs with BODY.PEEK, so retries see the same message again.
+    """
+
+    def __init__(self, imap, sender=VERIFICATION_SENDER, mailbox='INBOX'):
+        self.imap = imap
+        self.sender = sender
+        self.mailbox = mailbox
+        self.uidvalidity = None
+        self.baseline = None  # Highest UID present when the login was submitted
+        self.highest_scanned = None  # Highest UID already examined without a code
+
+    def select(self):
+        """Open the mailbox read-only and return UIDNEXT, resetting on a UIDVALIDITY change."""
+        typ, data = self.imap.select(self.mailbox, readonly=True)
+        if typ != 'OK':
+            raise self.imap.error(f"Failed to select {self.mailbox}: {data}")
+
+        _, validity = self.imap.response('UIDVALIDITY')
+        _, uidnext = self.imap.response('UIDNEXT')
+        validity = int(validity[0]) if validity and validity[0] else None
+        if self.uidvalidity is not None and validity != self.uidvalidity:
+            logging.warning(f"UIDVALIDITY of {self.mailbox} changed, rescanning unseen mail")
+            self.baseline = None
+            self.highest_scanned = None
+        self.uidvalidity = validity
+        return int(uidnext[0]) if uidnext and uidnext[0] else None
+
+    def snapshot(self):
+        """Remember the highest UID currently in the mailbox."""
+        uidnext = self.select()
+        if uidnext is None:
+            _, data = self.imap.uid('search', None, 'ALL')
+            uids = data[0].split() if data and data[0] else []
+            uidnext = int(uids[-1]) + 1 if uids else 1
+        self.baseline = self.highest_scanned = uidnext - 1
+        logging.debug(f"Mailbox baseline UID {self.baseline} (UIDVALIDITY {self.uidvalidity})")
+
+    def scan(self):
+        """Return a code from mail that arrived after the baseline, newest first."""
+        if self.baseline is None:
+            # Without a baseline fall back to the sender's unseen mail
+            criteria = f'(FROM "{self.sender}" UNSEEN)'
+        else:
+            criteria = f'(UID {self.highest_scanned + 1}:* FROM "{self.sender}")'
+
+        typ, data = self.imap.uid('search', None, criteria)
+        if typ != 'OK':
+            raise self.imap.error(f"UID SEARCH failed: {data}")
+        uids = [int(uid) for uid in (data[0] or b'').split()]
+        if self.baseline is not None:
+            # "n:*" always matches the last message, even when its UID is below n
+            uids = [uid for uid in uids if uid > self.highest_scanned]
+
+        for uid in sorted(uids, reverse=True):
+            code = self._extract_code(uid)
+            if code:
+                return code
+
+        if uids and self.baseline is not None:
+            self.highest_scanned = max(uids)
+        return None
+
+    def _extract_code(self, uid):
+        """Fetch the text parts of one message, plain before HTML, until a code is found."""
+        _, data = self.imap.uid('fetch', str(uid), '(BODYSTRUCTURE)')
+        structure = _find_item(_parse_sexp(_flatten_fetch(data)), 'BODYSTRUCTURE')
+        if not structure:
+            return None
+
+        parts = sorted(_text_parts(structure), key=lambda part: part[1] != 'plain')
+        for section, subtype, encoding, charset in parts:
+            _, data = self.imap.uid('fetch', str(uid), f'(BODY.PEEK[{section}])')
+            raw = next((item[1] for item in data if isinstance(item, tuple)), b'')
+            content = _decode_part(raw, encoding, charset)
+            if subtype == 'html':
+                content = _html_to_text(content)
+            match = CODE_PATTERN.search(content)
+            if match:
+                return match.group(0)
+        return None
+
+
+def _command_name(data, tagpre):
+    """Command of a client line, e.g. 'UID FETCH' or 'DONE'; its arguments may hold the password."""
+    words = data.split(None, 3)
+    if words and words[0].startswith(tagpre):
+        words = words[1:]
+    if not words or not words[0].isalpha():
+        return 'literal'
+    if words[0].upper() == b'UID' and len(words) > 1:
+        words = [words[0] + b' ' + words[1]]
+    return words[0].decode('ascii').upper()
+
+
+class _ReplaySocket:
+    """Socket stand-in for a replayed IMAP connection."""
+
+    def __init__(self):
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def makefile(self, mode='rb'):
+        return io.BytesIO()
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+class CassetteIMAPMixin:
+    """Records the IMAP stream into the account's cassette, or replays it with no server.
+
+    Lines are kept with the connection's tag prefix swapped for a
+    placeholder, and socket timeouts are replayed as timeouts. Client
+    commands are kept by name only. LOGOUT is answered locally on replay,
+    since which sessions get logged out depends on the run's timing.
+    """
+
+    def open(self, host='', port=imaplib.IMAP4_PORT, timeout=None):
+        self.cassette_account = cassette.current_account()
+        self._logging_out = False
+        self._local_lines = deque()
+        if cassette.player() is None:
+            return super().open(host, port, timeout)
+        self.host, self.port = host, port
+        self.sock = _ReplaySocket()
+        self.file = self.sock.makefile('rb')
+
+    def send(self, data):
+        name = _command_name(data, self.tagpre)
+        if name == 'LOGOUT':
+            self._logging_out = True
+            if cassette.player() is not None:
+                tag = data.split(None, 1)[0]
+                self._local_lines.extend([b'* BYE logging out\r\n', tag + b' OK LOGOUT completed\r\n'])
+                return
+        send = super().send
+        if self._logging_out:
+            return send(data)
+        cassette.exchange('imap', f"send {name}", lambda: send(data), account=self.cassette_account)
+
+    def readline(self):
+        return self._receive('readline', super().readline)
+
+    def read(self, size):
+        read = super().read
+        return self._receive('read', lambda: read(size))
+
+    def _receive(self, op, call):
+        if self._local_lines:
+            return self._local_lines.popleft()
+        if self._logging_out:
+            return call()
+        data = cassette.exchange('imap', op, lambda: self._capture(op, call), account=self.cassette_account)
+        if data is None:
+            raise socket.timeout('timed out')
+        data = data.encode('latin-1')
+        if op == 'readline' and data.startswith(_TAG_PLACEHOLDER):
+            data = self.tagpre + data[len(_TAG_PLACEHOLDER):]
+        return data
+
+    def _capture(self, op, call):
+        try:
+            data = call()
+        except (socket.timeout, TimeoutError):
+            return None
+        if op == 'readline' and data.startswith(self.tagpre):
+            data = _TAG_PLACEHOLDER + data[len(self.tagpre):]
+        return data.decode('latin-1')
+
+
+class CassetteIMAP4(CassetteIMAPMixin, imaplib.IMAP4):
+    pass
+
+
+class CassetteIMAP4_SSL(CassetteIMAPMixin, imaplib.IMAP4_SSL):
+    pass
+
+
+def imap_class(use_ssl=True):
+    """IMAP client class to connect with; records or replays while a cassette is active."""
+    if cassette.active():
+        return CassetteIMAP4_SSL if use_ssl else CassetteIMAP4
+    return imaplib.IMAP4_SSL if use_ssl else imaplib.IMAP4
+
+
+class IMAPConnectionManager:
+    """Authenticated IMAP4_SSL sessions, capped per server.
+
+    Sessions are cached per email address, so a session is only reused by
+    later attempts for the same account (retries, resumes); idle sessions of
+    other accounts are logged out when a slot is needed.
+    """
+
+    def __init__(self, server=IMAP_SERVER, port=IMAP_PORT, max_connections=IMAP_MAX_CONNECTIONS, use_ssl=True):
+        self.server = server
+        self.port = port
+        self.imap_class = imap_class(use_ssl)
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._idle = OrderedDict()  # email address -> authenticated session not in use
+        self._lock = threading.Lock()
+        # Signalled when a slot is freed or a session goes idle
+        self._available = threading.Condition(self._lock)
+
+    def _free_slot(self):
+        self._slots.release()
+        with self._available:
+            self._available.notify()
+
+    def _discard(self, imap):
+        try:
+            imap.logout()
+        except Exception:
+            pass
+        self._free_slot()
+
+    def _reserve_slot(self):
+        """Take a connection slot, evicting the least recently used idle session if full.
+        
+        When every slot is held by a session in use, wait until one is freed
+        or goes idle; sessions released while waiting are evicted too.
+        """
+        while True:
+            with self._available:
+                # Checked under the lock so a slot freed meanwhile is not missed
+                if self._slots.acquire(blocking=False):
+                    return
+                if not self._idle:
+                    self._available.wait()
+                    continue
+                victim = self._idle.popitem(last=False)[1]
+            self._discard(victim)
+
+    def acquire(self, email_address, password):
+        """Return an authenticated session for the address, reusing a cached one if alive."""
+        with self._lock:
+            imap = self._idle.pop(email_address, None)
+        if imap is not None:
+            try:
+                imap.noop()
+                logging.debug(f"Reusing IMAP session for {email_address}")
+                return imap
+            except Exception:
+                self._discard(imap)
+
+        self._reserve_slot()
+        try:
+            imap = self.imap_class(self.server, self.port, timeout=IMAP_TIMEOUT)
+            imap.login(email_address, password)
+        except BaseException:
+            self._free_slot()
+            raise
+        return imap
+
+    def release(self, email_address, imap, reusable=True):
+        """Return a session to the cache, or close it if it is no longer usable."""
+        if not reusable:
+            self._discard(imap)
+            return
+        with self._available:
+            previous = self._idle.pop(email_address, None)
+            self._idle[email_address] = imap
+            self._available.notify()
+        if previous is not None and previous is not imap:
+            self._discard(previous)
+
+    def close_all(self):
+        """Log out every cached session."""
+        with self._lock:
+            sessions = list(self._idle.values())
+            self._idle.clear()
+        for imap in sessions:
+            self._discard(imap)
+
+
 class EmailVerification:
-    def __init__(self, email_address, password):
+    def __init__(self, email_address, password, connection_manager=None):
         self.email_address = email_address
         self.password = password
+        self.connection_manager = connection_manager
         self.imap = None
+        self.scanner = None
+        self.healthy = True
+        self._prepare_thread = None
+        self._prepared = False
 
     def connect(self):
         """Establish IMAP connection to Outlook."""
         try:
-            self.imap = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-            self.imap.login(self.email_address, self.password)
+            if self.connection_manager:
+                self.imap = self.connection_manager.acquire(self.email_address, self.password)
+            else:
+                self.imap = imap_class()(IMAP_SERVER, IMAP_PORT, timeout=IMAP_TIMEOUT)
+                self.imap.login(self.email_address, self.password)
+            self.scanner = MailboxScanner(self.imap)
             return True
         except Exception as e:
             logging.error(f"Failed to connect to email: {str(e)}")
             return False
 
-    def get_verification_code(self):
-        """Retrieve verification code from TikTok email."""
+    def _prepare(self, context=None):
+        with log_context(**(context or {})), \
+                run_metrics.stage('imap_connect', self.email_address) as timer:
+            self._prepared = timer.check(self.connect() and self.snapshot_mailbox())
+
+    def prepare_async(self):
+        """Connect and snapshot the mailbox in a background thread.
+
+        Lets the TLS handshake and IMAP login run while the browser is being
+        prepared; wait_prepared() collects the result before the login submit.
+        """
+        self._prepare_thread = threading.Thread(
+            target=self._prepare,
+            args=(current_log_context(),),
+            name=f"{threading.current_thread().name}-imap",
+            daemon=True
+        )
+        self._prepare_thread.start()
+
+    def prepare_failed(self):
+        """Return True if background preparation has already finished unsuccessfully."""
+        thread = self._prepare_thread
+        return thread is not None and not thread.is_alive() and not self._prepared
+
+    def wait_prepared(self, timeout=None):
+        """Wait for prepare_async() and return True if the mailbox is ready."""
+        if self._prepare_thread is None:
+            self._prepare()
+        else:
+            self._prepare_thread.join(timeout)
+            if self._prepare_thread.is_alive():
+                logging.error("Timed out waiting for email connection")
+                return False
+        return self._prepared
+
+    def supports_idle(self):
+        """Return True if the server advertises the IDLE capability."""
+        return 'IDLE' in self.imap.capabilities
+
+    def wait_for_new_mail(self, timeout):
+        """Block in IMAP IDLE until the server reports new mail or timeout expires."""
+        imap = self.imap
+        tag = imap._new_tag()
+        imap.tagged_commands.pop(tag, None)
+        imap.send(tag + b' IDLE\r\n')
+        response = imap.readline()
+        if not response.startswith(b'+'):
+            raise imap.error(f"IDLE rejected: {response.strip()}")
+
+        new_mail = False
+        previous_timeout = imap.sock.gettimeout()
+        imap.sock.settimeout(timeout)
+        try:
+            while True:
+                line = imap.readline()
+                if not line:
+                    raise imap.abort("connection closed during IDLE")
+                if line.rstrip().endswith((b'EXISTS', b'RECENT')):
+                    new_mail = True
+                    break
+        except (socket.timeout, TimeoutError):
+            # A timed-out socket file cannot be read again, so open a fresh one
+            imap.file = imap.sock.makefile('rb')
+        finally:
+            imap.sock.settimeout(previous_timeout)
+
+        imap.send(b'DONE\r\n')
+        while True:
+            line = imap.readline()
+            if not line:
+                raise imap.abort("connection closed while ending IDLE")
+            if line.startswith(tag):
+                break
+        return new_mail
+
+    def snapshot_mailbox(self):
+        """Record the inbox UID baseline; call before the login form is submitted."""
+        try:
+            self.scanner.snapshot()
+            return True
+        except Exception as e:
+            logging.error(f"Failed to snapshot mailbox: {str(e)}")
+            return False
+
+    def get_verification_code(self, use_idle=EMAIL_USE_IDLE):
+        """Retrieve verification code from TikTok email.
+
+        With use_idle the server pushes new-mail notifications through IMAP IDLE;
+        servers without IDLE fall back to polling every EMAIL_CHECK_INTERVAL.
+        """
         start_time = time.time()
-        
-        while time.time() - start_time < EMAIL_SEARCH_TIMEOUT:
+        idle = use_idle and self.supports_idle()
+        logging.debug(f"Waiting for verification code ({'IDLE' if idle else 'polling'})")
+
+        try:
+            self.scanner.select()
+        except Exception as e:
+            logging.error(f"Error selecting mailbox: {str(e)}")
+            self.healthy = False
+            raise FatalError(f"Cannot select mailbox: {str(e)}") from e
+
+        while not cassette.expired('email_search', lambda: time.time() - start_time >= EMAIL_SEARCH_TIMEOUT):
             try:
-                self.imap.select('INBOX')
-                _, messages = self.imap.search(None, '(FROM "noreply@ads.tiktok.com" UNSEEN)')
-                
-                for msg_num in messages[0].split():
-                    _, msg_data = self.imap.fetch(msg_num, '(RFC822)')
-                    email_body = email.message_from_bytes(msg_data[0][1])
-                    
-                    # Extract verification code from email body
-                    if email_body.is_multipart():
-                        for part in email_body.walk():
-                            if part.get_content_type() == "text/plain":
-                                content = part.get_payload(decode=True).decode()
-                                # Look for 6-digit code in the content
-                                import re
-                                match = re.search(r'\b\d{6}\b', content)
-                                if match:
-                                    return match.group(0)
-                    else:
-                        content = email_body.get_payload(decode=True).decode()
-                        match = re.search(r'\b\d{6}\b', content)
-                        if match:
-                            return match.group(0)
-                            
+                code = self.scanner.scan()
+                if code:
+                    return code
+
+                remaining = EMAIL_SEARCH_TIMEOUT - (time.time() - start_time)
+                if idle and remaining > 0:
+                    self.wait_for_new_mail(remaining)
+                    continue
+
             except Exception as e:
                 logging.error(f"Error checking email: {str(e)}")
-            
+                if isinstance(e, (imaplib.IMAP4.abort, OSError)):
+                    # The session is unusable, so retrying on it cannot help
+                    self.healthy = False
+                    raise FatalError(f"IMAP connection lost: {str(e)}") from e
+
             time.sleep(EMAIL_CHECK_INTERVAL)
-            
+
         return None
 
+    def abort(self):
+        """Break a blocking IDLE/poll from another thread; the session is then discarded."""
+        self.healthy = False
+        imap = self.imap
+        if imap is not None:
+            try:
+                imap.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
     def cleanup(self):
         """Close IMAP connection."""
+        if self._prepare_thread is not None:
+            self._prepare_thread.join()
         if self.imap:
+            if self.connection_manager:
+                self.connection_manager.release(self.email_address, self.imap, self.healthy)
+                self.imap = None
+                return
             try:
                 self.imap.logout()
             except:
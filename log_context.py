@@ -0,0 +1,117 @@
+"""Per-account log correlation, JSONL formatting and off-thread log handling."""
+import json
+import logging
+import logging.handlers
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Fields attached to every record; '-' when no account is being processed
+CONTEXT_FIELDS = ('account', 'profile', 'correlation_id')
+
+# Correlation fields of the account being processed by the current thread
+_local = threading.local()
+_payloads_enabled = False
+
+
+def current_log_context():
+    """Return a copy of the correlation fields bound in this thread."""
+    return dict(getattr(_local, 'fields', {}))
+
+
+@contextmanager
+def log_context(**fields):
+    """Bind correlation fields to every record logged by this thread.
+
+    A new correlation_id is generated unless one is passed, so a context can
+    be carried into helper threads with log_context(**current_log_context()).
+    """
+    previous = getattr(_local, 'fields', None)
+    merged = dict(previous or {})
+    merged.update(fields)
+    merged.setdefault('correlation_id', uuid.uuid4().hex[:12])
+    _local.fields = merged
+    try:
+        yield merged
+    finally:
+        _local.fields = previous if previous is not None else {}
+
+
+def bind_log_context(**fields):
+    """Add fields (e.g. the profile ID once known) to the current context."""
+    if not hasattr(_local, 'fields'):
+        _local.fields = {}
+    _local.fields.update(fields)
+
+
+def set_payload_logging(enabled):
+    """Turn request/response payload dumps on or off."""
+    global _payloads_enabled
+    _payloads_enabled = bool(enabled)
+
+
+def payload_logging_enabled(logger=None):
+    """True when payload dumps are on and DEBUG records would be emitted."""
+    return _payloads_enabled and (logger or logging.getLogger()).isEnabledFor(logging.DEBUG)
+
+
+class ContextFilter(logging.Filter):
+    """Copy the thread's correlation fields onto each record as it is created."""
+
+    def filter(self, record):
+        fields = getattr(_local, 'fields', {})
+        for name in CONTEXT_FIELDS:
+            setattr(record, name, fields.get(name, '-'))
+        return True
+
+
+class JSONLFormatter(logging.Formatter):
+    """Format records as one JSON object per line.
+
+    A `payload` passed through `extra` is embedded as-is, so its
+    serialisation happens here on the listener thread, not in the caller.
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+                  + f".{int(record.msecs):03d}",
+            'level': record.levelname,
+            'thread': record.threadName,
+            'source': f"{record.filename}:{record.lineno}",
+        }
+        for name in CONTEXT_FIELDS:
+            value = getattr(record, name, '-')
+            if value != '-':
+                entry[name] = value
+        entry['message'] = record.getMessage()
+        payload = getattr(record, 'payload', None)
+        if payload is not None:
+            entry['payload'] = payload
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class PayloadFormatter(logging.Formatter):
+    """Plain text formatter that appends any `payload` as indented JSON."""
+
+    def format(self, record):
+        text = super().format(record)
+        payload = getattr(record, 'payload', None)
+        if payload is not None:
+            text += "\n" + json.dumps(payload, indent=2, default=str)
+        return text
+
+
+class ThreadQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler for an in-process queue.
+
+    Records stay in the same process, so they are queued untouched instead of
+    being pre-formatted for pickling; message formatting, payload dumps and
+    I/O all happen on the QueueListener thread.
+    """
+
+    def prepare(self, record):
+        return record
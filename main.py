@@ -1,114 +1,925 @@
 """Main script for TikTok Ads login automation."""
+import argparse
 import logging
+import sqlite3
 import sys
-from utils import setup_logging, read_accounts, save_profile_id, retry_operation
-from ads_power import AdsPowerAPI
-from tiktok_login import TikTokLogin
-from email_handler import EmailVerification
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from utils import setup_logging, retry_operation
+from accounts import FORMATS, iter_accounts, parse_shard
+from ads_power import AdsPowerAPI, browser_launch_options, port_open
+from profile_registry import ProfileRegistry, profile_name
+from account_state import AccountStateStore, STAGES
+from metrics import run_metrics
+from teardown import active_sessions, install_signal_handlers, shutdown_requested, wait_unless_shutdown
+from concurrency import AdaptiveLimiter
+from profiling import PipelineProfiler
+from work_queue import WorkQueue, Heartbeat, default_worker_id
+from retry_policy import Deadline, FatalError, account_deadline
+from pipeline import Pipeline, Stage
+import cassette
+from log_context import log_context, bind_log_context
+from config import (
+    ACCOUNT_DELAY, ACCOUNT_DEADLINE, MAX_WORKERS, METRICS_JSON_FILE, METRICS_PROM_FILE,
+    LOG_STRUCTURED, LOG_PAYLOADS, ADSPOWER_API_URL, QUEUE_HEARTBEAT_INTERVAL, QUEUE_POLL_INTERVAL,
+    CONCURRENCY_MIN, CONCURRENCY_MAX, TEARDOWN_WORKERS, CAPTCHA_LIST_PORT, PIPELINE_PREWARM
+)
 import time
+from contextlib import contextmanager
 
-def process_account(account, adspower_api):
-    """Process a single TikTok Ads account."""
-    logging.info(f"Processing account: {account['email']}")
+# Accounts queued per worker beyond the ones being processed
+SUBMIT_AHEAD = 2
+
+# Subcommands, each one phase in bulk; login (the default) runs the whole chain.
+# Selenium and the IMAP/email modules are imported only where a phase needs
+# them, so the AdsPower-only commands start quickly.
+COMMANDS = {
+    'login': "create missing profiles, open browsers, log in and verify (default)",
+    'check': "report AdsPower health, registry drift and open browsers",
+    'create-profiles': "create AdsPower profiles for accounts that have none",
+    'open': "open the browsers of the selected accounts and leave them open",
+    'verify-sessions': "check which registered profiles are still logged in",
+    'close-all': "close every open browser of a registered profile",
+}
+
+def fail_stage(state, email, stage, message):
+    """Log and journal a failed stage; returns False for the caller to return."""
+    logging.error(message)
+    state.fail(email, stage, message)
+    return False
+
+def process_account(account, adspower_api, registry, state, imap_manager, check_only=False,
+                    captcha_queue=None):
+    """Process a single TikTok Ads account, checkpointing each stage.
     
-    # Create AdsPower profile
-    profile_id = retry_operation(
-        adspower_api.create_profile,
-        f"TikTok_{account['email']}"
-    )
+    A profile that still holds a valid TikTok session is marked verified
+    without logging in. With check_only, accounts without one fail at
+    login_submitted instead of going through the login. With a captcha_queue,
+    an account stuck on a captcha is parked with its browser open and a
+    Future for its result is returned instead of a bool.
+    """
+    from tiktok_login import CAPTCHA
+    email = account['email']
+    logging.info(f"{'Checking session of' if check_only else 'Processing'} account: {email}")
+    state.start(email)
     
-    if not profile_id:
-        logging.error("Failed to create AdsPower profile")
-        return False
+    # Everything opened below is tracked so a shutdown signal can close it
+    session = active_sessions.open(email, adspower_api)
+    parked = False
+    try:
+        result = prepare_account(account, session, adspower_api, registry, state, imap_manager, check_only)
+        if result is not None:
+            return result
+        page_state = submit_login(account, session, state)
+        if page_state is None:
+            return False
+        if page_state == CAPTCHA:
+            if captcha_queue is not None:
+                # Hand the captcha to the operator and free this worker
+                result = captcha_queue.park(
+                    email, session.profile_id, session.tiktok,
+                    resume=lambda: resume_parked(account, session, state),
+                    on_timeout=lambda: give_up_parked(account, session, state)
+                )
+                if result is not None:
+                    parked = True
+                    return result
+            page_state = wait_out_captcha(account, session, state)
+            if page_state is None:
+                return False
+        return finish_login(account, state, session.tiktok, session.email_handler, page_state)
+        
+    finally:
+        # Quit the driver, release the IMAP session and stop the browser in
+        # parallel; a parked account keeps them until it is resumed
+        if not parked:
+            session.close()
+
+def prepare_account(account, session, adspower_api, registry, state, imap_manager, check_only=False):
+    """Profile, browser, WebDriver and saved-session check for one account.
     
-    save_profile_id(account['email'], profile_id)
+    Returns None when the login form is loaded and the account needs
+    submit_login(), else its final result: True for a still-valid session,
+    False on failure.
+    """
+    from tiktok_login import TikTokLogin, DASHBOARD
+    from email_handler import EmailVerification
+    email = account['email']
     
-    # Open browser
-    browser_info = retry_operation(adspower_api.open_browser, profile_id)
-    if not browser_info:
-        logging.error("Failed to open browser")
-        return False
+    def fail(stage, message):
+        return fail_stage(state, email, stage, message)
     
+    # Connect to email and record the mailbox baseline in the background while
+    # the profile and browser are prepared; only mail that arrives after the
+    # baseline is considered when looking for the code
+    if not check_only:
+        if cassette.recorder() is not None:
+            # A replay types a stand-in password, which must take as many keystrokes
+            cassette.describe(email, tiktok_password_length=len(account['tiktok_password']))
+        session.email_handler = EmailVerification(
+            email,
+            account['email_password'],
+            connection_manager=imap_manager
+        )
+        session.email_handler.prepare_async()
+    
+    stage = 'profile_created'
     try:
+        # Reuse the registered AdsPower profile, creating one only if needed
+        profile_id = registry.get(email)
+        if profile_id:
+            bind_log_context(profile=profile_id)
+            logging.info(f"Reusing AdsPower profile {profile_id}")
+        elif check_only:
+            return fail(stage, "No AdsPower profile registered")
+        else:
+            with run_metrics.stage('create_profile', email) as timer:
+                profile_id = timer.check(retry_operation(
+                    adspower_api.create_profile,
+                    profile_name(email)
+                ))
+            if not profile_id:
+                return fail(stage, "Failed to create AdsPower profile")
+            bind_log_context(profile=profile_id)
+            registry.register(email, profile_id)
+        session.profile_id = profile_id
+        state.complete(email, stage)
+        
+        # Don't spend a browser on an account whose mailbox already failed
+        if not check_only and session.email_handler.prepare_failed():
+            return fail('code_received', "Failed to connect to email")
+        
+        # Open browser
+        stage = 'browser_opened'
+        with run_metrics.stage('open_browser', email) as timer:
+            browser_info = timer.check(retry_operation(adspower_api.open_browser, profile_id))
+        if not browser_info:
+            return fail(stage, "Failed to open browser")
+        session.browser_opened = True
+        state.complete(email, stage)
+        
         # Initialize TikTok login handler
-        tiktok = TikTokLogin(browser_info['selenium_port'])
+        stage = 'login_submitted'
+        with run_metrics.stage('setup_driver', email):
+            tiktok = session.tiktok = TikTokLogin(browser_info['selenium_port'])
         
-        # Perform login
-        if not retry_operation(
-            tiktok.login,
-            account['email'],
-            account['tiktok_password']
-        ):
-            logging.error("Failed to perform login")
-            return False
+        # Fast path: a saved session lands straight on the dashboard
+        with run_metrics.stage('session_check', email):
+            session_state = tiktok.check_session()
+        if session_state == DASHBOARD:
+            logging.info(f"Session still valid for {email}, skipping login")
+            state.complete(email, 'verified')
+            return True
+        if check_only:
+            return fail(stage, f"No valid session (page shows {session_state})")
+        return None
         
-        # Handle CAPTCHA if present
-        if not retry_operation(tiktok.handle_captcha):
-            logging.error("Failed to handle CAPTCHA")
-            return False
+    except Exception as e:
+        return fail(stage, f"Error processing account: {str(e)}")
+
+def submit_login(account, session, state):
+    """Fill in and submit the login form; returns the page state that follows, or None on failure."""
+    email = account['email']
+    stage = 'login_submitted'
+    try:
+        # The mailbox baseline must exist before the login form is submitted
+        if not session.email_handler.wait_prepared():
+            fail_stage(state, email, 'code_received', "Failed to connect to email")
+            return None
         
-        # Handle email verification
-        email_handler = EmailVerification(
-            account['email'],
-            account['email_password']
-        )
+        # Perform login
+        with run_metrics.stage('login', email) as timer:
+            logged_in = timer.check(retry_operation(
+                session.tiktok.login,
+                email,
+                account['tiktok_password']
+            ))
+        if not logged_in:
+            fail_stage(state, email, stage, "Failed to perform login")
+            return None
         
-        if not email_handler.connect():
-            logging.error("Failed to connect to email")
-            return False
+        # Branch on what the page shows after the submit instead of fixed waits
+        return session.tiktok.wait_after_submit()
         
-        verification_code = retry_operation(email_handler.get_verification_code)
-        if not verification_code:
-            logging.error("Failed to get verification code")
-            return False
+    except Exception as e:
+        fail_stage(state, email, stage, f"Error processing account: {str(e)}")
+        return None
+
+def wait_out_captcha(account, session, state):
+    """Wait for a captcha to be solved by hand; returns the page state after it, or None."""
+    email = account['email']
+    try:
+        with run_metrics.stage('captcha_wait', email) as timer:
+            solved = timer.check(session.tiktok.handle_captcha())
+        if not solved:
+            fail_stage(state, email, 'login_submitted', "Failed to handle CAPTCHA")
+            return None
+        return session.tiktok.wait_after_submit()
+    except Exception as e:
+        fail_stage(state, email, 'login_submitted', f"Error processing account: {str(e)}")
+        return None
+
+def finish_login(account, state, tiktok, email_handler, page_state):
+    """Complete an account from the page shown after the login submit: email code onward."""
+    from tiktok_login import DASHBOARD, ERROR
+    email = account['email']
+    stage = 'login_submitted'
+    try:
+        if page_state == ERROR:
+            return fail_stage(state, email, stage, "TikTok rejected the login")
+        state.complete(email, stage)
         
-        if not retry_operation(
-            tiktok.enter_verification_code,
-            verification_code
-        ):
-            logging.error("Failed to enter verification code")
-            return False
+        if page_state == DASHBOARD:
+            logging.info("Logged in without email verification")
+        else:
+            # Handle email verification
+            stage = 'code_received'
+            with run_metrics.stage('code_arrival', email) as timer:
+                verification_code = timer.check(
+                    retry_operation(email_handler.get_verification_code)
+                )
+            if not verification_code:
+                return fail_stage(state, email, stage, "Failed to get verification code")
+            state.complete(email, stage)
+            
+            stage = 'verified'
+            with run_metrics.stage('enter_code', email) as timer:
+                entered = timer.check(retry_operation(
+                    tiktok.enter_verification_code,
+                    verification_code
+                ))
+            if not entered:
+                return fail_stage(state, email, stage, "Failed to enter verification code")
+        state.complete(email, 'verified')
         
-        logging.info(f"Successfully processed account: {account['email']}")
+        logging.info(f"Successfully processed account: {email}")
         return True
         
     except Exception as e:
-        logging.error(f"Error processing account: {str(e)}")
+        return fail_stage(state, email, stage, f"Error processing account: {str(e)}")
+
+def resume_parked(account, session, state):
+    """Finish an account whose parked captcha was solved; runs on a pool worker."""
+    with log_context(account=account['email'], profile=session.profile_id), \
+            account_deadline(ACCOUNT_DEADLINE):
+        try:
+            tiktok = session.tiktok
+            return finish_login(account, state, tiktok, session.email_handler, tiktok.wait_after_submit())
+        finally:
+            session.close()
+
+def give_up_parked(account, session, state):
+    """Fail an account whose parked captcha was not solved in time and release its browser."""
+    fail_stage(state, account['email'], 'login_submitted', "CAPTCHA resolution timeout exceeded")
+    session.close()
+
+def run_account(account, adspower_api, registry, state, imap_manager, check_only=False,
+                captcha_queue=None):
+    """Worker entry point: process one account and pace the worker afterwards."""
+    try:
+        with log_context(account=account['email']), \
+                run_metrics.stage('account', account['email']) as timer, \
+                account_deadline(ACCOUNT_DEADLINE):
+            result = process_account(
+                account, adspower_api, registry, state, imap_manager, check_only, captcha_queue
+            )
+            if isinstance(result, Future):
+                # Parked on a captcha: the account ends when its Future resolves
+                finish = timer.defer()
+                result.add_done_callback(lambda future: finish(future.exception() is None and future.result()))
+                return result
+            return timer.check(result)
+    except Exception as e:
+        logging.error(f"Unhandled error for account {account['email']}: {str(e)}")
         return False
-        
     finally:
-        # Cleanup
-        if 'tiktok' in locals():
-            tiktok.cleanup()
-        if 'email_handler' in locals():
-            email_handler.cleanup()
+        wait_unless_shutdown(ACCOUNT_DELAY)  # Delay before this worker picks up the next account
+
+def log_summary(results, elapsed):
+    """Log the end-of-run summary."""
+    succeeded = [email for email, ok in results.items() if ok]
+    failed = [email for email, ok in results.items() if not ok]
+    rate = len(results) / elapsed * 3600 if elapsed > 0 else 0.0
+
+    logging.info("Run summary:")
+    logging.info(f"Accounts processed: {len(results)}")
+    logging.info(f"Succeeded: {len(succeeded)}")
+    logging.info(f"Failed: {len(failed)}")
+    logging.info(f"Elapsed: {elapsed:.1f}s ({rate:.1f} accounts/hour)")
+    for email in failed:
+        logging.info(f"Failed account: {email}")
+
+def shard_arg(value):
+    """argparse type for --shard."""
+    try:
+        return parse_shard(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="TikTok Ads login automation",
+        epilog="commands:\n" + "\n".join(f"  {name:<16} {text}" for name, text in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        'command', nargs='?', default='login', choices=COMMANDS, metavar='command',
+        help="Phase to run (default: login), see below"
+    )
+    parser.add_argument(
+        '--workers', type=int, default=MAX_WORKERS,
+        help="Number of accounts processed at once (match the AdsPower browser slots, "
+             "less CAPTCHA_MAX_PARKED with --captcha-queue)"
+    )
+    parser.add_argument(
+        '--adaptive', action='store_true',
+        help="Adjust the accounts in flight (starting at --workers) to host load and AdsPower errors"
+    )
+    parser.add_argument(
+        '--min-workers', type=int, default=CONCURRENCY_MIN,
+        help="Floor of accounts in flight with --adaptive"
+    )
+    parser.add_argument(
+        '--max-workers', type=int, default=CONCURRENCY_MAX,
+        help="Ceiling of accounts in flight with --adaptive"
+    )
+    parser.add_argument(
+        '--accounts', default="accounts.txt",
+        help="Path to the accounts file"
+    )
+    parser.add_argument(
+        '--accounts-format', choices=FORMATS,
+        help="Accounts file format (default: from the extension; .csv, .jsonl, otherwise text)"
+    )
+    parser.add_argument(
+        '--shard', type=shard_arg,
+        help="Process only shard i of n (e.g. 2/4), partitioned by email hash"
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help="Skip accounts the state journal already records as verified"
+    )
+    parser.add_argument(
+        '--only-failed', action='store_true',
+        help="Process only accounts whose last attempt failed"
+    )
+    parser.add_argument(
+        '--retry-stage', choices=STAGES,
+        help="Process only accounts whose last attempt failed at this stage"
+    )
+    parser.add_argument(
+        '--metrics-json', default=METRICS_JSON_FILE,
+        help="Write per-stage metrics and raw timings to this JSON file"
+    )
+    parser.add_argument(
+        '--metrics-prom', default=METRICS_PROM_FILE,
+        help="Write per-stage metrics to this Prometheus textfile"
+    )
+    parser.add_argument(
+        '--profile', metavar='DIR',
+        help="Write per-account cProfile .pstats files and collapsed stacks to DIR "
+             "(Python 3.12+ profiles one account at a time; use --workers 1 for every account)"
+    )
+    parser.add_argument(
+        '--profile-stages', action='store_true',
+        help="With --profile, write one .pstats file per stage instead of per account"
+    )
+    parser.add_argument(
+        '--record', metavar='DIR',
+        help="Record AdsPower, WebDriver and IMAP traffic into per-account cassettes in DIR "
+             "(replay them with python -m benchmarks.replay DIR)"
+    )
+    parser.add_argument(
+        '--pipeline', action='store_true',
+        help="Run prepare, login and email verification as separate stages with their own workers"
+    )
+    parser.add_argument(
+        '--prewarm', type=int, default=PIPELINE_PREWARM,
+        help="With --pipeline, browsers kept opened and attached ahead of the login workers"
+    )
+    parser.add_argument(
+        '--verify-workers', type=int,
+        help="With --pipeline, accounts waiting for their email code at once (default: --workers)"
+    )
+    parser.add_argument(
+        '--captcha-queue', action='store_true',
+        help="Park accounts that hit a captcha with the browser open and keep processing others; "
+             "up to CAPTCHA_MAX_PARKED parked browsers stay open on top of --workers"
+    )
+    parser.add_argument(
+        '--captcha-port', type=int, default=CAPTCHA_LIST_PORT,
+        help="Serve the list of parked captchas at http://127.0.0.1:PORT/ (with --captcha-queue)"
+    )
+    parser.add_argument(
+        '--check-sessions', action='store_true',
+        help="Same as the verify-sessions command"
+    )
+    parser.add_argument(
+        '--adspower-url', default=ADSPOWER_API_URL,
+        help="Local API URL of the AdsPower instance this process drives"
+    )
+    parser.add_argument(
+        '--lean-browser', action='store_true',
+        help="Start browsers without images, extensions or restored tabs and with small caches"
+    )
+    parser.add_argument(
+        '--headless', action='store_true',
+        help="Start browsers headless (captchas then cannot be solved by hand)"
+    )
+    parser.add_argument(
+        '--queue',
+        help="SQLite work queue shared with other hosts; accounts are leased from it"
+    )
+    parser.add_argument(
+        '--enqueue', action='store_true',
+        help="With --queue, load the accounts file into the queue before draining it"
+    )
+    parser.add_argument(
+        '--worker-id', default=default_worker_id(),
+        help="Name this worker holds leases under (default: hostname:pid)"
+    )
+    parser.add_argument(
+        '--log-json', action='store_true', default=LOG_STRUCTURED,
+        help="Write structured JSONL logs with per-account correlation fields"
+    )
+    parser.add_argument(
+        '--log-payloads', action='store_true', default=LOG_PAYLOADS,
+        help="Include AdsPower request/response bodies in DEBUG logs"
+    )
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.adaptive and not 1 <= args.min_workers <= args.max_workers:
+        parser.error("--min-workers must be at least 1 and not above --max-workers")
+    if args.enqueue and not args.queue:
+        parser.error("--enqueue requires --queue")
+    if args.pipeline:
+        if args.command != 'login' or args.check_sessions or args.queue:
+            parser.error("--pipeline only applies to the login command without --queue")
+        if args.adaptive or args.captcha_queue:
+            parser.error("--pipeline cannot be combined with --adaptive or --captcha-queue")
+        if args.prewarm < 1:
+            parser.error("--prewarm must be at least 1")
+        if args.profile and not args.profile_stages:
+            # An account runs on three stage threads, and cProfile cannot follow it across them
+            parser.error("--pipeline profiles per stage only; add --profile-stages to --profile")
+    if args.verify_workers is None:
+        args.verify_workers = args.workers
+    return args
+
+def reclaim_browsers(adspower_api, registry, wanted=()):
+    """Deal with browsers of registered profiles that a killed run left open.
+    
+    Browsers of profiles in wanted whose WebDriver port still answers are
+    adopted, so process_account reuses them instead of starting new ones;
+    the rest are closed in parallel. Browsers of other profiles are left alone.
+    """
+    active = adspower_api.list_active_browsers()
+    if not active:
+        return
+    ours = {profile_id for _, profile_id in registry.items()}
+    stale = []
+    for browser in active:
+        profile_id = browser['user_id']
+        if profile_id not in ours:
+            continue
+        if profile_id in wanted and port_open(browser['selenium_port']):
+            adspower_api.adopt_browser(profile_id, browser)
+            logging.info(f"Adopted browser left open for profile {profile_id}")
+        else:
+            stale.append(profile_id)
+    if stale:
+        logging.info(f"Closing {len(stale)} browsers left open by a previous run")
+        with ThreadPoolExecutor(max_workers=TEARDOWN_WORKERS, thread_name_prefix="reclaim") as executor:
+            closed = sum(1 for ok in executor.map(adspower_api.close_browser, stale) if ok)
+        logging.info(f"Closed {closed}/{len(stale)} leaked browsers")
+
+def close_unused_adopted(adspower_api):
+    """Close adopted browsers whose accounts ended before reaching open_browser."""
+    for profile_id in adspower_api.drop_adopted():
         adspower_api.close_browser(profile_id)
 
-def main():
-    """Main execution function."""
-    setup_logging()
-    logging.info("Starting TikTok Ads login automation")
+def select_accounts(args, state):
+    """Stream the accounts file, narrowed by --shard and the state journal options."""
+    return state.select(
+        iter_accounts(args.accounts, fmt=args.accounts_format, shard=args.shard),
+        resume=args.resume,
+        only_failed=args.only_failed,
+        retry_stage=args.retry_stage
+    )
+
+def report(args, results, elapsed):
+    """Log the run summary and write the requested metrics files."""
+    log_summary(results, elapsed)
+    run_metrics.log_summary()
+    if args.metrics_json:
+        run_metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        run_metrics.write_prometheus(args.metrics_prom)
+
+def release_when_finished(limiter, future):
+    """Release the limiter once an account is finished; a parked account holds it until resolved."""
+    result = future.result() if future.exception() is None else None
+    if isinstance(result, Future):
+        result.add_done_callback(limiter.release)
+    else:
+        limiter.release()
+
+def run_pool(workers, accounts, work, *args, limiter=None, captcha_queue=None):
+    """Run work(account, *args) for each account on a bounded thread pool.
+    
+    Each worker builds its own TikTokLogin/EmailVerification inside
+    process_account. Only a few accounts per worker are queued at a time, so
+    memory stays flat however long the accounts iterable is. With an
+    AdaptiveLimiter, up to its ceiling threads are started and the limiter
+    decides how many accounts run at once. Accounts parked on a captcha_queue
+    are resumed on the same pool and awaited before returning. Returns a dict
+    of email -> result.
+    """
+    results = {}
+    run_metrics.reset()
+    threads = limiter.ceiling if limiter else workers
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="worker") as executor:
+        if captcha_queue:
+            captcha_queue.start(executor.submit)
+        pending = {}
+        for account in accounts:
+            if shutdown_requested():
+                logging.warning("Shutdown requested, not starting further accounts")
+                break
+            if limiter:
+                limiter.acquire()
+                for future in [future for future in pending if future.done()]:
+                    results[pending.pop(future)] = future.result()
+            elif len(pending) >= workers * SUBMIT_AHEAD:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[pending.pop(future)] = future.result()
+            future = executor.submit(work, account, *args)
+            if limiter:
+                future.add_done_callback(lambda future: release_when_finished(limiter, future))
+            pending[future] = account['email']
+        for future in as_completed(pending):
+            results[pending[future]] = future.result()
+        # Wait for parked accounts to be resumed, or given up on
+        for email, result in list(results.items()):
+            if isinstance(result, Future):
+                results[email] = result.result()
+        if captcha_queue:
+            captcha_queue.stop()
+    return results
+
+@contextmanager
+def adaptive_limiter(args):
+    """Yield a started AdaptiveLimiter with --adaptive, else None."""
+    if not args.adaptive:
+        yield None
+        return
+    limiter = AdaptiveLimiter(args.workers, floor=args.min_workers, ceiling=args.max_workers).start()
+    try:
+        yield limiter
+    finally:
+        limiter.stop()
+
+@contextmanager
+def pipeline_profiler(args):
+    """Profile every stage into args.profile while the block runs, if set."""
+    if not args.profile:
+        yield None
+        return
+    profiler = PipelineProfiler(args.profile, per_stage=args.profile_stages).start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+
+def run_session_checks(args, adspower_api):
+    """Bulk pass: check the saved session of every registered profile.
     
-    # Initialize AdsPower API
-    adspower_api = AdsPowerAPI()
+    Accounts whose profile is still logged in are recorded as verified, so a
+    following --resume run only logs in the rest.
+    """
+    state = AccountStateStore().load()
+    registry = ProfileRegistry().load()
+    registry.reconcile(adspower_api)
+    profiles = registry.items()
+    reclaim_browsers(adspower_api, registry, {profile_id for _, profile_id in profiles})
+    logging.info(f"Checking sessions of {len(profiles)} registered profiles with {args.workers} worker(s)")
+    start_time = time.time()
+    try:
+        results = run_pool(
+            args.workers, ({'email': email} for email, _ in profiles),
+            run_account, adspower_api, registry, state, None, True
+        )
+    finally:
+        close_unused_adopted(adspower_api)
+    report(args, results, time.time() - start_time)
+    return results
+
+def run_check(args, adspower_api):
+    """Report AdsPower profiles and open browsers against the registry; False if unreachable."""
+    registry = ProfileRegistry().load()
+    profiles = adspower_api.list_profiles()
+    active = adspower_api.list_active_browsers()
+    if profiles is None or active is None:
+        return False
+    known = {profile.get('user_id') for profile in profiles}
+    ours = {profile_id for _, profile_id in registry.items()}
+    logging.info(
+        f"AdsPower has {len(profiles)} profiles and {len(active)} open browsers, "
+        f"{sum(1 for browser in active if browser['user_id'] in ours)} of them registered"
+    )
+    logging.info(f"Registry has {len(ours)} profiles, {len(ours - known)} no longer in AdsPower")
+    return True
+
+def run_create_profiles(args, adspower_api):
+    """Bulk phase: create AdsPower profiles for the selected accounts that have none."""
+    state = AccountStateStore().load()
+    registry = ProfileRegistry().load()
+    registry.reconcile(adspower_api)
+    return registry.create_missing((account['email'] for account in select_accounts(args, state)), adspower_api)
+
+def run_open(args, adspower_api):
+    """Bulk phase: open the browsers of the selected accounts' profiles.
     
-    # Check if AdsPower is running
-    if not adspower_api.check_connection():
-        logging.error("AdsPower is not running or not accessible. Please start AdsPower and try again.")
-        sys.exit(1)
+    The browsers are left open; a following login run adopts them instead
+    of starting its own. Returns a dict of profile_id -> opened.
+    """
+    state = AccountStateStore().load()
+    registry = ProfileRegistry().load()
+    registry.reconcile(adspower_api)
+    active = {browser['user_id'] for browser in adspower_api.list_active_browsers() or []}
+    profile_ids = list(dict.fromkeys(
+        profile_id for profile_id in (registry.get(account['email']) for account in select_accounts(args, state))
+        if profile_id and profile_id not in active
+    ))
+    logging.info(f"Opening {len(profile_ids)} browsers ({len(active)} already open)")
+
+    def open_one(profile_id):
+        try:
+            return bool(retry_operation(adspower_api.open_browser, profile_id))
+        except FatalError as e:
+            logging.error(f"Cannot open browser for profile {profile_id}: {str(e)}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="open") as executor:
+        results = dict(zip(profile_ids, executor.map(open_one, profile_ids)))
+    logging.info(f"Opened {sum(results.values())}/{len(profile_ids)} browsers")
+    return results
+
+def run_close_all(args, adspower_api):
+    """Bulk phase: close every open browser of a registered profile in parallel."""
+    registry = ProfileRegistry().load()
+    reclaim_browsers(adspower_api, registry)
+
+def run(args, adspower_api, imap_manager):
+    """Run the phase selected by args.command against the given services.
     
-    # Read accounts from file
-    accounts = read_accounts("accounts.txt")
-    if not accounts:
-        logging.error("No accounts found in accounts.txt")
-        return
+    For login and verify-sessions, returns a dict of email -> success for
+    the accounts that were processed.
+    """
+    if args.command == 'check':
+        return run_check(args, adspower_api)
+    if args.command == 'create-profiles':
+        return run_create_profiles(args, adspower_api)
+    if args.command == 'open':
+        return run_open(args, adspower_api)
+    if args.command == 'close-all':
+        return run_close_all(args, adspower_api)
+    if args.command == 'verify-sessions' or args.check_sessions:
+        return run_session_checks(args, adspower_api)
+    if args.queue:
+        return run_queue_worker(args, adspower_api, imap_manager)
     
-    # Process each account
-    for account in accounts:
-        process_account(account, adspower_api)
-        time.sleep(5)  # Delay between accounts
+    # Stream accounts from file and narrow the run using the state journal;
+    # each pass below re-reads the file instead of holding the list in memory
+    state = AccountStateStore().load()
+    if next(select_accounts(args, state), None) is None:
+        logging.info(f"Nothing to process in {args.accounts}")
+        return {}
     
-    logging.info("Automation completed")
+    # Load known profiles, verify them against AdsPower and create the rest up front
+    registry = ProfileRegistry().load()
+    registry.reconcile(adspower_api)
+    reclaim_browsers(
+        adspower_api, registry,
+        {registry.get(account['email']) for account in select_accounts(args, state)} - {None}
+    )
+    registry.create_missing((account['email'] for account in select_accounts(args, state)), adspower_api)
+    
+    if args.pipeline:
+        start_time = time.time()
+        try:
+            results = run_pipeline(args, adspower_api, registry, state, imap_manager)
+        finally:
+            close_unused_adopted(adspower_api)
+        report(args, results, time.time() - start_time)
+        return results
+    
+    logging.info(f"Processing accounts from {args.accounts} with {args.workers} worker(s)")
+    start_time = time.time()
+    captcha_queue = None
+    if args.captcha_queue:
+        from captcha_queue import CaptchaQueue
+        captcha_queue = CaptchaQueue(listing_port=args.captcha_port)
+        logging.info(
+            f"Up to {captcha_queue.max_parked} browsers parked on a captcha may be open "
+            f"on top of the {args.workers} worker(s)"
+        )
+    try:
+        with adaptive_limiter(args) as limiter:
+            results = run_pool(
+                args.workers, select_accounts(args, state),
+                run_account, adspower_api, registry, state, imap_manager, False, captcha_queue,
+                limiter=limiter, captcha_queue=captcha_queue
+            )
+    finally:
+        close_unused_adopted(adspower_api)
+    
+    report(args, results, time.time() - start_time)
+    return results
+
+def run_pipeline(args, adspower_api, registry, state, imap_manager):
+    """Run the selected accounts through prepare -> login -> verify stage pools.
+    
+    Prepare workers create the profile, open and attach the browser and load
+    the TikTok page, keeping up to --prewarm accounts ready ahead of the
+    --workers login workers. Accounts then wait for their email code (and
+    any captcha) on --verify-workers verify workers, so browser start-up and
+    email waits overlap other accounts' logins. Returns email -> success.
+    """
+    from tiktok_login import CAPTCHA
+    logging.info(
+        f"Pipelining accounts from {args.accounts}: {args.prewarm} prewarmed, "
+        f"{args.workers} login and {args.verify_workers} verify worker(s)"
+    )
+    results = {}
+    run_metrics.reset()
+    
+    @contextmanager
+    def account_step(item):
+        # Per-thread log context and the account's remaining deadline
+        session = item['session']
+        with log_context(account=session.email, profile=session.profile_id), \
+                account_deadline(item['deadline'].remaining()):
+            yield
+    
+    def prepare(item):
+        account = item['account']
+        state.start(account['email'])
+        item['session'] = active_sessions.open(account['email'], adspower_api)
+        item['deadline'] = Deadline(ACCOUNT_DEADLINE)
+        with account_step(item):
+            logging.info(f"Processing account: {account['email']}")
+            item['result'] = prepare_account(account, item['session'], adspower_api, registry, state, imap_manager)
+        return item['result'] is None
+    
+    def login(item):
+        try:
+            with account_step(item):
+                item['page_state'] = submit_login(item['account'], item['session'], state)
+            return item['page_state'] is not None
+        finally:
+            wait_unless_shutdown(ACCOUNT_DELAY)  # Delay before this worker logs in the next account
+    
+    def verify(item):
+        account, session = item['account'], item['session']
+        with account_step(item):
+            page_state = item['page_state']
+            if page_state == CAPTCHA:
+                page_state = wait_out_captcha(account, session, state)
+            if page_state is not None:
+                item['result'] = finish_login(account, state, session.tiktok, session.email_handler, page_state)
+        return False
+    
+    def done(item):
+        email = item['account']['email']
+        if item.get('session') is not None:
+            item['session'].close()
+        result = bool(item.get('result'))
+        run_metrics.record(
+            'account', time.perf_counter() - item['started'], 'ok' if result else 'failed', account=email
+        )
+        results[email] = result
+    
+    Pipeline([
+        Stage('prepare', prepare, args.prewarm),
+        Stage('login', login, args.workers, capacity=args.prewarm),
+        Stage('verify', verify, args.verify_workers),
+    ]).run(
+        ({'account': account, 'started': time.perf_counter()} for account in select_accounts(args, state)),
+        done,
+        should_stop=shutdown_requested
+    )
+    return results
+
+def run_queue_worker(args, adspower_api, imap_manager):
+    """Drain the shared work queue at args.queue with this host's AdsPower.
+    
+    With --enqueue the accounts file is loaded into the queue first. Leases
+    are renewed by a heartbeat while accounts are processed; the worker exits
+    once no account is queued or held under a live lease anywhere.
+    """
+    work_queue = WorkQueue(args.queue)
+    state = AccountStateStore().load()
+    if args.enqueue:
+        work_queue.enqueue(select_accounts(args, state))
+    
+    # Profiles are per AdsPower instance, so each host keeps its own registry
+    # and creates profiles on demand in process_account
+    registry = ProfileRegistry().load()
+    registry.reconcile(adspower_api)
+    # Which accounts this worker will lease is unknown, so nothing is adopted
+    reclaim_browsers(adspower_api, registry)
+    
+    logging.info(f"Worker {args.worker_id} draining {args.queue} with {args.workers} worker(s)")
+    heartbeat = Heartbeat(work_queue, args.worker_id, QUEUE_HEARTBEAT_INTERVAL).start()
+    results = {}
+    
+    def drain(limiter):
+        while not shutdown_requested():
+            if limiter:
+                limiter.acquire()
+            try:
+                account = work_queue.lease(args.worker_id)
+                if account is None:
+                    if not work_queue.outstanding():
+                        return
+                    # Other workers still hold leases that may yet expire
+                    wait_unless_shutdown(QUEUE_POLL_INTERVAL)
+                    continue
+                
+                email = account['email']
+                heartbeat.hold(email)
+                try:
+                    results[email] = run_account(account, adspower_api, registry, state, imap_manager)
+                finally:
+                    heartbeat.release(email)
+            except sqlite3.Error as e:
+                logging.error(f"Work queue unavailable: {str(e)}")
+                wait_unless_shutdown(QUEUE_POLL_INTERVAL)
+                continue
+            finally:
+                if limiter:
+                    limiter.release()
+            try:
+                work_queue.complete(email, args.worker_id, results[email])
+            except sqlite3.Error as e:
+                logging.error(f"Could not record result for {email}: {str(e)}")
+    
+    start_time = time.time()
+    run_metrics.reset()
+    try:
+        with adaptive_limiter(args) as limiter:
+            threads = limiter.ceiling if limiter else args.workers
+            with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="worker") as executor:
+                for future in [executor.submit(drain, limiter) for _ in range(threads)]:
+                    future.result()
+    finally:
+        heartbeat.stop()
+    
+    report(args, results, time.time() - start_time)
+    logging.info(f"Queue status: {work_queue.counts()}")
+    return results
+
+def main(argv=None):
+    """Main execution function."""
+    args = parse_args(argv)
+    log_listener = setup_logging(structured=args.log_json, payloads=args.log_payloads)
+    install_signal_handlers()
+    if args.record:
+        cassette.start_recording(args.record)
+    try:
+        logging.info("Starting TikTok Ads login automation")
+        
+        # Initialize AdsPower API
+        adspower_api = AdsPowerAPI(
+            base_url=args.adspower_url,
+            launch_options=browser_launch_options(args.lean_browser, args.headless)
+        )
+        
+        # Check if AdsPower is running
+        if not adspower_api.check_connection():
+            logging.error("AdsPower is not running or not accessible. Please start AdsPower and try again.")
+            sys.exit(1)
+        
+        imap_manager = None
+        if args.command == 'login' and not args.check_sessions:
+            from email_handler import IMAPConnectionManager
+            imap_manager = IMAPConnectionManager()
+        try:
+            with pipeline_profiler(args):
+                result = run(args, adspower_api, imap_manager)
+        finally:
+            if imap_manager is not None:
+                imap_manager.close_all()
+        if result is False:
+            sys.exit(1)
+        logging.info("Automation completed")
+    finally:
+        cassette.stop()
+        # Flush records still queued for the listener thread
+        log_listener.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,229 @@
+"""Per-stage latency metrics for the account pipeline."""
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+
+# Stage timers active in the current thread, innermost last
+_active = threading.local()
+
+
+def _percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def note_retry():
+    """Count a retry against the innermost stage timed in this thread, if any."""
+    stack = getattr(_active, 'stack', None)
+    if stack:
+        stack[-1].retries += 1
+
+
+class StageTimer:
+    """Context manager timing one stage; the outcome defaults to ok, exceptions are errors."""
+
+    def __init__(self, metrics, stage, account):
+        self.metrics = metrics
+        self.stage = stage
+        self.account = account
+        self.outcome = 'ok'
+        self.retries = 0
+        self.start = None
+        self._hooks = None
+        self._deferred = False
+
+    def __enter__(self):
+        if self.metrics.stage_hooks:
+            self._hooks = ExitStack()
+            for hook in list(self.metrics.stage_hooks):
+                self._hooks.enter_context(hook(self.stage, self.account))
+        self.start = time.perf_counter()
+        if not hasattr(_active, 'stack'):
+            _active.stack = []
+        _active.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start
+        _active.stack.remove(self)
+        if exc_type is not None:
+            self.outcome = 'error'
+        if not self._deferred:
+            self.metrics.record(self.stage, duration, self.outcome, self.retries, self.account)
+        if self._hooks is not None:
+            self._hooks.close()
+        return False
+
+    def defer(self):
+        """Record the stage when it really ends rather than on exit; returns finish(result) for that."""
+        self._deferred = True
+
+        def finish(result):
+            duration = time.perf_counter() - self.start
+            self.metrics.record(self.stage, duration, 'ok' if result else 'failed', self.retries, self.account)
+        return finish
+
+    def check(self, result):
+        """Mark the stage failed if result is falsy and hand the result back."""
+        if not result:
+            self.outcome = 'failed'
+        return result
+
+
+class RunMetrics:
+    """Thread-safe collection of stage durations, retry counts and outcomes."""
+
+    def __init__(self):
+        self.records = []
+        self.started_at = time.time()
+        self.stage_hooks = []  # hook(stage, account) -> context manager wrapped around every stage
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Drop collected records and restart the run clock."""
+        with self._lock:
+            self.records = []
+            self.started_at = time.time()
+
+    def stage(self, name, account=None):
+        """Return a StageTimer for name; use as a context manager."""
+        return StageTimer(self, name, account)
+
+    def add_stage_hook(self, hook):
+        """Wrap every stage timed from now on in the context manager hook(stage, account) returns."""
+        self.stage_hooks.append(hook)
+
+    def remove_stage_hook(self, hook):
+        self.stage_hooks.remove(hook)
+
+    def record(self, stage, duration, outcome='ok', retries=0, account=None):
+        """Record one stage execution."""
+        with self._lock:
+            self.records.append({
+                'stage': stage,
+                'account': account,
+                'duration': duration,
+                'outcome': outcome,
+                'retries': retries,
+                'ts': time.time(),
+            })
+
+    def since(self, ts):
+        """Return a copy of the records that completed at or after ts."""
+        with self._lock:
+            return [record for record in self.records if record['ts'] >= ts]
+
+    def summary(self):
+        """Aggregate records per stage, plus run-level throughput."""
+        with self._lock:
+            records = list(self.records)
+        elapsed = time.time() - self.started_at
+
+        grouped = defaultdict(list)
+        for record in records:
+            grouped[record['stage']].append(record)
+
+        stages = {}
+        for stage, items in grouped.items():
+            durations = sorted(item['duration'] for item in items)
+            outcomes = defaultdict(int)
+            for item in items:
+                outcomes[item['outcome']] += 1
+            stages[stage] = {
+                'count': len(items),
+                'outcomes': dict(outcomes),
+                'retries': sum(item['retries'] for item in items),
+                'sum': sum(durations),
+                'mean': sum(durations) / len(durations),
+                'p50': _percentile(durations, 0.50),
+                'p95': _percentile(durations, 0.95),
+                'max': durations[-1],
+            }
+
+        accounts = len(grouped.get('account', []))
+        return {
+            'started_at': self.started_at,
+            'elapsed': elapsed,
+            'accounts': accounts,
+            'accounts_per_hour': accounts / elapsed * 3600 if elapsed > 0 else 0.0,
+            'stages': stages,
+        }
+
+    def log_summary(self):
+        """Log p50/p95 per stage and overall throughput."""
+        summary = self.summary()
+        logging.info("Stage latency summary:")
+        for stage, data in sorted(summary['stages'].items(), key=lambda item: -item[1]['sum']):
+            outcomes = ", ".join(f"{key}={value}" for key, value in sorted(data['outcomes'].items()))
+            logging.info(
+                f"  {stage}: n={data['count']} p50={data['p50']:.2f}s p95={data['p95']:.2f}s "
+                f"max={data['max']:.2f}s total={data['sum']:.1f}s retries={data['retries']} ({outcomes})"
+            )
+        logging.info(f"Throughput: {summary['accounts_per_hour']:.1f} accounts/hour")
+
+    @staticmethod
+    def _write_atomic(path, content):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    def write_json(self, path):
+        """Write the summary and raw records as JSON."""
+        with self._lock:
+            records = list(self.records)
+        report = self.summary()
+        report['records'] = records
+        try:
+            self._write_atomic(path, json.dumps(report, indent=2))
+            logging.info(f"Metrics written to {path}")
+        except Exception as e:
+            logging.error(f"Error writing metrics JSON: {str(e)}")
+
+    def write_prometheus(self, path):
+        """Write a Prometheus textfile-collector file."""
+        summary = self.summary()
+        lines = [
+            "# HELP tiktok_stage_duration_seconds Duration of account pipeline stages.",
+            "# TYPE tiktok_stage_duration_seconds summary",
+        ]
+        for stage, data in sorted(summary['stages'].items()):
+            lines.append(f'tiktok_stage_duration_seconds{{stage="{stage}",quantile="0.5"}} {data["p50"]:.6f}')
+            lines.append(f'tiktok_stage_duration_seconds{{stage="{stage}",quantile="0.95"}} {data["p95"]:.6f}')
+            lines.append(f'tiktok_stage_duration_seconds_sum{{stage="{stage}"}} {data["sum"]:.6f}')
+            lines.append(f'tiktok_stage_duration_seconds_count{{stage="{stage}"}} {data["count"]}')
+        lines += [
+            "# HELP tiktok_stage_total Stage executions by outcome.",
+            "# TYPE tiktok_stage_total counter",
+        ]
+        for stage, data in sorted(summary['stages'].items()):
+            for outcome, count in sorted(data['outcomes'].items()):
+                lines.append(f'tiktok_stage_total{{stage="{stage}",outcome="{outcome}"}} {count}')
+        lines += [
+            "# HELP tiktok_stage_retries_total Retries spent inside each stage.",
+            "# TYPE tiktok_stage_retries_total counter",
+        ]
+        for stage, data in sorted(summary['stages'].items()):
+            lines.append(f'tiktok_stage_retries_total{{stage="{stage}"}} {data["retries"]}')
+        lines += [
+            "# HELP tiktok_accounts_per_hour Accounts processed per hour in this run.",
+            "# TYPE tiktok_accounts_per_hour gauge",
+            f"tiktok_accounts_per_hour {summary['accounts_per_hour']:.6f}",
+        ]
+        try:
+            self._write_atomic(path, "\n".join(lines) + "\n")
+            logging.info(f"Prometheus metrics written to {path}")
+        except Exception as e:
+            logging.error(f"Error writing Prometheus metrics: {str(e)}")
+
+
+# Shared by every worker in the process
+run_metrics = RunMetrics()
@@ -0,0 +1,94 @@
+"""Staged pipeline: each stage has its own worker threads and a bounded hand-off from the previous one."""
+import logging
+import queue
+import threading
+
+# Tells a stage worker that no more items will arrive
+_STOP = object()
+
+
+class Stage:
+    """One step of a Pipeline.
+
+    work(item) returns True to pass the item on to the next stage, False
+    when the item is finished. capacity bounds the items the previous stage
+    may be working on or have waiting for this one (default: workers), so a
+    slow stage holds back the stages before it.
+    """
+
+    def __init__(self, name, work, workers, capacity=None):
+        self.name = name
+        self.work = work
+        self.workers = max(1, workers)
+        self.capacity = max(1, capacity or self.workers)
+        self.queue = queue.Queue()
+        self.slots = threading.Semaphore(self.capacity)
+        self.threads = []
+
+
+class Pipeline:
+    """Moves items through stages; every stage runs on its own pool of threads."""
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def run(self, items, on_done, should_stop=lambda: False):
+        """Feed items through the stages, calling on_done(item) once each item is finished.
+
+        Feeding stops early when should_stop() returns True; items already
+        inside the pipeline still run to completion. Returns once every
+        stage has drained.
+        """
+        for index, stage in enumerate(self.stages):
+            following = self.stages[index + 1] if index + 1 < len(self.stages) else None
+            for number in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work, args=(stage, following, on_done),
+                    name=f"{stage.name}_{number}", daemon=True
+                )
+                thread.start()
+                stage.threads.append(thread)
+
+        first = self.stages[0]
+        for item in items:
+            if should_stop():
+                logging.warning("Shutdown requested, not starting further accounts")
+                break
+            first.slots.acquire()
+            first.queue.put(item)
+
+        # Stop each stage once the one before it has handed over its last item
+        for stage in self.stages:
+            for _ in stage.threads:
+                stage.queue.put(_STOP)
+            for thread in stage.threads:
+                thread.join()
+
+    def _work(self, stage, following, on_done):
+        while True:
+            # Reserve room downstream before taking an item, so at most
+            # following.capacity items are worked on ahead of that stage
+            if following is not None:
+                following.slots.acquire()
+            item = stage.queue.get()
+            if item is _STOP:
+                if following is not None:
+                    following.slots.release()
+                return
+            stage.slots.release()
+
+            try:
+                forward = stage.work(item)
+            except Exception as e:
+                logging.error(f"Unhandled error in pipeline stage {stage.name}: {str(e)}")
+                forward = False
+
+            if forward and following is not None:
+                following.queue.put(item)
+                continue
+            if following is not None:
+                following.slots.release()
+            try:
+                on_done(item)
+            except Exception as e:
+                logging.error(f"Error finishing pipeline item: {str(e)}")
@@ -0,0 +1,126 @@
+"""Registry of AdsPower profiles indexed by account email."""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import PROFILE_IDS_FILE, PROFILE_NAME_PREFIX, PROFILE_CREATE_WORKERS
+from utils import save_profile_id, retry_operation
+from retry_policy import FatalError
+
+
+def profile_name(email):
+    """Return the AdsPower profile name used for an account."""
+    return f"{PROFILE_NAME_PREFIX}{email}"
+
+
+class ProfileRegistry:
+    """Maps account emails to AdsPower profile IDs so reruns reuse profiles."""
+
+    def __init__(self, filename=PROFILE_IDS_FILE):
+        self.filename = filename
+        self._profiles = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._profiles)
+
+    def __contains__(self, email):
+        return email in self._profiles
+
+    def get(self, email):
+        """Return the profile ID registered for email, or None."""
+        return self._profiles.get(email)
+
+    def items(self):
+        """Return a snapshot of (email, profile_id) pairs."""
+        with self._lock:
+            return list(self._profiles.items())
+
+    def load(self):
+        """Load email,profile_id pairs from the profile IDs file; later lines win."""
+        try:
+            with open(self.filename, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    email, sep, profile_id = line.rpartition(',')
+                    if not sep or not email or not profile_id:
+                        logging.error(f"Invalid line format in profile IDs file: {line}")
+                        continue
+                    self._profiles[email] = profile_id
+        except FileNotFoundError:
+            logging.info(f"No profile IDs file found at {self.filename}, starting empty")
+        except Exception as e:
+            logging.error(f"Error reading profile IDs file: {str(e)}")
+        logging.info(f"Loaded {len(self._profiles)} registered profiles from {self.filename}")
+        return self
+
+    def reconcile(self, adspower_api):
+        """Drop entries AdsPower no longer knows and adopt unregistered TikTok_ profiles."""
+        profiles = adspower_api.list_profiles()
+        if profiles is None:
+            logging.warning("Could not list AdsPower profiles, keeping registry unverified")
+            return False
+
+        by_name = {}
+        known_ids = set()
+        for profile in profiles:
+            known_ids.add(profile.get("user_id"))
+            name = profile.get("name") or ""
+            if name.startswith(PROFILE_NAME_PREFIX):
+                by_name[name[len(PROFILE_NAME_PREFIX):]] = profile["user_id"]
+
+        with self._lock:
+            stale = [email for email, pid in self._profiles.items() if pid not in known_ids]
+            for email in stale:
+                logging.warning(f"Profile {self._profiles[email]} for {email} no longer exists in AdsPower")
+                del self._profiles[email]
+
+            adopted = 0
+            for email, profile_id in by_name.items():
+                if email not in self._profiles:
+                    self._profiles[email] = profile_id
+                    adopted += 1
+
+        if stale or adopted:
+            logging.info(f"Registry reconciled: {len(stale)} stale removed, {adopted} adopted")
+            self._rewrite()
+        return True
+
+    def _rewrite(self):
+        """Rewrite the profile IDs file from the in-memory registry."""
+        try:
+            with self._lock, open(self.filename, 'w') as f:
+                for email, profile_id in self._profiles.items():
+                    f.write(f"{email},{profile_id}\n")
+        except Exception as e:
+            logging.error(f"Error rewriting profile IDs file: {str(e)}")
+
+    def register(self, email, profile_id):
+        """Record a newly created profile in memory and on disk."""
+        with self._lock:
+            self._profiles[email] = profile_id
+            save_profile_id(email, profile_id, self.filename)
+
+    def create_missing(self, emails, adspower_api, workers=PROFILE_CREATE_WORKERS):
+        """Create profiles, in one pass, for every email that has none yet."""
+        missing = list(dict.fromkeys(email for email in emails if email not in self._profiles))
+        if not missing:
+            return 0
+        logging.info(f"Creating {len(missing)} missing AdsPower profiles")
+
+        def create(email):
+            try:
+                profile_id = retry_operation(adspower_api.create_profile, profile_name(email))
+            except FatalError as e:
+                logging.error(f"Cannot create profile for {email}: {str(e)}")
+                return None
+            if profile_id:
+                self.register(email, profile_id)
+            return profile_id
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="create") as executor:
+            created = sum(1 for profile_id in executor.map(create, missing) if profile_id)
+
+        logging.info(f"Created {created}/{len(missing)} AdsPower profiles")
+        return created
@@ -0,0 +1,159 @@
+"""Opt-in CPU profiling of the account pipeline (--profile)."""
+import cProfile
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from metrics import run_metrics
+from config import PROFILE_SAMPLE_INTERVAL
+
+# Stage wrapping a whole account in run_account
+ACCOUNT_STAGE = 'account'
+
+
+def _file_name(*parts):
+    """Filesystem-safe name for an account/stage pstats file."""
+    return re.sub(r'[^\w@.-]', '_', '.'.join(part for part in parts if part)) + '.pstats'
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class PipelineProfiler:
+    """Profiles every stage timed through run_metrics, so new stages are covered for free.
+
+    Each account is run under cProfile and written to <directory>/<email>.pstats;
+    with per_stage, each stage inside an account gets its own
+    <email>.<stage>.pstats instead (cProfile cannot nest within a thread).
+    A sampling thread meanwhile records the stacks of every thread inside a
+    stage, prefixed with the stage path, and stop() writes them to
+    <directory>/stacks.collapsed for flamegraph.pl or speedscope, along with
+    all accounts merged into <directory>/combined.pstats.
+    """
+
+    def __init__(self, directory, per_stage=False, interval=PROFILE_SAMPLE_INTERVAL, metrics=run_metrics):
+        self.directory = directory
+        self.per_stage = per_stage
+        self.interval = interval
+        self.metrics = metrics
+        self.samples = Counter()
+        self._stages = {}  # thread id -> stage path of the stages it is inside
+        self._profiled = {}  # thread id -> (Profile, stage) currently enabled
+        self._written = []
+        self._skipped = 0  # runs not profiled because another cProfile was active
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.metrics.add_stage_hook(self.stage)
+        self._thread.start()
+        logging.info(f"Profiling accounts into {self.directory}")
+        return self
+
+    def stop(self):
+        self.metrics.remove_stage_hook(self.stage)
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+    @contextmanager
+    def stage(self, stage, account):
+        """Stage hook: label the thread for the sampler and run cProfile where due."""
+        thread_id = threading.get_ident()
+        with self._lock:
+            path = self._stages.get(thread_id, ())
+            self._stages[thread_id] = path + (stage,)
+            due = thread_id not in self._profiled and (stage == ACCOUNT_STAGE) != self.per_stage
+        profile = self._enable(thread_id, stage) if due else None
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                self._save(profile, account, None if stage == ACCOUNT_STAGE else stage)
+                with self._lock:
+                    del self._profiled[thread_id]
+            with self._lock:
+                if path:
+                    self._stages[thread_id] = path
+                else:
+                    del self._stages[thread_id]
+
+    def _enable(self, thread_id, stage):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Python 3.12+ allows one active cProfile per process
+            with self._lock:
+                self._skipped += 1
+                first = self._skipped == 1
+            if first:
+                logging.warning(
+                    f"Not profiling {stage}: {str(e)}; on Python 3.12+ only one account or stage "
+                    "is profiled at a time, run with --workers 1 for complete .pstats files"
+                )
+            return None
+        with self._lock:
+            self._profiled[thread_id] = (profile, stage)
+        return profile
+
+    def _save(self, profile, account, stage):
+        path = os.path.join(self.directory, _file_name(account or 'unknown', stage))
+        try:
+            profile.dump_stats(path)
+        except OSError as e:
+            logging.error(f"Failed to write profile {path}: {str(e)}")
+            return
+        with self._lock:
+            self._written.append(path)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                stages = dict(self._stages)
+            frames = sys._current_frames()
+            for thread_id, path in stages.items():
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                self.samples[';'.join(path + tuple(reversed(stack)))] += 1
+
+    def write(self):
+        """Write the collapsed stacks and the merged pstats; returns the paths written."""
+        paths = []
+        collapsed = os.path.join(self.directory, 'stacks.collapsed')
+        try:
+            with open(collapsed, 'w') as f:
+                for stack, count in sorted(self.samples.items()):
+                    f.write(f"{stack} {count}\n")
+            paths.append(collapsed)
+        except OSError as e:
+            logging.error(f"Failed to write {collapsed}: {str(e)}")
+
+        with self._lock:
+            written = list(self._written)
+            skipped = self._skipped
+        if written:
+            combined = os.path.join(self.directory, 'combined.pstats')
+            try:
+                pstats.Stats(*written).dump_stats(combined)
+                paths.append(combined)
+            except (OSError, TypeError, EOFError) as e:
+                logging.error(f"Failed to write {combined}: {str(e)}")
+        logging.info(
+            f"Profiled {len(written)} runs and {sum(self.samples.values())} stack samples into {self.directory}"
+        )
+        if skipped:
+            logging.warning(f"{skipped} runs were not profiled because another profile was active")
+        return paths
@@ -0,0 +1,57 @@
+"""Token-bucket rate limiting shared by every thread calling the AdsPower API."""
+import threading
+import time
+
+
+class TokenBucket:
+    """Allows `rate` calls per second on average with bursts of up to `burst`.
+
+    acquire() reserves a token and sleeps until it is due, so waiting callers
+    are served in arrival order without spinning.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take one token without sleeping; returns the seconds until it is due."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def acquire(self):
+        """Take one token, sleeping if needed; returns the seconds waited."""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class RateLimiter:
+    """Per-key token buckets plus an optional bucket ('*') applied to every key."""
+
+    def __init__(self, limits):
+        self.buckets = {key: TokenBucket(rate, burst) for key, (rate, burst) in limits.items()}
+
+    def reserve(self, key):
+        """Take from the global and the key's bucket without sleeping; returns the seconds to wait.
+
+        For callers that must not block, e.g. on an event loop.
+        """
+        return sum(self.buckets[name].reserve() for name in ('*', key) if name in self.buckets)
+
+    def acquire(self, key):
+        """Wait for the global and the key's bucket; returns the total seconds waited."""
+        waited = 0.0
+        for name in ('*', key):
+            bucket = self.buckets.get(name)
+            if bucket is not None:
+                waited += bucket.acquire()
+        return waited
@@ -0,0 +1,99 @@
+"""Retry policy shared by every stage: error classification, backoff and per-account deadlines."""
+import random
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from config import RETRY_DELAY, RETRY_MAX_DELAY
+
+# AdsPower `msg` fragments (lower-cased) for throttling and transient load
+ADSPOWER_RETRYABLE_MESSAGES = ('too many request', 'rate limit', 'busy', 'try again', 'timeout')
+# AdsPower `msg` fragments (lower-cased) that will not go away by retrying
+ADSPOWER_FATAL_MESSAGES = (
+    'exceed', 'limit', 'does not exist', 'not exist', 'invalid',
+    'insufficient', 'expired', 'no permission', 'not allowed',
+)
+# IMAP responses that mean the credentials or account are wrong
+IMAP_FATAL_MESSAGES = ('authenticationfailed', 'login failed', 'invalid credentials', 'logondenied')
+# WebDriver exception class names that mean the browser session itself is gone
+WEBDRIVER_FATAL_ERRORS = (
+    'InvalidSessionIdException', 'SessionNotCreatedException', 'NoSuchWindowException',
+)
+
+# Deadline of the account being processed by the current thread
+_local = threading.local()
+
+
+class RetryableError(Exception):
+    """A failure that may succeed if the operation is tried again."""
+
+
+class FatalError(Exception):
+    """A failure that retrying cannot fix; the account should be abandoned."""
+
+
+def adspower_error(data):
+    """Turn a non-zero AdsPower response into a RetryableError or FatalError."""
+    message = str(data.get('msg', 'Unknown error'))
+    lowered = message.lower()
+    if any(part in lowered for part in ADSPOWER_RETRYABLE_MESSAGES):
+        return RetryableError(f"AdsPower: {message}")
+    if any(part in lowered for part in ADSPOWER_FATAL_MESSAGES):
+        return FatalError(f"AdsPower: {message}")
+    return RetryableError(f"AdsPower: {message}")
+
+
+def is_retryable(error):
+    """Classify an exception raised by AdsPower, IMAP or WebDriver code."""
+    if isinstance(error, FatalError):
+        return False
+    if isinstance(error, RetryableError):
+        return True
+    # Only loaded by the commands that talk IMAP; without it there are no IMAP errors
+    imaplib = sys.modules.get('imaplib')
+    if imaplib is not None and isinstance(error, imaplib.IMAP4.error):
+        if isinstance(error, imaplib.IMAP4.abort):
+            return True
+        return not any(part in str(error).lower() for part in IMAP_FATAL_MESSAGES)
+    if type(error).__name__ in WEBDRIVER_FATAL_ERRORS:
+        return False
+    if isinstance(error, (OSError, socket.timeout, TimeoutError)):
+        return True
+    # Unknown errors (including generic WebDriverException) get the benefit of the doubt
+    return True
+
+
+def backoff_delay(attempt):
+    """Jittered exponential backoff for the given zero-based attempt."""
+    ceiling = min(RETRY_MAX_DELAY, RETRY_DELAY * (2 ** attempt))
+    return random.uniform(ceiling / 2, ceiling)
+
+
+class Deadline:
+    """Wall-clock budget for one account."""
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+@contextmanager
+def account_deadline(seconds):
+    """Bound every retry made by this thread to a shared per-account deadline."""
+    previous = getattr(_local, 'deadline', None)
+    _local.deadline = Deadline(seconds)
+    try:
+        yield _local.deadline
+    finally:
+        _local.deadline = previous
+
+
+def current_deadline():
+    """Return the deadline set by account_deadline() in this thread, if any."""
+    return getattr(_local, 'deadline', None)
@@ -0,0 +1,138 @@
+"""In-flight session tracking, parallel teardown and SIGINT/SIGTERM shutdown."""
+import logging
+import signal
+import threading
+import time
+from log_context import log_context, current_log_context
+from config import SHUTDOWN_DEADLINE
+
+_shutdown = threading.Event()
+
+
+def shutdown_requested():
+    """True once a shutdown signal was received."""
+    return _shutdown.is_set()
+
+
+def wait_unless_shutdown(seconds):
+    """Sleep for seconds, returning early (True) if shutdown is requested."""
+    return _shutdown.wait(seconds)
+
+
+def run_parallel(calls, timeout):
+    """Run each (name, callable) in its own thread and wait up to timeout overall.
+
+    The caller's log context is carried into the threads. Errors are
+    logged, not raised. Returns the names that had not finished when the
+    timeout expired; their threads are daemons and are abandoned.
+    """
+    context = current_log_context()
+    threads = []
+    for name, call in calls:
+        def target(name=name, call=call):
+            try:
+                with log_context(**context):
+                    call()
+            except Exception as e:
+                logging.error(f"Teardown step {name} failed: {str(e)}")
+        thread = threading.Thread(target=target, name=f"teardown-{name}", daemon=True)
+        thread.start()
+        threads.append((name, thread))
+
+    deadline = time.monotonic() + timeout
+    for _, thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+    unfinished = [name for name, thread in threads if thread.is_alive()]
+    if unfinished:
+        logging.warning(f"Teardown steps still running after {timeout}s: {', '.join(unfinished)}")
+    return unfinished
+
+
+class AccountSession:
+    """Resources one process_account call holds; close() releases them all once."""
+
+    def __init__(self, tracker, email, adspower_api):
+        self.tracker = tracker
+        self.email = email
+        self.adspower_api = adspower_api
+        self.profile_id = None
+        self.browser_opened = False
+        self.tiktok = None
+        self.email_handler = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def _close_browser(self):
+        # Quit the WebDriver session before AdsPower stops the browser under it
+        if self.tiktok:
+            self.tiktok.cleanup()
+        if self.browser_opened:
+            self.adspower_api.close_browser(self.profile_id)
+
+    def close(self, timeout=SHUTDOWN_DEADLINE, abort=False):
+        """Tear down the browser and IMAP session in parallel; safe to call twice.
+        
+        With abort, a worker blocked waiting for mail is woken up first.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if abort and self.email_handler:
+                self.email_handler.abort()
+            calls = [('browser', self._close_browser)]
+            if self.email_handler:
+                calls.append(('imap', self.email_handler.cleanup))
+            run_parallel(calls, timeout)
+        self.tracker.discard(self)
+
+
+class SessionTracker:
+    """Registry of in-flight AccountSessions so a signal can close them all."""
+
+    def __init__(self):
+        self._sessions = set()
+        self._lock = threading.Lock()
+
+    def open(self, email, adspower_api):
+        """Register and return a new AccountSession."""
+        session = AccountSession(self, email, adspower_api)
+        with self._lock:
+            self._sessions.add(session)
+        return session
+
+    def discard(self, session):
+        with self._lock:
+            self._sessions.discard(session)
+
+    def close_all(self, timeout=SHUTDOWN_DEADLINE):
+        """Close every in-flight session at once, within timeout overall."""
+        with self._lock:
+            sessions = list(self._sessions)
+        if not sessions:
+            return []
+        logging.info(f"Closing {len(sessions)} in-flight sessions")
+        return run_parallel(
+            [(session.email, lambda session=session: session.close(timeout, abort=True)) for session in sessions],
+            timeout
+        )
+
+
+active_sessions = SessionTracker()
+
+
+def install_signal_handlers(timeout=SHUTDOWN_DEADLINE):
+    """On the first SIGINT/SIGTERM stop new work and close in-flight sessions in parallel.
+
+    A second signal interrupts the main thread as usual. Must be called from
+    the main thread.
+    """
+    def handle(signum, frame):
+        if _shutdown.is_set():
+            raise KeyboardInterrupt
+        _shutdown.set()
+        logging.warning(f"Received {signal.Signals(signum).name}, shutting down (again to force)")
+        active_sessions.close_all(timeout)
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, handle)
@@ -1,22 +1,104 @@
 """TikTok Ads login automation using Selenium."""
 from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException, NoSuchFrameException
+from selenium.webdriver.remote.remote_connection import RemoteConnection
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from retry_policy import FatalError, is_retryable
+import cassette
 import time
 import random
 import logging
 from config import (
     TIKTOK_ADS_URL, SELECTORS, PAGE_LOAD_TIMEOUT,
-    IMPLICIT_WAIT, TYPING_DELAY_MIN, TYPING_DELAY_MAX,
-    ACTION_DELAY, MANUAL_CAPTCHA_TIMEOUT
+    TYPING_DELAY_MIN, TYPING_DELAY_MAX, MANUAL_CAPTCHA_TIMEOUT,
+    PAGE_STATE_TIMEOUT, PAGE_STATE_POLL_INTERVAL, SESSION_CHECK_TIMEOUT
 )
 
+# Page states reported by TikTokLogin.detect_state()
+LOGIN_FORM = 'login_form'
+CAPTCHA = 'captcha'
+CODE_ENTRY = 'code_entry'
+DASHBOARD = 'dashboard'
+ERROR = 'error'
+UNKNOWN = 'unknown'
+
+
+def xpaths(name):
+    """Fallback XPaths of a SELECTORS entry, tried in order."""
+    selector = SELECTORS[name]
+    return [selector] if isinstance(selector, str) else list(selector)
+
+
+# Checked in order, so overlays (captcha, errors) win over the form beneath them
+STATE_SELECTORS = [
+    (CAPTCHA, xpaths('captcha_iframe')),
+    (ERROR, xpaths('login_error')),
+    (CODE_ENTRY, xpaths('verification_code_input')),
+    (DASHBOARD, xpaths('dashboard')),
+    (LOGIN_FORM, xpaths('email_input')),
+]
+
+LOGIN_ELEMENTS = ('email_input', 'password_input', 'login_button')
+
+
+class CassetteConnection(RemoteConnection):
+    """WebDriver transport that records commands to, or replays them from, the account's cassette.
+
+    Only command names, responses and timings are kept; request parameters
+    (typed text included) are not recorded.
+    """
+
+    def __init__(self, remote_server_addr, account):
+        super().__init__(remote_server_addr)
+        self.account = account
+
+    def execute(self, command, params):
+        return cassette.exchange(
+            'webdriver', command, lambda: RemoteConnection.execute(self, command, params), account=self.account
+        )
+
+# Classifies the page and resolves the requested elements in a single
+# WebDriver round trip; the first visible match among an entry's XPaths wins.
+# The window flag tells whether a navigation happened since the last call.
+INSPECT_SCRIPT = """
+const [checks, lookups] = arguments;
+// Iframes too: a captcha frame hidden, or left behind once solved, must not count
+const visible = (node) => {
+    const rect = node.getBoundingClientRect();
+    return rect.width > 0 && rect.height > 0 && getComputedStyle(node).visibility !== 'hidden';
+};
+const find = (candidates) => {
+    for (const xpath of candidates) {
+        const node = document.evaluate(
+            xpath, document, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null
+        ).singleNodeValue;
+        if (node && visible(node)) {
+            return node;
+        }
+    }
+    return null;
+};
+let state = null;
+for (const [name, candidates] of checks) {
+    if (find(candidates)) {
+        state = name;
+        break;
+    }
+}
+const elements = {};
+for (const [name, candidates] of lookups) {
+    elements[name] = find(candidates);
+}
+const fresh = !window.__tiktokLoginInspected;
+window.__tiktokLoginInspected = true;
+return [state, elements, fresh];
+"""
+
 class TikTokLogin:
     def __init__(self, selenium_port):
         self.driver = None
         self.selenium_port = selenium_port
+        self._elements = {}  # name -> element handle, valid until the page changes
+        self._state = None  # page state the cached handles belong to
         self.setup_driver()
 
     def setup_driver(self):
@@ -24,13 +106,15 @@ class TikTokLogin:
         options = webdriver.ChromeOptions()
         options.add_argument('--no-sandbox')
         options.add_argument('--disable-dev-shm-usage')
-        
+
+        url = f"http://localhost:{self.selenium_port}"
         self.driver = webdriver.Remote(
-            command_executor=f"http://localhost:{self.selenium_port}",
+            command_executor=CassetteConnection(url, cassette.current_account()) if cassette.active() else url,
             options=options
         )
         self.driver.set_page_load_timeout(PAGE_LOAD_TIMEOUT)
-        self.driver.implicitly_wait(IMPLICIT_WAIT)
+        # No implicit wait: lookups that may legitimately miss must not block,
+        # every wait below is an explicit condition
 
     def humanized_type(self, element, text):
         """Simulate human-like typing with random delays."""
@@ -38,84 +122,169 @@ class TikTokLogin:
             element.send_keys(char)
             time.sleep(random.uniform(TYPING_DELAY_MIN, TYPING_DELAY_MAX))
 
+    def inspect(self, names=()):
+        """Classify the page and resolve the named elements in one script round trip.
+        
+        Handles are cached until the page navigates or changes state, and
+        only names missing from the cache are looked up. Returns
+        (state, {name: element or None}).
+        """
+        cached = {name: self._elements[name] for name in names if name in self._elements}
+        lookups = [(name, xpaths(name)) for name in names if name not in cached]
+        state, found, fresh = self.driver.execute_script(INSPECT_SCRIPT, STATE_SELECTORS, lookups)
+        state = state or UNKNOWN
+        if fresh or state != self._state:
+            self._elements.clear()
+            self._state = state
+            if cached:
+                # The cached handles belonged to the previous page
+                return self.inspect(names)
+        self._elements.update((name, element) for name, element in found.items() if element is not None)
+        return state, {name: self._elements.get(name) for name in names}
+
+    def element(self, name, timeout=PAGE_STATE_TIMEOUT):
+        """Cached handle for name, or poll inspect() until it appears; None on timeout."""
+        if name in self._elements:
+            return self._elements[name]
+        return self.poll(lambda: self.inspect((name,))[1][name], timeout, 'element')
+
+    def poll(self, condition, timeout, wait):
+        """Call condition() every PAGE_STATE_POLL_INTERVAL until it is truthy; None after timeout.
+        
+        The give-up check goes through cassette.expired() under the name wait.
+        """
+        end = time.monotonic() + timeout
+        while True:
+            value = condition()
+            if value:
+                return value
+            if cassette.expired(wait, lambda: time.monotonic() >= end):
+                return None
+            time.sleep(PAGE_STATE_POLL_INTERVAL)
+
+    def detect_state(self, names=()):
+        """Classify the current page with one script round trip, resolving names on the way."""
+        try:
+            return self.inspect(names)[0]
+        except WebDriverException as e:
+            logging.debug(f"Page state check failed: {str(e)}")
+            return UNKNOWN
+
+    def wait_for_state(self, states, timeout=PAGE_STATE_TIMEOUT, names=()):
+        """Poll detect_state() until it returns one of states; None on timeout.
+        
+        Elements in names are resolved by the same polls, ready for element().
+        """
+        def matched():
+            state = self.detect_state(names)
+            return state if state in states else None
+
+        state = self.poll(matched, timeout, 'page_state')
+        if state is None:
+            logging.debug(f"Page did not reach any of {sorted(states)} within {timeout}s")
+        return state
+
+    def wait_after_submit(self, timeout=PAGE_STATE_TIMEOUT):
+        """Wait for the page that follows the login submit and return its state."""
+        state = self.wait_for_state(
+            {CAPTCHA, CODE_ENTRY, DASHBOARD, ERROR}, timeout, names=('verification_code_input',)
+        )
+        logging.info(f"Page state after login submit: {state or UNKNOWN}")
+        return state or UNKNOWN
+
+    def check_session(self, timeout=SESSION_CHECK_TIMEOUT):
+        """Open TikTok Ads and report the state the profile lands on.
+        
+        DASHBOARD means the profile's session is still valid and the login
+        can be skipped; LOGIN_FORM leaves the form loaded for login().
+        """
+        try:
+            self.driver.get(TIKTOK_ADS_URL)
+        except TimeoutException:
+            logging.warning("TikTok Ads page load timed out during session check")
+        state = self.wait_for_state({DASHBOARD, LOGIN_FORM, CAPTCHA, CODE_ENTRY, ERROR}, timeout)
+        logging.info(f"Session check: {state or UNKNOWN}")
+        return state or UNKNOWN
+
     def handle_captcha(self):
         """Handle CAPTCHA by waiting for manual resolution."""
         try:
-            # Check if CAPTCHA iframe exists
             logging.info("Checking for CAPTCHA presence...")
-            iframe = WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.XPATH, SELECTORS['captcha_iframe']))
-            )
-            
-            if not iframe:
+            if self.detect_state() != CAPTCHA:
                 logging.info("No CAPTCHA detected")
                 return True
-                
-            logging.info("CAPTCHA detected, switching to iframe...")
-            self.driver.switch_to.frame(iframe)
-            
+
             # Wait for manual CAPTCHA resolution
-            logging.info("Waiting for manual CAPTCHA resolution...")
+            logging.info("CAPTCHA detected, waiting for manual resolution...")
             start_time = time.time()
-            
-            while time.time() - start_time < MANUAL_CAPTCHA_TIMEOUT:
-                try:
-                    # Check if CAPTCHA is still present
-                    self.driver.find_element(By.XPATH, SELECTORS['captcha_verify_button'])
-                    time.sleep(2)
-                except:
+
+            while not cassette.expired('captcha', lambda: time.time() - start_time >= MANUAL_CAPTCHA_TIMEOUT):
+                if self.detect_state() != CAPTCHA:
                     logging.info("CAPTCHA appears to be solved")
                     return True
-            
+                time.sleep(PAGE_STATE_POLL_INTERVAL)
+
             logging.error("CAPTCHA resolution timeout exceeded")
             return False
-            
-        except NoSuchFrameException:
-            logging.info("CAPTCHA iframe not found, might not be required")
-            return True
+
         except Exception as e:
             logging.error(f"Error handling CAPTCHA: {str(e)}")
             return False
-        finally:
-            try:
-                self.driver.switch_to.default_content()
-            except:
-                pass
 
     def login(self, email, password):
         """Perform TikTok Ads login."""
         try:
-            self.driver.get(TIKTOK_ADS_URL)
-            time.sleep(ACTION_DELAY)
-            
-            # Enter email
-            email_input = self.driver.find_element(By.XPATH, SELECTORS['email_input'])
+            # Reuse the form when check_session() already loaded it; the
+            # state check resolves the form's elements in the same round trip
+            state, elements = self.inspect(LOGIN_ELEMENTS)
+            if state != LOGIN_FORM or None in elements.values():
+                self.driver.get(TIKTOK_ADS_URL)
+                if self.wait_for_state({LOGIN_FORM}, names=LOGIN_ELEMENTS) is None:
+                    logging.error("Login form did not appear")
+                    return False
+                state, elements = self.inspect(LOGIN_ELEMENTS)
+                if None in elements.values():
+                    missing = [name for name, element in elements.items() if element is None]
+                    logging.error(f"Login form is missing {', '.join(missing)}")
+                    return False
+
+            # Enter email (cleared first, a failed attempt may have left text)
+            email_input = elements['email_input']
+            email_input.clear()
             self.humanized_type(email_input, email)
-            
+
             # Enter password
-            password_input = self.driver.find_element(By.XPATH, SELECTORS['password_input'])
+            password_input = elements['password_input']
+            password_input.clear()
             self.humanized_type(password_input, password)
-            
+
             # Click login
-            login_button = self.driver.find_element(By.XPATH, SELECTORS['login_button'])
-            login_button.click()
-            
+            elements['login_button'].click()
+
             return True
-            
+
         except Exception as e:
+            # A handle may have gone stale; look everything up again on retry
+            self._elements.clear()
             logging.error(f"Error during login: {str(e)}")
+            if not is_retryable(e):
+                raise FatalError(f"Browser session lost during login: {str(e)}") from e
             return False
 
     def enter_verification_code(self, code):
         """Enter email verification code."""
         try:
-            code_input = WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.XPATH, SELECTORS['verification_code_input']))
-            )
+            code_input = self.element('verification_code_input')
+            if code_input is None:
+                logging.error("Verification code input did not appear")
+                return False
             self.humanized_type(code_input, code)
             return True
         except Exception as e:
+            self._elements.clear()
             logging.error(f"Error entering verification code: {str(e)}")
+            if not is_retryable(e):
+                raise FatalError(f"Browser session lost entering the code: {str(e)}") from e
             return False
 
     def cleanup(self):
@@ -1,57 +1,62 @@
 """Utility functions for the TikTok Ads login automation."""
 import logging
+import logging.handlers
+import queue
 import time
-from config import LOG_FORMAT, LOG_FILE, LOG_LEVEL, MAX_RETRIES, RETRY_DELAY, PROFILE_IDS_FILE
+from accounts import iter_accounts
+from metrics import note_retry
+from teardown import shutdown_requested
+from retry_policy import FatalError, backoff_delay, current_deadline, is_retryable
+from log_context import (
+    ContextFilter, JSONLFormatter, PayloadFormatter, ThreadQueueHandler, set_payload_logging
+)
+from config import (
+    LOG_FORMAT, LOG_FILE, LOG_JSON_FILE, LOG_LEVEL, LOG_PAYLOADS, LOG_STRUCTURED,
+    MAX_RETRIES, PROFILE_IDS_FILE
+)
 
-def setup_logging():
-    """Configure logging settings with enhanced formatting and debug level."""
+def setup_logging(structured=LOG_STRUCTURED, payloads=LOG_PAYLOADS):
+    """Configure logging through a queue so formatting and I/O stay off worker threads.
+    
+    Records are tagged with the account/profile correlation fields, then
+    written by a listener thread as text (LOG_FILE and stdout) or, when
+    structured, as JSONL to LOG_JSON_FILE. Returns the started QueueListener;
+    stop it before exiting to flush pending records.
+    """
     # Convert string log level to logging constant
     numeric_level = getattr(logging, LOG_LEVEL.upper(), logging.INFO)
+    set_payload_logging(payloads)
+    
+    if structured:
+        formatter = JSONLFormatter()
+        handlers = [logging.FileHandler(LOG_JSON_FILE)]
+    else:
+        formatter = PayloadFormatter(LOG_FORMAT)
+        handlers = [logging.FileHandler(LOG_FILE), logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
     
-    logging.basicConfig(
-        level=numeric_level,
-        format=LOG_FORMAT,
-        handlers=[
-            logging.FileHandler(LOG_FILE),
-            logging.StreamHandler()
-        ]
-    )
+    log_queue = queue.SimpleQueue()
+    queue_handler = ThreadQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    logging.basicConfig(level=numeric_level, handlers=[queue_handler], force=True)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
     
     # Log initial setup information
     logging.info("Logging system initialized")
     logging.debug(f"Log level set to: {LOG_LEVEL}")
-    logging.debug(f"Log file: {LOG_FILE}")
+    logging.debug(f"Log file: {LOG_JSON_FILE if structured else LOG_FILE}")
+    return listener
 
 def read_accounts(filename):
-    """Read account credentials from file."""
-    accounts = []
-    try:
-        with open(filename, 'r') as f:
-            for line in f:
-                if line.strip():  # Skip empty lines
-                    try:
-                        email, email_pass, tiktok_pass = line.strip().split()
-                        accounts.append({
-                            'email': email,
-                            'email_password': email_pass,
-                            'tiktok_password': tiktok_pass
-                        })
-                    except ValueError as e:
-                        logging.error(f"Invalid line format in accounts file: {line.strip()}")
-                        logging.error(f"Expected format: email email_password tiktok_password")
-        logging.info(f"Successfully loaded {len(accounts)} accounts from {filename}")
-        return accounts
-    except FileNotFoundError:
-        logging.error(f"Accounts file not found: {filename}")
-        return []
-    except Exception as e:
-        logging.error(f"Error reading accounts file: {str(e)}")
-        return []
+    """Read all account credentials from file into a list; see accounts.iter_accounts."""
+    return list(iter_accounts(filename))
 
-def save_profile_id(email, profile_id):
+def save_profile_id(email, profile_id, filename=PROFILE_IDS_FILE):
     """Save created profile ID to file with error handling."""
     try:
-        with open(PROFILE_IDS_FILE, 'a') as f:
+        with open(filename, 'a') as f:
             f.write(f"{email},{profile_id}\n")
         logging.info(f"Saved profile ID {profile_id} for account {email}")
     except Exception as e:
@@ -59,9 +64,15 @@ def save_profile_id(email, profile_id):
         logging.error(f"Email: {email}, Profile ID: {profile_id}")
 
 def retry_operation(operation, *args, **kwargs):
-    """Retry an operation with exponential backoff and detailed logging."""
+    """Retry an operation under the shared retry policy with detailed logging.
+    
+    Falsy results and retryable errors are retried with jittered exponential
+    backoff. Fatal errors, and retries that would overrun the account deadline,
+    raise FatalError at once so the worker can move on.
+    """
     operation_name = operation.__name__
     logging.debug(f"Starting operation: {operation_name}")
+    deadline = current_deadline()
     
     for attempt in range(MAX_RETRIES):
         try:
@@ -75,13 +86,23 @@ def retry_operation(operation, *args, **kwargs):
                 logging.warning(f"Operation {operation_name} returned False on attempt {attempt + 1}")
                 
         except Exception as e:
+            if not is_retryable(e):
+                logging.error(f"Operation {operation_name} failed permanently: {str(e)}")
+                if isinstance(e, FatalError):
+                    raise
+                raise FatalError(str(e)) from e
             logging.error(f"Operation {operation_name} failed (attempt {attempt + 1}/{MAX_RETRIES})")
             logging.error(f"Error details: {str(e)}")
         
         if attempt < MAX_RETRIES - 1:
-            delay = RETRY_DELAY * (attempt + 1)
-            logging.debug(f"Waiting {delay} seconds before next attempt")
+            if shutdown_requested():
+                raise FatalError(f"Shutting down during {operation_name}")
+            delay = backoff_delay(attempt)
+            if deadline is not None and deadline.remaining() < delay:
+                raise FatalError(f"Account deadline exceeded during {operation_name}")
+            logging.debug(f"Waiting {delay:.1f} seconds before next attempt")
             time.sleep(delay)
+            note_retry()
     
     logging.error(f"Operation {operation_name} failed after {MAX_RETRIES} attempts")
     return None
@@ -0,0 +1,213 @@
+"""Shared SQLite work queue that lets several hosts drain one account list."""
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from config import QUEUE_LEASE_SECONDS, QUEUE_MAX_ATTEMPTS
+
+# Account rows move queued -> leased -> done/failed; an expired lease is
+# treated as queued again so a crashed worker's accounts are picked up
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    email TEXT PRIMARY KEY,
+    email_password TEXT NOT NULL,
+    tiktok_password TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL
+);
+CREATE INDEX IF NOT EXISTS accounts_status ON accounts (status, lease_expires);
+"""
+
+# Rows a worker may lease: never leased, or leased by someone whose lease lapsed
+_LEASABLE = "(status = 'queued' OR (status = 'leased' AND lease_expires < ?)) AND attempts < ?"
+
+
+def default_worker_id():
+    """hostname:pid, unique across the hosts sharing a queue."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """Lease-based account queue in a SQLite file, safe across threads and processes.
+
+    Every call opens its own short-lived connection, so one WorkQueue can be
+    shared by worker threads, and the file can sit on storage shared by hosts.
+    """
+
+    def __init__(self, path, lease_seconds=QUEUE_LEASE_SECONDS, max_attempts=QUEUE_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return _Transaction(db)
+
+    def enqueue(self, accounts, batch_size=500):
+        """Add accounts not already in the queue; returns how many were added."""
+        added = 0
+        batch = []
+
+        def flush():
+            with self._connect() as db:
+                before = db.total_changes
+                db.executemany(
+                    "INSERT OR IGNORE INTO accounts (email, email_password, tiktok_password, updated_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    batch
+                )
+                return db.total_changes - before
+
+        for account in accounts:
+            batch.append((account['email'], account['email_password'], account['tiktok_password'], time.time()))
+            if len(batch) >= batch_size:
+                added += flush()
+                batch = []
+        if batch:
+            added += flush()
+        logging.info(f"Queued {added} new accounts in {self.path}")
+        return added
+
+    def lease(self, worker_id):
+        """Lease the next available account to worker_id; None when nothing is leasable."""
+        now = time.time()
+        with self._connect() as db:
+            # Lapsed leases with no attempts left will never be picked up again
+            abandoned = db.execute(
+                "UPDATE accounts SET status = 'failed', lease_expires = NULL, updated_at = ? "
+                "WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, now, self.max_attempts)
+            ).rowcount
+            if abandoned:
+                logging.warning(f"Marked {abandoned} accounts failed after {self.max_attempts} expired leases")
+            row = db.execute(
+                f"SELECT * FROM accounts WHERE {_LEASABLE} ORDER BY attempts, rowid LIMIT 1",
+                (now, self.max_attempts)
+            ).fetchone()
+            if row is None:
+                return None
+            if row['status'] == 'leased':
+                logging.warning(f"Re-leasing {row['email']}, lease of {row['worker']} expired")
+            db.execute(
+                "UPDATE accounts SET status = 'leased', worker = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated_at = ? WHERE email = ?",
+                (worker_id, now + self.lease_seconds, now, row['email'])
+            )
+        return {
+            'email': row['email'],
+            'email_password': row['email_password'],
+            'tiktok_password': row['tiktok_password'],
+        }
+
+    def heartbeat(self, emails, worker_id):
+        """Extend worker_id's leases on emails; returns the emails it still holds."""
+        if not emails:
+            return []
+        now = time.time()
+        held = []
+        with self._connect() as db:
+            for email in emails:
+                cursor = db.execute(
+                    "UPDATE accounts SET lease_expires = ?, updated_at = ? "
+                    "WHERE email = ? AND worker = ? AND status = 'leased'",
+                    (now + self.lease_seconds, now, email, worker_id)
+                )
+                if cursor.rowcount:
+                    held.append(email)
+        return held
+
+    def complete(self, email, worker_id, success):
+        """Mark a leased account done or failed; ignored if the lease was lost."""
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE accounts SET status = ?, lease_expires = NULL, updated_at = ? "
+                "WHERE email = ? AND worker = ? AND status = 'leased'",
+                ('done' if success else 'failed', time.time(), email, worker_id)
+            )
+            updated = cursor.rowcount
+        if not updated:
+            logging.warning(f"Lease on {email} was lost before it completed")
+
+    def outstanding(self):
+        """Accounts that are held under a live lease or can still be leased."""
+        now = time.time()
+        with self._connect() as db:
+            return db.execute(
+                f"SELECT COUNT(*) FROM accounts WHERE (status = 'leased' AND lease_expires >= ?) OR {_LEASABLE}",
+                (now, now, self.max_attempts)
+            ).fetchone()[0]
+
+    def counts(self):
+        """Number of accounts per status."""
+        with self._connect() as db:
+            return dict(db.execute("SELECT status, COUNT(*) FROM accounts GROUP BY status").fetchall())
+
+
+class _Transaction:
+    """Connection context that runs its statements in one IMMEDIATE transaction."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute("BEGIN IMMEDIATE")
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.db.close()
+        return False
+
+
+class Heartbeat:
+    """Background thread renewing the leases held by one worker process."""
+
+    def __init__(self, work_queue, worker_id, interval):
+        self.queue = work_queue
+        self.worker_id = worker_id
+        self.interval = interval
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="queue-heartbeat", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def hold(self, email):
+        with self._lock:
+            self._held.add(email)
+
+    def release(self, email):
+        with self._lock:
+            self._held.discard(email)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                emails = list(self._held)
+            try:
+                held = self.queue.heartbeat(emails, self.worker_id)
+            except Exception as e:
+                logging.error(f"Queue heartbeat failed: {str(e)}")
+                continue
+            for email in set(emails) - set(held):
+                logging.warning(f"Lost the lease on {email}; another worker may retry it")
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()